@@ -6,15 +6,28 @@ Python 3, [RDFLib](http://rdflib.readthedocs.org/en/latest/) and [Requests](http
 
 If you want to see a progress bar, you'll need [PyPrind](https://github.com/rasbt/pyprind).
 
+The asyncio versions (`arpa.AsyncArpa` and `arpa.arpafy_async`) require [aiohttp](https://docs.aiohttp.org/).
+
 ## Usage<a name="usage"></a>
 
 The module can be invoked as a script from the command line or by calling `arpa.arpafy` (or `arpa.process`) in your Python code.
 
+Instead of an ARPA service, the texts can be matched in process against the labels of a vocabulary graph with `arpa.LocalArpa`.
+
 <pre style="padding:5px">
 usage: arpa.py [-h] [--fi INPUT_FORMAT] [--fo OUTPUT_FORMAT] [-n] [-c]
                [--rdf_class CLASS] [--prop PROPERTY]
                [--ignore [TERM [TERM ...]]] [--min_ngram N]
+               [--local_candidates] [--max_ngram N]
                [--no_duplicates [TYPE [TYPE ...]]] [-r N] [-w N]
+               [--backoff FACTOR] [--max_wait SECONDS] [--jitter FRACTION]
+               [--breaker_threshold N] [--breaker_timeout SECONDS]
+               [--workers N] [--adaptive] [--max_rate N] [--processes N]
+               [--batch_size N] [--batch_bytes N] [--validation_window N]
+               [--stream] [--stream_links]
+               [--cache FILE] [--cache_size N] [--cache_ttl SECONDS]
+               [--checkpoint FILE] [--checkpoint_interval N] [--resume]
+               [--manifest FILE] [--report FILE]
                [--log_level {NOTSET,DEBUG,INFO,WARNING,ERROR,CRITICAL}]
                input output target_property arpa
 
@@ -46,6 +59,11 @@ optional arguments:
                         Terms that should be ignored even if matched
   --min_ngram N         The minimum ngram length that is considered a match.
                         Default is 1.
+  --local_candidates    Generate the candidates (n-grams) in process instead of
+                        querying them from ARPA. Only has an effect with
+                        --candidates_only.
+  --max_ngram N         The maximum length of the candidates generated with
+                        --local_candidates. Not limited by default.
   --no_duplicates [TYPE [TYPE ...]]
                         Remove duplicate matches based on the 'label' returned
                         by the ARPA service. Here 'duplicate' means a subject
@@ -60,6 +78,72 @@ optional arguments:
   -w N, --wait N        The number of seconds to wait between retries. Only
                         has an effect if number of retries is set. Default is
                         1 second.
+  --backoff FACTOR      The factor by which the wait time is multiplied after
+                        each retry. Default is 1 (constant wait time).
+  --max_wait SECONDS    The maximum number of seconds to wait between retries.
+                        Not limited by default.
+  --jitter FRACTION     The fraction (0-1) of the wait time that is randomly
+                        subtracted from it. Default is 0.
+  --breaker_threshold N
+                        Pause all queries after N consecutive failed queries
+                        (circuit breaker). Not used by default.
+  --breaker_timeout SECONDS
+                        The number of seconds the queries are paused by the
+                        circuit breaker. Default is 30.
+  --workers N           The number of concurrent queries to the ARPA service.
+                        Default is 1.
+  --adaptive            Adapt the number of concurrent queries between 1 and
+                        --workers based on the errors and latency of the
+                        responses.
+  --max_rate N          The maximum number of queries per second. Not limited
+                        by default.
+  --processes N         The number of processes the subjects are split between.
+                        Each process runs (and with --adaptive, adapts) --workers
+                        concurrent queries, and --max_rate is divided between
+                        the processes. Can not be used with --stream,
+                        --checkpoint, --manifest, --breaker_threshold or
+                        --cache. Default is 1.
+  --batch_size N        Query the texts of up to N subjects in a single request
+                        when possible. Batching is not used by default.
+  --batch_bytes N       The maximum size of a batch query in bytes. Not
+                        limited by default.
+  --validation_window N
+                        The number of subjects whose results are validated
+                        together, if the validator supports it. Default is
+                        100.
+  --stream              Process the input file line by line instead of loading
+                        it into memory. The input format has to be N-Triples
+                        or N-Quads, and the output is written in the same
+                        format.
+  --stream_links        With --new_graph, write each link to the output file as
+                        N-Triples as soon as it is found, instead of
+                        collecting the links into a graph and serializing it
+                        at the end. The output is N-Triples regardless of
+                        --fo.
+  --cache FILE          Cache the ARPA service responses in the given SQLite
+                        database file, and use the cached responses when
+                        available.
+  --cache_size N        The maximum number of cached responses. Not limited by
+                        default.
+  --cache_ttl SECONDS   The number of seconds after which a cached response
+                        expires. Never by default.
+  --checkpoint FILE     Journal the results in the given file as they are
+                        received, so that an interrupted run can be resumed
+                        with --resume.
+  --checkpoint_interval N
+                        The number of results after which the checkpoint
+                        journal is flushed to disk. Default is 100.
+  --resume              Resume an interrupted run from the --checkpoint
+                        journal: the journaled subjects are not queried again,
+                        and their results are added to the output as is.
+  --manifest FILE       Link incrementally: only query the subjects whose
+                        source text is new or has changed since the previous
+                        run with the same manifest file, and reuse the
+                        previous results of the rest. The manifest is updated
+                        when the run completes.
+  --report FILE         Write a JSON report of the run with the time spent in
+                        each phase and the number of requests, retries and
+                        bytes transferred.
   --log_level {NOTSET,DEBUG,INFO,WARNING,ERROR,CRITICAL}
                         Logging level, default is INFO.
   --log_file LOG_FILE   The log file. Default is arpa_linker.log.
@@ -77,18 +161,46 @@ and [arpa.args](https://github.com/SemanticComputing/python-arpa-linker/blob/mas
 
 import sys
 import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import reprlib
+import sqlite3
+import threading
 import requests
 import time
 import logging
-from datetime import timedelta
+import multiprocessing
+import zlib
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
-from rdflib import Graph, URIRef, Literal
+from rdflib import Graph, URIRef, Literal, BNode
 from rdflib.namespace import RDF, SKOS
-from rdflib.util import guess_format
-
-__all__ = ['Arpa', 'ArpaMimic', 'arpafy', 'process', 'process_graph', 'prune_candidates',
-            'combine_candidates', 'map_results', 'log_to_file', 'post', 'parse_args',
-            'main', 'LABEL_PROP', 'TYPE_PROP']
+from rdflib.util import guess_format, from_n3
+from rdflib.plugins.parsers.ntriples import ParseError
+try:
+    from rdflib.plugins.parsers.ntriples import W3CNTriplesParser as NTriplesParser
+except ImportError:
+    from rdflib.plugins.parsers.ntriples import NTriplesParser
+
+__all__ = ['Arpa', 'ArpaMimic', 'AsyncArpa', 'AsyncArpaMimic', 'LocalArpa', 'QueryCache', 'Checkpoint',
+            'Manifest', 'LinkWriter',
+            'CircuitBreaker', 'Throttle', 'ResultMapper', 'CandidateGenerator',
+            'arpafy', 'arpafy_async', 'process', 'process_graph', 'process_stream', 'prune_candidates',
+            'combine_candidates', 'map_results', 'log_to_file', 'post', 'post_async',
+            'make_session', 'get_shard', 'split_graph', 'parse_args', 'main',
+            'LABEL_PROP', 'TYPE_PROP', 'DEFAULT_POOL_SIZE', 'DEFAULT_VALIDATION_WINDOW',
+            'DEFAULT_PRUNE_CACHE_SIZE', 'BATCH_SEPARATOR', 'LINE_FORMATS', 'RETRYABLE_STATUS_CODES', 'MAX_LOG_LENGTH']
 
 LABEL_PROP = 'label'
 """The name of the property containing the label of the match in the ARPA results."""
@@ -99,12 +211,103 @@ The name of the property containing the type of the match in the ARPA results->p
 Only needed for prioritized duplicate removal.
 """
 
+DEFAULT_POOL_SIZE = 10
+"""The default maximum number of connections kept open per host."""
+
+DEFAULT_VALIDATION_WINDOW = 100
+"""The default number of subjects whose results are validated together by `arpa.arpafy`."""
+
+DEFAULT_PRUNE_CACHE_SIZE = 100000
+"""The default maximum number of cached pruning results in `arpa.prune_candidates`."""
+
+BATCH_SEPARATOR = '\n.\n'
+"""The separator between texts when querying multiple texts at once with `arpa.Arpa.query_batch`."""
+
+LINE_FORMATS = ('nt', 'ntriples', 'nt11', 'nquads')
+"""The line-based RDF formats (rdflib format names) supported by `arpa.process_stream`."""
+
+MAX_LOG_LENGTH = 500
+"""
+The maximum length of the payloads (query texts, request data and results) in log messages.
+Longer payloads are truncated. Set to `None` to log the payloads in full.
+"""
+
 logger = logging.getLogger(__name__)
 
 # Hide requests INFO logging spam
 requests_logger = logging.getLogger('requests')
 requests_logger.setLevel(logging.WARNING)
 
+_WORD_RE = re.compile(r'\w+')
+
+_LOG_REPR = reprlib.Repr()
+_LOG_REPR.maxlevel = 3
+_LOG_REPR.maxdict = _LOG_REPR.maxlist = _LOG_REPR.maxset = _LOG_REPR.maxtuple = 4
+_LOG_REPR.maxstring = _LOG_REPR.maxother = 100
+
+_SMALL_LOG_VALUE = 50
+"""Containers with at most this many nested items are logged with `str`, which is faster for them."""
+
+
+def _is_small(value, limit=_SMALL_LOG_VALUE):
+    """Return whether `value` contains at most `limit` nested container items."""
+
+    stack = [value]
+    count = 0
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            value = value.values()
+        elif not isinstance(value, (list, tuple, set, frozenset)):
+            continue
+        count += len(value)
+        if count > limit:
+            return False
+        stack.extend(value)
+    return True
+
+
+class _Truncated:
+    """
+    Log message argument that formats `value` lazily, truncated to `arpa.MAX_LOG_LENGTH`
+    characters. The value is only converted to a string if the message is logged.
+    Large containers are abbreviated while formatting, so that the cost of a logged message
+    does not grow with the size of the results.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        if MAX_LOG_LENGTH is None:
+            return str(self.value)
+        if isinstance(self.value, str) or _is_small(self.value):
+            text = str(self.value)
+        else:
+            text = _LOG_REPR.repr(self.value)
+        if len(text) > MAX_LOG_LENGTH:
+            return '{}... ({} characters)'.format(text[:MAX_LOG_LENGTH], len(text))
+        return text
+
+
+def _has_validate_batch(validator):
+    """
+    Return `True` if `validator` implements `validate_batch`. The method is looked
+    up in the class of the validator, so that mocks and proxies do not qualify.
+    """
+
+    return callable(getattr(type(validator), 'validate_batch', None))
+
+
+def _normalize_words(text):
+    """
+    Return the words of `text` in lower case, separated and surrounded by single spaces.
+    """
+
+    return ' {} '.format(' '.join(_WORD_RE.findall(text.lower())))
+
 
 def _get_value(result):
     type_ = result.get('type', None)
@@ -119,461 +322,2773 @@ def _get_value(result):
     return value
 
 
-def map_results(results):
+class ResultMapper:
     """
-    Map general SPARQL results to the format ARPA returns.
-
-    Return the mapped results.
+    Incrementally map general SPARQL result bindings to the format ARPA returns.
 
-    `results` is the SPARQL result as a dict. Each row has to include an 'id' variable.
+    Each binding is handled in constant time, so bindings can be added as they are
+    received. See `arpa.map_results`.
     """
 
-    logger.debug('Mapping results {} to ARPA format'.format(results))
+    def __init__(self):
+        # Entries by id, in the order the ids were first seen
+        self._entries = {}
+        # The set of matches of each entry, for fast membership tests
+        self._matches = {}
 
-    res = []
-    for obj in results['results']['bindings']:
-        o_id = obj['id']['value']
+    def add(self, binding):
+        """
+        Add a single result row.
+
+        `binding` is a SPARQL JSON result binding (a dict). It has to include an 'id' variable.
+        """
+
+        o_id = binding['id']['value']
+        ngram = binding.get('ngram', {}).get('value', '')
 
-        idx = next((index for (index, d) in enumerate(res) if d['id'] == o_id), None)
-        if idx is None:
-            props = {key: [_get_value(value)] for key, value in obj.items()}
-            o = {
+        o = self._entries.get(o_id)
+        if o is None:
+            props = {key: [_get_value(value)] for key, value in binding.items()}
+            self._entries[o_id] = {
                 'id': o_id,
-                'label': obj.get('label', {}).get('value', ''),
-                'matches': [obj.get('ngram', {}).get('value', '')],
+                'label': binding.get('label', {}).get('value', ''),
+                'matches': [ngram],
                 'properties': props
             }
-            res.append(o)
-        else:
-            o = res[idx]
-            ngram = obj.get('ngram', {}).get('value', '')
-            if ngram not in o['matches']:
-                o['matches'].append(ngram)
-            for k, v in obj.items():
-                p = o.get('properties').get(k, None)
-                if p:
-                    p.append(_get_value(v))
-                else:
-                    o['properties'][k] = [_get_value(v)]
+            self._matches[o_id] = {ngram}
+            return
 
-    res = {'results': res}
+        matches = self._matches[o_id]
+        if ngram not in matches:
+            matches.add(ngram)
+            o['matches'].append(ngram)
+        props = o['properties']
+        for k, v in binding.items():
+            p = props.get(k)
+            if p:
+                p.append(_get_value(v))
+            else:
+                props[k] = [_get_value(v)]
 
-    logger.debug('Mapped to: {}'.format(res))
+    def add_all(self, bindings):
+        """Add each result row in the iterable `bindings`."""
 
-    return res
+        for binding in bindings:
+            self.add(binding)
+
+    def get_results(self):
+        """Return the mapped results."""
+
+        return {'results': list(self._entries.values())}
 
 
-def post(url, data, retries=0, wait=1):
+def map_results(results):
     """
-    Send a post request to the given URL with the given data, expecting a JSON response.
-    Throws a HTTPError if the request fails (after retries, if any) or if JSON
-    parsing fails.
+    Map general SPARQL results to the format ARPA returns.
 
-    `url` is the URL to send the request to.
+    Return the mapped results.
 
-    `data` is a dict containing the data to send to the URL.
+    `results` is the SPARQL result as a dict, or an iterable of the result bindings.
+    Each row has to include an 'id' variable.
+    """
 
-    `retries` is the number of retries to attempt if the request fails. Optional.
+    logger.debug('Mapping results %s to ARPA format', _Truncated(results))
 
-    `wait` is the number of seconds to wait between retries. Optional, default is 1 second.
-    Has no effect if `retries` is not set.
+    if isinstance(results, dict):
+        results = results['results']['bindings']
+
+    mapper = ResultMapper()
+    mapper.add_all(results)
+    res = mapper.get_results()
+
+    logger.debug('Mapped to: %s', _Truncated(res))
+
+    return res
+
+
+_perf_counter = time.perf_counter
+
+
+class Stats:
+    """
+    Thread-safe accumulator of counts and durations, e.g. the number of requests
+    sent by `arpa.post` and the time spent in each phase of `arpa.process`.
     """
 
-    if retries < 0:
-        raise ValueError('Invalid amount of retries: {}'.format(retries))
-    if wait < 0:
-        raise ValueError('Invalid retry wait time: {}'.format(wait))
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
 
-    tries = retries + 1
+    def add(self, key, value=1):
+        """Add `value` to the value of `key`."""
 
-    while tries:
-        logger.debug('Sending request to {} with data: {}'.format(url, data))
-        res = requests.post(url, data)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, key):
+        """Context manager that adds the seconds spent in it to the value of `key`."""
+
+        start = _perf_counter()
         try:
-            res.raise_for_status()
-            res = res.json()
-        except (HTTPError, ValueError) as e:
-            tries -= 1
-            if tries:
-                logger.warning('Received error ({}) from {} with request data: {}.'
-                        .format(e, url, data))
-                logger.warning('Waiting {} seconds before retrying'.format(wait))
-                time.sleep(wait)
-                continue
-            elif retries:
-                logger.warning('Error {}, out of retries.'.format(e))
-            raise HTTPError('Error ({}) from {} with request data: {}.'.format(e, url, data))
-        else:
-            # Success
-            logger.debug('Success, received: {}'.format(res))
-            return res
+            yield
+        finally:
+            self.add(key, _perf_counter() - start)
 
+    def as_dict(self):
+        """Return the current values as a dict."""
 
-class Arpa:
-    """Class representing the ARPA service"""
+        with self._lock:
+            return dict(self._values)
 
-    def __init__(self, url, remove_duplicates=False, min_ngram_length=1, ignore=None,
-            retries=0, wait_between_tries=1):
-        """
-        Initialize the Arpa service object.
 
-        `url` is the ARPA service url.
+def _timer(stats, key):
+    """Return `stats.timer(key)`, or a no-op context manager if `stats` is `None`."""
 
-        If `remove_duplicates` is `True`, choose only one subject out of all the
-        matched subjects that have the same label (arbitrarily).
-        If, instead, the value is a list or a tuple, assume that it represents
-        a list of class names and prefer those classes when choosing
-        the subject. The ARPA results must include a property (`arpa.TYPE_PROP`)
-        that has the class of the match as the value. Optional.
+    return stats.timer(key) if stats is not None else nullcontext()
 
-        `min_ngram_length` is the minimum ngram match length that will be included when
-        returning the query results. Optional.
 
-        `ignore` is a list of matches that should be removed from the results (case insensitive).
-        Optional.
+def make_session(pool_connections=DEFAULT_POOL_SIZE, pool_maxsize=DEFAULT_POOL_SIZE,
+        pool_block=False, keep_alive=True):
+    """
+    Create a `requests.Session` with a connection pool for use with `arpa.post`.
 
-        `retries` is the number of retries per query. Optional.
+    `pool_connections` is the number of hosts to keep connection pools for.
 
-        `wait_between_tries` is the amount of times in seconds to wait between retries.
-        Optional, default is 1 second. Has no effect if `retries` is not set.
-        """
+    `pool_maxsize` is the maximum number of connections kept open per host.
 
-        logger.debug('Initialize Arpa instance')
+    If `pool_block` is set, never open more than `pool_maxsize` connections to
+    a host at the same time, but wait for a connection to become available instead.
 
-        if retries < 0:
-            raise ValueError('Number of retries has to be a non-negative number, got {}'
-                    .format(retries))
-        if wait_between_tries < 0:
-            raise ValueError('Retry wait time has to be a non-negative number, got {}'
-                    .format(wait_between_tries))
+    If `keep_alive` is not set, close each connection after the request.
+    """
 
-        self._retries = retries
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+            pool_block=pool_block)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
 
-        self._url = url
-        self._ignore = [s.lower() for s in ignore or []]
-        self._min_ngram_length = min_ngram_length
-        self._wait = wait_between_tries
+    return session
 
-        if type(remove_duplicates) == bool:
-            self._no_duplicates = remove_duplicates
-        else:
-            self._no_duplicates = tuple('<{}>'.format(x) for x in remove_duplicates)
 
-        logger.debug('ARPA ignore set to {}'.format(self._ignore))
-        logger.debug('ARPA url set to {}'.format(self._url))
-        logger.debug('ARPA min_ngram_length set to {}'.format(self._min_ngram_length))
-        logger.debug('ARPA no_duplicates set to {}'.format(self._no_duplicates))
-        logger.debug('ARPA retries set to {}'.format(self._retries))
+RETRYABLE_STATUS_CODES = frozenset((408, 425, 429, 500, 502, 503, 504))
+"""
+The HTTP status codes of the error responses that are retried by `arpa.post`.
+Requests that receive any other error status fail immediately.
+"""
 
-    def _remove_duplicates(self, entries):
-        """
-        Remove duplicates from the entries.
+_TRIAL_POLL_INTERVAL = 0.1
 
-        A 'duplicate' is an entry with the same `LABEL_PROP` property value.
 
-        If `self._no_duplicates == True`, choose the subject to keep any which way.
+class CircuitBreaker:
+    """
+    Circuit breaker that pauses the requests to an endpoint after repeated failures.
 
-        If `self._no_duplicates` is a tuple (or a list), choose the kept subject
-        by comparing its type to the types contained in the tuple. The lower the
-        index of the type in the tuple, the higher the priority.
+    After `failure_threshold` consecutive failed requests the circuit opens, and
+    `arpa.post` holds all requests until `reset_timeout` seconds have passed.
+    Then a single trial request is let through. If it succeeds, the circuit closes,
+    and if it fails, the circuit opens again.
 
-        `entries` is the ARPA service results as a JSON object.
+    The breaker is thread-safe, and should be shared by all the threads
+    (and `arpa.Arpa` instances) that query the same endpoint.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
         """
+        Initialize the circuit breaker.
 
-        res = entries
-        if self._no_duplicates is True:
-            labels = set()
-            add = labels.add
-            res = [x for x in res if not (x[LABEL_PROP] in labels
-                # If the label is not in the labels set, add it to the set.
-                # This works because set.add() returns None.
-                or add(x[LABEL_PROP]))]
+        `failure_threshold` is the number of consecutive failures after which the circuit opens.
+        Default is 5.
 
-        elif self._no_duplicates:
-            # self._no_duplicates is a tuple - prioritize types defined in it
-            items = {}
-            for x in res:
-                x_label = x[LABEL_PROP].lower()
-                # Get the types of the latest most preferrable entry that
-                # had the same label as this one
-                prev_match_types = items.get(x_label, {}).get('properties', {}).get(TYPE_PROP, [])
-                # Get matches from the preferred types for the previously selected entry
-                prev_pref = set(prev_match_types).intersection(set(self._no_duplicates))
-                try:
-                    # Find the priority of the previously selected entry
-                    prev_idx = min([self._no_duplicates.index(t) for t in prev_pref])
-                except ValueError:
-                    # No previous entry or previous entry doesn't have a preferred type
-                    prev_idx = float('inf')
-                # Get matches in the preferred types for this entry
-                pref = set(x['properties'][TYPE_PROP]).intersection(self._no_duplicates)
-                try:
-                    idx = min([self._no_duplicates.index(t) for t in pref])
-                except ValueError:
-                    # This one is not of a preferred type
-                    idx = float('inf')
+        `reset_timeout` is the number of seconds the circuit is kept open. Default is 30.
+        """
 
-                if (not prev_match_types) or idx < prev_idx:
-                    # There is no previous entry with this label or
-                    # the current match has a higher priority preferred type
-                    items[x_label] = x
+        if failure_threshold < 1:
+            raise ValueError('Circuit breaker failure threshold has to be a positive number, got {}'
+                    .format(failure_threshold))
+        if reset_timeout < 0:
+            raise ValueError('Circuit breaker timeout has to be a non-negative number, got {}'
+                    .format(reset_timeout))
 
-            res = [x for x in res if x in items.values()]
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.times_opened = 0
 
-        return res
+        self._open_until = None
+        self._trial = False
+        self._lock = threading.Lock()
 
-    def _filter_results(self, results, get_len, get_label, skip_remove_duplicates=False):
+    @property
+    def is_open(self):
+        """`True` if the circuit is open (or a trial request is pending)."""
+
+        return self._open_until is not None
+
+    def get_delay(self):
         """
-        Internal filter function used by `arpa.Arpa._filter`.
+        Return the number of seconds to wait before sending a request, or 0
+        if the request can be sent now.
         """
 
-        # Filter ignored results
-        if self._ignore:
-            results = [x for x in results if get_label(x) not in self._ignore]
+        with self._lock:
+            if self._open_until is None:
+                return 0
+            delay = self._open_until - time.monotonic()
+            if delay > 0:
+                return delay
+            if self._trial:
+                # Wait for the result of the trial request
+                return _TRIAL_POLL_INTERVAL
+            self._trial = True
+            return 0
+
+    def wait(self):
+        """Block until a request can be sent."""
+
+        delay = self.get_delay()
+        while delay:
+            time.sleep(delay)
+            delay = self.get_delay()
+
+    async def wait_async(self):
+        """Coroutine version of `arpa.CircuitBreaker.wait`."""
+
+        delay = self.get_delay()
+        while delay:
+            await asyncio.sleep(delay)
+            delay = self.get_delay()
+
+    def record_success(self):
+        """Record a request that reached the endpoint. Closes the circuit."""
+
+        with self._lock:
+            if self._open_until is not None:
+                logger.info('Circuit closed, resuming requests')
+            self.failures = 0
+            self._open_until = None
+            self._trial = False
+
+    def cancel_trial(self):
+        """
+        Let another trial request through if the trial request was interrupted
+        before it got a result. The circuit stays open.
+        """
 
-        # Filter by minimum ngram length
-        if self._min_ngram_length > 1:
-            results = [x for x in results if get_len(x) >= self._min_ngram_length]
+        with self._lock:
+            self._trial = False
 
-        # Remove duplicates unless requested to skip
-        if skip_remove_duplicates:
-            return results
-        return self._remove_duplicates(results)
+    def record_failure(self):
+        """Record a failed request. Opens the circuit if the threshold is reached."""
 
-    def _filter(self, results, candidates=False):
-        """
-        Filter matches based on `self._ignore` and remove matches that are
-        for ngrams with length less than `self.min_ngram_length`.
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self._open_until is not None or self.failures >= self.failure_threshold:
+                self._open_until = time.monotonic() + self.reset_timeout
+                self.times_opened += 1
+                logger.warning('Circuit opened after {} consecutive failures, pausing requests'
+                        ' for {} seconds'.format(self.failures, self.reset_timeout))
 
-        Return the response with the ignored matches removed.
 
-        `results` is the parsed ARPA service results.
+_THROTTLE_POLL_INTERVAL = 0.01
+_BASELINE_DRIFT = 0.01
+_LATENCY_SMOOTHING = 0.2
 
-        `candidates` is whether or not the results contain just the candidates.
-        """
 
-        if candidates:
-            logger.debug('Filtering candidates')
-            get_len = lambda x: len(x.split())
-            get_label = lambda x: x.lower()
-            # No use in removing literal duplicates
-            skip_remove_duplicates = True
-        else:
-            logger.debug('Filtering results')
-            get_len = lambda x: len(x['properties']['ngram'][0].split())
-            get_label = lambda x: x[LABEL_PROP].lower()
-            skip_remove_duplicates = False
+class Throttle:
+    """
+    Adaptive concurrency limit and rate limit for the requests sent by `arpa.post`.
 
-        return self._filter_results(results, get_len, get_label, skip_remove_duplicates)
+    The concurrency limit is adjusted with additive increase and multiplicative
+    decrease (AIMD): each successful request raises the limit so that it grows by
+    one per round of requests, and a failed (retryable) or slow request multiplies
+    it by `decrease_factor`. The limit is decreased at most once per round, i.e.
+    failures of requests sent before the last decrease are ignored.
 
-    def query(self, text, candidates=False):
-        """
-        Query the ARPA service and return the response results as JSON
+    A request is slow if the smoothed latency exceeds the baseline latency by the
+    factor `latency_tolerance`. The baseline is the lowest latency seen, which
+    slowly drifts upwards so that it adapts to lasting changes.
 
-        Results will be filtered if a filter was specified at init.
+    The rate limit is a token bucket of `burst` requests refilled at `rate`
+    requests per second.
 
-        `text` is the text used in the query.
+    The throttle is thread-safe, and should be shared by all the threads
+    (and `arpa.Arpa` instances) that query the same endpoint.
+    """
 
-        If `candidates` is set, query for candidates only.
+    def __init__(self, max_concurrency=None, min_concurrency=1, initial_concurrency=None,
+            rate=None, burst=1, latency_tolerance=2, decrease_factor=0.5):
         """
+        Initialize the throttle.
 
-        logger.debug('Query ARPA at {} with text {}'.format(self._url, text))
-
-        if not text:
-            raise ValueError('Empty ARPA query text')
+        `max_concurrency` is the upper bound of the concurrency limit. Optional, by default
+        the concurrency is not limited.
 
-        url = self._url + ('?cgen' if candidates else '')
+        `min_concurrency` is the lower bound of the concurrency limit. Default is 1.
 
-        # Query the ARPA service with the text
-        data = {'text': text}
+        `initial_concurrency` is the initial concurrency limit. Default is `min_concurrency`.
 
-        res = post(url, data, retries=self._retries, wait=self._wait)
+        `rate` is the maximum number of requests per second. Optional, by default the
+        rate is not limited.
 
-        return self._filter(res.get('results', []), candidates)
+        `burst` is the number of requests that can be sent at once without waiting
+        for the rate limit. Default is 1.
 
-    def extract_uris(self, results):
-        """
-        Get the URIs from results.
+        `latency_tolerance` is the factor by which the latency can exceed the baseline
+        before the concurrency limit is decreased. `None` disables the latency check.
+        Default is 2.
 
-        `results` is the results as returned by `arpa.query`.
+        `decrease_factor` is the factor (0-1) by which the concurrency limit is multiplied
+        when it is decreased. Default is 0.5.
         """
-        return [URIRef(x['id']) for x in results]
 
-    def get_distinct_mentions(self, results):
+        if max_concurrency is not None and not 1 <= min_concurrency <= max_concurrency:
+            raise ValueError('Invalid concurrency bounds: {}-{}'
+                    .format(min_concurrency, max_concurrency))
+        if rate is not None and rate <= 0:
+            raise ValueError('Rate limit has to be a positive number, got {}'.format(rate))
+        if burst < 1:
+            raise ValueError('Rate limit burst has to be at least 1, got {}'.format(burst))
+        if not 0 < decrease_factor < 1:
+            raise ValueError('Invalid decrease factor: {}'.format(decrease_factor))
+
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+
+        self.limit = None
+        if max_concurrency is not None:
+            self.limit = float(min(max(initial_concurrency or min_concurrency, min_concurrency),
+                max_concurrency))
+        self.decreases = 0
+
+        self._in_flight = 0
+        self._tokens = burst
+        self._refilled = time.monotonic()
+        self._baseline = None
+        self._latency = None
+        self._last_decrease = float('-inf')
+        self._cond = threading.Condition()
+
+    def _try_acquire(self):
         """
-        Get distinct mentions (i.e. matches) that yielded results.
+        Reserve a slot for a request if possible. Call with the lock held.
 
-        `results` is the results as returned by `arpa.query`.
+        Return a tuple of the token and `None` if the slot was reserved.
+        Otherwise return `None` and the number of seconds to wait before trying
+        again, or `None` if a request has to finish first.
         """
-        return {m for ml in [p['matches'] for p in results] for m in ml}
 
-    def get_uri_matches(self, text, *args, validator=None, **kwargs):
+        now = time.monotonic()
+        if self.limit is not None and self._in_flight >= int(self.limit):
+            return None, None
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+            self._refilled = now
+            if self._tokens < 1:
+                return None, (1 - self._tokens) / self.rate
+            self._tokens -= 1
+        self._in_flight += 1
+        return now, None
+
+    def acquire(self):
         """
-        Query ARPA and return a dict with a list of uris of resources that match the text.
-
-        Return a dict where 'results' has the list of uris, 'mentions' has the mentions
-        that yielded results, and 'pre_validation_mentions' has mentions that yielded
-        results before running the `validator`.
-
-        `text` is the text to use in the query.
-
-        `validator` is an object that implements a `validate` method that takes
-        the results and `text` (and any other parameters passed to this method)
-        as parameters, and returns a subset of the results.
+        Block until a request can be sent. Return a token that has to be passed
+        to `arpa.Throttle.release` when the request is done.
         """
 
-        logger.info('Getting URI matches: {}'.format(text))
+        with self._cond:
+            while True:
+                token, delay = self._try_acquire()
+                if token is not None:
+                    return token
+                self._cond.wait(delay)
 
-        results = self.query(text)
+    async def acquire_async(self):
+        """Coroutine version of `arpa.Throttle.acquire`."""
 
-        pre_validation_mentions = set()
-        post_validation_mentions = set()
+        while True:
+            with self._cond:
+                token, delay = self._try_acquire()
+            if token is not None:
+                return token
+            await asyncio.sleep(delay or _THROTTLE_POLL_INTERVAL)
 
-        if validator and results:
-            logger.debug('Validating results: {}'.format(results))
-            pre_validation_mentions = self.get_distinct_mentions(results)
-            logger.info('Distinct mentions before validation: {} ({})'.format(len(pre_validation_mentions), pre_validation_mentions))
-            results = validator.validate(results, text, *args, **kwargs)
+    def _is_slow(self, latency):
+        """Update the latency statistics with a successful request, and return `True` if it was slow."""
 
-        if results:
-            logger.info('Found matches {}'.format(results))
-            post_validation_mentions = self.get_distinct_mentions(results)
-            logger.info('Distinct mentions: {} ({})'.format(len(post_validation_mentions), post_validation_mentions))
-            results = self.extract_uris(results)
+        if self._baseline is None:
+            self._baseline = self._latency = latency
         else:
-            logger.info('No matches found'.format(text))
-
-        return {
-            'results': results,
-            'mentions': post_validation_mentions,
-            'pre_validation_mentions': pre_validation_mentions
-        }
+            self._baseline = min(latency, self._baseline * (1 + _BASELINE_DRIFT))
+            self._latency += _LATENCY_SMOOTHING * (latency - self._latency)
+        return (self.latency_tolerance is not None
+                and self._latency > self.latency_tolerance * self._baseline)
 
-    def get_candidates(self, text, *args, **kwargs):
+    def release(self, token, success=True):
         """
-        Get the candidates from `text` that would be used by the ARPA service
-        to query for matches.
+        Release the slot of a finished request, and adjust the concurrency limit.
 
-        A dict is returned for compatibility with `arpa.get_uri_matches`.
+        `token` is the token returned by `arpa.Throttle.acquire`.
 
-        Return a dict where 'results' has the candidates as a list of rdflib Literals.
+        `success` is `False` if the request failed in a way that indicates overload.
         """
 
-        if not text:
-            raise ValueError('Empty ARPA query text')
+        now = time.monotonic()
+        with self._cond:
+            self._in_flight -= 1
+            if self.limit is not None:
+                if not success or self._is_slow(now - token):
+                    if token >= self._last_decrease:
+                        self._last_decrease = now
+                        self.decreases += 1
+                        self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+                        logger.info('Decreased concurrency limit to %s (%s)', int(self.limit),
+                                'slow response' if success else 'error')
+                elif self.limit < self.max_concurrency:
+                    previous = int(self.limit)
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                    if int(self.limit) > previous:
+                        logger.debug('Increased concurrency limit to %s', int(self.limit))
+            self._cond.notify_all()
+
+    def get_limits(self):
+        """
+        Return a dict with the current concurrency limit (concurrency_limit)
+        and the rate limit (rate_limit), if set.
+        """
 
-        res = self.query(text, candidates=True)
+        limits = {}
+        if self.limit is not None:
+            limits['concurrency_limit'] = int(self.limit)
+        if self.rate is not None:
+            limits['rate_limit'] = self.rate
+        return limits
 
-        logger.debug('Received candidates: {}'.format(res))
 
-        result = {'results': [Literal(candidate) for candidate in res]}
+def _check_retry_params(retries, wait, backoff, max_wait, jitter):
+    """Raise a ValueError if the retry parameters of `arpa.post` are invalid."""
 
-        return result
+    if retries < 0:
+        raise ValueError('Invalid amount of retries: {}'.format(retries))
+    if wait < 0:
+        raise ValueError('Invalid retry wait time: {}'.format(wait))
+    if backoff < 1:
+        raise ValueError('Invalid retry backoff factor: {}'.format(backoff))
+    if max_wait is not None and max_wait < 0:
+        raise ValueError('Invalid maximum retry wait time: {}'.format(max_wait))
+    if not 0 <= jitter <= 1:
+        raise ValueError('Invalid retry jitter: {}'.format(jitter))
 
 
-class ArpaMimic(Arpa):
+def _parse_retry_after(value):
     """
-    Class that behaves like `arpa.Arpa` except that it queries a SPARQL endpoint
-    instead of an ARPA service.
+    Return the number of seconds to wait given the value of a Retry-After header
+    (seconds or a HTTP date), or `None` if the value is missing or invalid.
+    """
+
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def _get_retry_delay(retry, wait, backoff, max_wait, jitter, retry_after=None):
+    """
+    Return the number of seconds to wait before the retry number `retry` (counting from 0).
+    See `arpa.post` for the other parameters.
+    """
+
+    delay = wait * backoff ** retry
+    if jitter:
+        delay -= random.uniform(0, jitter * delay)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    if max_wait is not None:
+        delay = min(delay, max_wait)
+    return delay
+
+
+def _handle_error(error, retryable, retry, url, data, retries, wait, backoff, max_wait, jitter,
+        retry_after, circuit_breaker):
+    """
+    Record a failed request in `circuit_breaker`, and return the number of seconds
+    to wait before retrying. Raise a HTTPError if the request should not be retried.
+    See `arpa.post`.
+    """
+
+    if circuit_breaker is not None:
+        if retryable:
+            circuit_breaker.record_failure()
+        else:
+            # The endpoint is up, the request itself is invalid
+            circuit_breaker.record_success()
+
+    if not retryable:
+        logger.warning('Error {}, not retrying.'.format(error))
+    elif retry < retries:
+        delay = _get_retry_delay(retry, wait, backoff, max_wait, jitter, retry_after)
+        logger.warning('Received error (%s) from %s with request data: %s.',
+                error, url, _Truncated(data))
+        logger.warning('Waiting %s seconds before retrying', delay)
+        return delay
+    elif retries:
+        logger.warning('Error {}, out of retries.'.format(error))
+
+    raise HTTPError('Error ({}) from {} with request data: {}.'.format(error, url, data))
+
+
+def _record_escaped_error(circuit_breaker, error):
+    """
+    Record an error that is raised from `arpa.post` without retrying in `circuit_breaker`,
+    so that the breaker is not left waiting for the result of a trial request.
+    Interruptions (e.g. KeyboardInterrupt or a cancelled task) are not counted as failures.
+    """
+
+    if circuit_breaker is None:
+        return
+    if isinstance(error, Exception):
+        circuit_breaker.record_failure()
+    else:
+        circuit_breaker.cancel_trial()
+
+
+def post(url, data, retries=0, wait=1, session=None, backoff=1, max_wait=None, jitter=0,
+        circuit_breaker=None, throttle=None, stats=None):
+    """
+    Send a post request to the given URL with the given data, expecting a JSON response.
+    Throws a HTTPError if the request fails (after retries, if any) or if JSON
+    parsing fails.
+
+    Connection errors, timeouts, invalid JSON and the error statuses in
+    `arpa.RETRYABLE_STATUS_CODES` are retried. Other error statuses fail immediately.
+
+    `url` is the URL to send the request to.
+
+    `data` is a dict containing the data to send to the URL.
+
+    `retries` is the number of retries to attempt if the request fails. Optional.
+
+    `wait` is the number of seconds to wait before the first retry. Optional, default is 1 second.
+    Has no effect if `retries` is not set.
+
+    `session` is the `requests.Session` used for sending the request (see `arpa.make_session`).
+    Optional, by default a new connection is opened for the request.
+
+    `backoff` is the factor by which the wait time is multiplied after each retry.
+    Optional, default is 1 (constant wait time).
+
+    `max_wait` is the maximum number of seconds to wait between retries. Optional.
+
+    `jitter` is the fraction (0-1) of the wait time that is randomly subtracted
+    from it, so that concurrent clients do not retry at the same time. Optional, default is 0.
+
+    If the response has a Retry-After header, wait at least the time it gives
+    (but at most `max_wait`).
+
+    `circuit_breaker` is an `arpa.CircuitBreaker` that is shared by the requests to
+    the same endpoint. Optional.
+
+    `throttle` is an `arpa.Throttle` that limits the concurrency and rate of the requests
+    to the same endpoint. Each try is a separate request for the throttle. Optional.
+
+    `stats` is an `arpa.Stats` where the number of requests (requests), retries (retries),
+    bytes sent and received (bytes_sent, bytes_received), and the seconds spent waiting
+    for the responses (http_time) and decoding them (decode_time) are added. Optional.
+    """
+
+    _check_retry_params(retries, wait, backoff, max_wait, jitter)
+
+    retry = 0
+
+    while True:
+        if circuit_breaker is not None:
+            circuit_breaker.wait()
+
+        token = throttle.acquire() if throttle is not None else None
+
+        logger.debug('Sending request to %s with data: %s', url, _Truncated(data))
+
+        if stats is not None:
+            stats.add('requests')
+            stats.add('bytes_sent', len(urlencode(data or {}, doseq=True).encode()))
+
+        error = None
+        retryable = True
+        retry_after = None
+        try:
+            with _timer(stats, 'http_time'):
+                res = (session or requests).post(url, data)
+            if stats is not None:
+                stats.add('bytes_received', len(res.content))
+            res.raise_for_status()
+            with _timer(stats, 'decode_time'):
+                res = res.json()
+        except HTTPError as e:
+            error = e
+            retryable = res.status_code in RETRYABLE_STATUS_CODES
+            retry_after = _parse_retry_after(res.headers.get('Retry-After'))
+        except (requests.ConnectionError, requests.Timeout, ValueError) as e:
+            error = e
+        except BaseException as e:
+            # Not retried, but a pending trial request of the breaker has to be resolved
+            error = e
+            _record_escaped_error(circuit_breaker, e)
+            raise
+        finally:
+            if throttle is not None:
+                throttle.release(token, error is None or not retryable)
+
+        if error is None:
+            # Success
+            if circuit_breaker is not None:
+                circuit_breaker.record_success()
+            logger.debug('Success, received: %s', _Truncated(res))
+            return res
+
+        delay = _handle_error(error, retryable, retry, url, data, retries, wait, backoff,
+                max_wait, jitter, retry_after, circuit_breaker)
+        time.sleep(delay)
+        retry += 1
+        if stats is not None:
+            stats.add('retries')
+
+
+async def post_async(session, url, data, retries=0, wait=1, backoff=1, max_wait=None,
+        jitter=0, circuit_breaker=None, throttle=None, stats=None):
+    """
+    Coroutine version of `arpa.post`.
+
+    Send a post request to the given URL with the given data, expecting a JSON response.
+    Throws a HTTPError if the request fails (after retries, if any) or if JSON
+    parsing fails.
+
+    `session` is the `aiohttp.ClientSession` used for sending the request.
+
+    For the other parameters, see `arpa.post`.
+    """
+
+    _check_retry_params(retries, wait, backoff, max_wait, jitter)
+
+    import aiohttp
+
+    retry = 0
+
+    while True:
+        if circuit_breaker is not None:
+            await circuit_breaker.wait_async()
+
+        token = await throttle.acquire_async() if throttle is not None else None
+
+        logger.debug('Sending request to %s with data: %s', url, _Truncated(data))
+
+        if stats is not None:
+            stats.add('requests')
+            stats.add('bytes_sent', len(urlencode(data or {}, doseq=True).encode()))
+
+        error = None
+        retryable = True
+        retry_after = None
+        try:
+            with _timer(stats, 'http_time'):
+                async with session.post(url, data=data) as res:
+                    res.raise_for_status()
+                    body = await res.read()
+            if stats is not None:
+                stats.add('bytes_received', len(body))
+            if not body.strip():
+                raise ValueError('Empty response')
+            with _timer(stats, 'decode_time'):
+                res = json.loads(body)
+        except aiohttp.ClientResponseError as e:
+            error = e
+            retryable = e.status in RETRYABLE_STATUS_CODES
+            retry_after = _parse_retry_after((e.headers or {}).get('Retry-After'))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            error = e
+        except BaseException as e:
+            error = e
+            _record_escaped_error(circuit_breaker, e)
+            raise
+        finally:
+            if throttle is not None:
+                throttle.release(token, error is None or not retryable)
+
+        if error is None:
+            # Success
+            if circuit_breaker is not None:
+                circuit_breaker.record_success()
+            logger.debug('Success, received: %s', _Truncated(res))
+            return res
+
+        delay = _handle_error(error, retryable, retry, url, data, retries, wait, backoff,
+                max_wait, jitter, retry_after, circuit_breaker)
+        await asyncio.sleep(delay)
+        retry += 1
+        if stats is not None:
+            stats.add('retries')
+
+
+class QueryCache:
+    """
+    Persistent SQLite-backed cache for raw query responses.
+
+    The responses are stored as returned by the service (before any filtering),
+    so changing the filtering options of `arpa.Arpa` does not invalidate the cache.
+    The cache key consists of the URL and the data sent to it, i.e. the query text,
+    the candidates flag (`?cgen` in the URL) and, for `arpa.ArpaMimic`, the query
+    that was built from the query template.
+
+    The cache can be shared by multiple `arpa.Arpa` instances and threads.
+    """
+
+    def __init__(self, path, max_entries=None, ttl=None):
+        """
+        Initialize the cache.
+
+        `path` is the path of the SQLite database file. It is created if it does not exist.
+        Use `':memory:'` for a non-persistent cache.
+
+        `max_entries` is the maximum number of responses stored. The least recently
+        used responses are evicted when the cache is full. Optional, by default
+        the size of the cache is not limited.
+
+        `ttl` is the number of seconds after which a stored response expires. Optional,
+        by default the responses do not expire.
+        """
+
+        if max_entries is not None and max_entries < 1:
+            raise ValueError('Maximum cache size has to be a positive number, got {}'
+                    .format(max_entries))
+        if ttl is not None and ttl <= 0:
+            raise ValueError('Cache TTL has to be a positive number, got {}'.format(ttl))
+
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._connect()
+
+        logger.debug('Query cache {} opened with {} entries'.format(self.path, self._size))
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, '
+                'response TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+        self._conn.commit()
+        self._size = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _key(url, data):
+        return hashlib.sha256(json.dumps([url, data], sort_keys=True).encode()).hexdigest()
+
+    def get(self, url, data):
+        """
+        Return the cached response for the request, or `None` if it is not cached.
+
+        `url` and `data` are the URL and the data of the request, see `arpa.post`.
+        """
+
+        key = self._key(url, data)
+        now = time.time()
+
+        with self._lock:
+            row = self._conn.execute('SELECT response, created FROM cache WHERE key = ?',
+                    (key,)).fetchone()
+            if row and self.ttl is not None and now - row[1] > self.ttl:
+                # Expired
+                self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                self._conn.commit()
+                self._size -= 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def put(self, url, data, response):
+        """
+        Store the response of the request in the cache.
+
+        `url` and `data` are the URL and the data of the request, see `arpa.post`.
+
+        `response` is the parsed JSON response.
+        """
+
+        key = self._key(url, data)
+        now = time.time()
+        response = json.dumps(response)
+
+        with self._lock:
+            updated = self._conn.execute('UPDATE cache SET response = ?, created = ?, '
+                    'accessed = ? WHERE key = ?', (response, now, now, key)).rowcount
+            if not updated:
+                self._conn.execute('INSERT INTO cache VALUES (?, ?, ?, ?)',
+                        (key, response, now, now))
+                self._size += 1
+                if self.max_entries is not None and self._size > self.max_entries:
+                    # Evict the least recently used entries
+                    self._conn.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache '
+                            'ORDER BY accessed LIMIT ?)', (self._size - self.max_entries,))
+                    self._size = self.max_entries
+            self._conn.commit()
+
+    def close(self):
+        """Close the database connection."""
+
+        with self._lock:
+            self._conn.close()
+
+
+def _dump_result_dict(result_dict):
+    """
+    Return the result dict (see `arpa.Arpa.get_uri_matches`) as a JSON-serializable dict
+    with the results in N-Triples syntax.
+    """
+
+    entry = {'results': [_nt_term(r) for r in result_dict['results']]}
+    for key in ('mentions', 'pre_validation_mentions'):
+        if key in result_dict:
+            entry[key] = sorted(result_dict[key])
+    return entry
+
+
+def _load_result_dict(entry):
+    """Return the result dict of an entry dumped with `arpa._dump_result_dict`."""
+
+    res = {'results': [from_n3(r) for r in entry['results']]}
+    for key in ('mentions', 'pre_validation_mentions'):
+        if key in entry:
+            res[key] = set(entry[key])
+    return res
+
+
+class Checkpoint:
+    """
+    Append-only journal of the results of `arpa.arpafy`, for resuming an interrupted run.
+
+    Each (subject, source value) pair that was queried successfully is written to the
+    journal file as a JSON line along with its results. When resuming, the journaled
+    pairs are not queried again, and their results are added to the output as is.
+    Failed queries are not journaled, so they are retried when resuming.
+
+    Blank node subjects get new labels when a graph is parsed, so they can not be
+    resumed from a journal written by a previous process, unless the input is
+    streamed (see `arpa.process_stream`).
+    """
+
+    def __init__(self, path, resume=False, flush_interval=100):
+        """
+        Open the journal.
+
+        `path` is the path of the journal file.
+
+        If `resume` is set, read the entries of an existing journal file and append
+        new entries to it. Otherwise the file is truncated.
+
+        `flush_interval` is the number of entries after which the journal is flushed
+        to disk. Default is 100.
+        """
+
+        if flush_interval < 1:
+            raise ValueError('Checkpoint flush interval has to be a positive number, got {}'
+                    .format(flush_interval))
+
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self._entries = {}
+        self._unflushed = 0
+
+        partial_line = False
+        if resume and os.path.exists(path):
+            partial_line = self._load()
+
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        if partial_line:
+            # The previous run was interrupted in the middle of a write
+            self._file.write('\n')
+
+        logger.debug('Checkpoint {} opened with {} entries'.format(self.path, len(self)))
+
+    def _load(self):
+        """
+        Read the entries of the journal file.
+        Return `True` if the last line of the file is incomplete.
+        """
+
+        line = ''
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning('Skipping an invalid checkpoint entry: {}'.format(line[:100]))
+                    continue
+                self._entries[(entry.pop('s'), entry.pop('o'))] = entry
+
+        return bool(line) and not line.endswith('\n')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, pair):
+        s, o = pair
+        return (_nt_term(s), _nt_term(o)) in self._entries
+
+    def get(self, s, o):
+        """
+        Return the journaled result dict for subject `s` and source value `o`,
+        or `None` if the pair has not been journaled.
+        """
+
+        entry = self._entries.get((_nt_term(s), _nt_term(o)))
+        if entry is None:
+            return None
+        return _load_result_dict(entry)
+
+    def add(self, s, o, result_dict):
+        """
+        Journal the result dict (see `arpa.Arpa.get_uri_matches`) of subject `s`
+        and source value `o`.
+        """
+
+        entry = _dump_result_dict(result_dict)
+        key = (_nt_term(s), _nt_term(o))
+        self._entries[key] = entry
+        self._file.write(json.dumps(dict(entry, s=key[0], o=key[1])) + '\n')
+
+        self._unflushed += 1
+        if self._unflushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Flush the journal to disk."""
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unflushed = 0
+
+    def close(self):
+        """Flush and close the journal file."""
+
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Manifest:
+    """
+    Manifest of the linked subjects for incremental runs of `arpa.arpafy`.
+
+    The manifest maps each subject to a fingerprint (a hash of its preprocessed source
+    text and the configuration of the run) and the results of the subject. When the
+    subject has the same fingerprint in the next run, its previous results are added
+    to the output instead of querying it again, so only new and changed subjects are
+    queried. Subjects that no longer exist are dropped from the manifest.
+
+    The new manifest is written to a temporary file next to the previous one, and
+    replaces it when the manifest is closed. If the run fails (when used as a context
+    manager), the previous manifest is kept. Failed queries are not included,
+    so they are retried in the next run.
+
+    Blank node subjects get new labels when a graph is parsed, so they are queried
+    in every run, unless the input is streamed (see `arpa.process_stream`).
+    """
+
+    def __init__(self, path, config=None):
+        """
+        Open the manifest.
+
+        `path` is the path of the manifest file. The entries of an existing manifest
+        are read from it.
+
+        `config` is a JSON-serializable value describing the configuration that affects
+        the results, e.g. the ARPA service URL and the filtering options (see
+        `arpa.get_manifest_config`). If it changes, all subjects are queried again.
+        Changes to the validator are not detected, so the manifest should be removed
+        when the validation changes. Optional.
+        """
+
+        self.path = path
+        self._config = json.dumps(config, sort_keys=True, default=str)
+
+        self._entries = {}
+        if os.path.exists(path):
+            self._load()
+
+        self._tmp_path = path + '.tmp'
+        self._file = open(self._tmp_path, 'w', encoding='utf-8')
+
+        logger.debug('Manifest {} opened with {} entries'.format(self.path, len(self)))
+
+    def _load(self):
+        """Read the entries of the manifest file."""
+
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning('Skipping an invalid manifest entry: {}'.format(line[:100]))
+                    continue
+                self._entries[(entry.pop('s'), entry.pop('fingerprint'))] = entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_fingerprint(self, text):
+        """Return the fingerprint of the (preprocessed) source text `text`."""
+
+        data = '{}\n{}'.format(self._config, text).encode('utf-8')
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def get(self, s, fingerprint):
+        """
+        Return the result dict of subject `s` from the previous manifest,
+        or `None` if the subject is new or its fingerprint has changed.
+        """
+
+        entry = self._entries.get((_nt_term(s), fingerprint))
+        if entry is None:
+            return None
+        return _load_result_dict(entry)
+
+    def add(self, s, fingerprint, result_dict):
+        """
+        Add the result dict (see `arpa.Arpa.get_uri_matches`) of subject `s`
+        with the given fingerprint to the new manifest.
+        """
+
+        entry = _dump_result_dict(result_dict)
+        entry.update(s=_nt_term(s), fingerprint=fingerprint)
+        self._file.write(json.dumps(entry) + '\n')
+
+    def close(self, replace=True):
+        """
+        Close the new manifest and replace the previous manifest with it,
+        or discard it if `replace` is `False`.
+        """
+
+        if self._file.closed:
+            return
+        self._file.close()
+        if replace:
+            os.replace(self._tmp_path, self.path)
+        else:
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(replace=exc_type is None)
+
+
+class CandidateGenerator:
+    """
+    Generate the candidates (word n-grams) of texts in process, instead of querying
+    them from the ARPA service. See `arpa.Arpa`.
+    """
+
+    def __init__(self, min_length=1, max_length=None, normalize=None, tokenize=None):
+        """
+        Initialize the candidate generator.
+
+        `min_length` and `max_length` are the minimum and maximum number of words
+        in a candidate. Optional, all the n-grams of the text are generated by default.
+
+        `normalize` is a function that takes a candidate and returns its normalized form,
+        for example `str.lower` or a lemmatizer. It can also return a list of forms.
+        Optional.
+
+        `tokenize` is a function that splits a text into a list of words. Optional,
+        by default the words are the sequences of word characters in the text
+        (punctuation is dropped).
+        """
+
+        if min_length < 1:
+            raise ValueError('The minimum candidate length has to be at least 1, got {}'
+                    .format(min_length))
+        if max_length is not None and max_length < min_length:
+            raise ValueError('The maximum candidate length has to be at least the minimum length, '
+                    'got {}'.format(max_length))
+
+        self.min_length = min_length
+        self.max_length = max_length
+        self._normalize = normalize
+        self._tokenize = tokenize or _WORD_RE.findall
+
+    def get_ngrams(self, words):
+        """Yield the n-grams of the list `words`, by start position and length."""
+
+        n = len(words)
+        max_length = n if self.max_length is None else self.max_length
+        for i in range(n):
+            for j in range(i + self.min_length, min(n, i + max_length) + 1):
+                yield ' '.join(words[i:j])
+
+    def __call__(self, text):
+        """
+        Return the distinct candidates of `text` in the order of their first occurrence.
+        """
+
+        ngrams = self.get_ngrams(self._tokenize(text))
+        if self._normalize is None:
+            return list(dict.fromkeys(ngrams))
+
+        candidates = {}
+        for ngram in ngrams:
+            forms = self._normalize(ngram)
+            if isinstance(forms, str):
+                forms = (forms,)
+            for form in forms:
+                if form:
+                    candidates[form] = None
+        return list(candidates)
+
+
+class Arpa:
+    """Class representing the ARPA service"""
+
+    def __init__(self, url, remove_duplicates=False, min_ngram_length=1, ignore=None,
+            retries=0, wait_between_tries=1, pool_connections=DEFAULT_POOL_SIZE,
+            pool_maxsize=DEFAULT_POOL_SIZE, pool_block=False, keep_alive=True, cache=None,
+            max_batch_bytes=None, backoff=1, max_wait=None, jitter=0, circuit_breaker=None,
+            throttle=None, candidate_generator=None):
+        """
+        Initialize the Arpa service object.
+
+        `url` is the ARPA service url.
+
+        If `remove_duplicates` is `True`, choose only one subject out of all the
+        matched subjects that have the same label (arbitrarily).
+        If, instead, the value is a list or a tuple, assume that it represents
+        a list of class names and prefer those classes when choosing
+        the subject. The ARPA results must include a property (`arpa.TYPE_PROP`)
+        that has the class of the match as the value. Optional.
+
+        `min_ngram_length` is the minimum ngram match length that will be included when
+        returning the query results. Optional.
+
+        `ignore` is a list of matches that should be removed from the results (case insensitive).
+        Optional.
+
+        `retries` is the number of retries per query. Optional.
+
+        `wait_between_tries` is the amount of times in seconds to wait between retries.
+        Optional, default is 1 second. Has no effect if `retries` is not set.
+
+        `backoff`, `max_wait` and `jitter` configure the growth of the wait time
+        between retries, and `circuit_breaker` is an `arpa.CircuitBreaker` for pausing
+        the queries after repeated failures. See `arpa.post`. Optional.
+
+        `throttle` is an `arpa.Throttle` for adapting the number of concurrent queries
+        and limiting the query rate. Optional.
+
+        The instance keeps a pool of connections to the service open.
+        `pool_connections`, `pool_maxsize`, `pool_block` and `keep_alive` configure
+        the pool, see `arpa.make_session`. `pool_maxsize` should be at least the number
+        of concurrent queries. Optional.
+
+        `cache` is an `arpa.QueryCache` instance that is used for caching the
+        service responses. Optional.
+
+        `max_batch_bytes` is the maximum size of the query in bytes when querying
+        multiple texts at once with `arpa.Arpa.query_batch`. A single text that
+        exceeds the limit is still queried. Optional, not limited by default.
+
+        `candidate_generator` is an `arpa.CandidateGenerator` (or any function that
+        takes a text and returns a list of candidates) that is used for getting the
+        candidates in process, instead of querying them from the service. Optional.
+        """
+
+        logger.debug('Initialize Arpa instance')
+
+        if retries < 0:
+            raise ValueError('Number of retries has to be a non-negative number, got {}'
+                    .format(retries))
+        if wait_between_tries < 0:
+            raise ValueError('Retry wait time has to be a non-negative number, got {}'
+                    .format(wait_between_tries))
+        _check_retry_params(retries, wait_between_tries, backoff, max_wait, jitter)
+
+        self._retries = retries
+        self._backoff = backoff
+        self._max_wait = max_wait
+        self._jitter = jitter
+        self._circuit_breaker = circuit_breaker
+        self._throttle = throttle
+        self._stats = Stats()
+
+        self._url = url
+        self._ignore = [s.lower() for s in ignore or []]
+        self._min_ngram_length = min_ngram_length
+        self._wait = wait_between_tries
+
+        self._pool_connections = pool_connections
+        self._pool_maxsize = pool_maxsize
+        self._pool_block = pool_block
+        self._keep_alive = keep_alive
+        self._session = make_session(pool_connections, pool_maxsize, pool_block, keep_alive)
+
+        self._cache = cache
+        self._max_batch_bytes = max_batch_bytes
+        self._candidate_generator = candidate_generator
+
+        if type(remove_duplicates) == bool:
+            self._no_duplicates = remove_duplicates
+        else:
+            self._no_duplicates = tuple('<{}>'.format(x) for x in remove_duplicates)
+
+        # The priority of each preferred type for duplicate removal (lower is better)
+        self._type_ranks = {}
+        if type(self._no_duplicates) == tuple:
+            for rank, type_ in enumerate(self._no_duplicates):
+                self._type_ranks.setdefault(type_, rank)
+
+        logger.debug('ARPA ignore set to {}'.format(self._ignore))
+        logger.debug('ARPA url set to {}'.format(self._url))
+        logger.debug('ARPA min_ngram_length set to {}'.format(self._min_ngram_length))
+        logger.debug('ARPA no_duplicates set to {}'.format(self._no_duplicates))
+        logger.debug('ARPA retries set to {}'.format(self._retries))
+        logger.debug('ARPA connection pool size set to {}'.format(self._pool_maxsize))
+
+    def close(self):
+        """Close the connections to the service."""
+
+        self._session.close()
+
+    def _reconnect(self):
+        """
+        Replace the connections inherited from a parent process with new ones.
+        Called in the worker processes of `arpa.process_graph`.
+        """
+
+        self._session = make_session(self._pool_connections, self._pool_maxsize,
+                self._pool_block, self._keep_alive)
+
+    def _share_limits(self, count):
+        """
+        Limit the query rate of this instance to its share of `count` processes that
+        query the same endpoint. Called in the worker processes of `arpa.process_graph`.
+        """
+
+        throttle = self._throttle
+        if throttle is not None and throttle.rate is not None:
+            throttle.rate /= count
+            throttle.burst = max(1, throttle.burst // count)
+            throttle._tokens = min(throttle._tokens, throttle.burst)
+
+    def get_stats(self):
+        """
+        Return a dict of cumulative statistics about the queries made by this instance.
+
+        The number of requests sent (requests), retries (retries), and bytes sent and
+        received (bytes_sent, bytes_received) are counted, as are the seconds spent waiting
+        for the responses (http_time), decoding them (decode_time), filtering the
+        results (filter_time) and validating them (validation_time). With concurrent
+        queries the times of each query are summed. Candidates and matches found in process
+        are timed as candidate_time and match_time (see `arpa.CandidateGenerator` and
+        `arpa.LocalArpa`).
+
+        If a cache is used, 'cache_hits' and 'cache_misses' have the cache hit and
+        miss counts.
+        """
+
+        stats = self._stats.as_dict()
+        if self._cache is not None:
+            stats['cache_hits'] = self._cache.hits
+            stats['cache_misses'] = self._cache.misses
+        return stats
+
+    def _post(self, url, data):
+        """
+        Send the request with `arpa.post` unless the response is cached.
+        Return the parsed response.
+        """
+
+        if self._cache is not None:
+            res = self._cache.get(url, data)
+            if res is not None:
+                logger.debug('Using cached response')
+                return res
+
+        res = post(url, data, retries=self._retries, wait=self._wait, session=self._session,
+                **self._get_post_kwargs())
+
+        if self._cache is not None:
+            self._cache.put(url, data, res)
+
+        return res
+
+    def get_limits(self):
+        """
+        Return a dict of the current limits of the `arpa.Throttle` of this instance,
+        see `arpa.Throttle.get_limits`. Empty if no throttle is used.
+        """
+
+        return self._throttle.get_limits() if self._throttle is not None else {}
+
+    def _get_post_kwargs(self):
+        return dict(backoff=self._backoff, max_wait=self._max_wait, jitter=self._jitter,
+                circuit_breaker=self._circuit_breaker, throttle=self._throttle, stats=self._stats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _remove_duplicates(self, entries):
+        """
+        Remove duplicates from the entries.
+
+        A 'duplicate' is an entry with the same `LABEL_PROP` property value.
+
+        If `self._no_duplicates == True`, choose the subject to keep any which way.
+
+        If `self._no_duplicates` is a tuple (or a list), choose the kept subject
+        by comparing its type to the types contained in the tuple. The lower the
+        index of the type in the tuple, the higher the priority.
+
+        `entries` is the ARPA service results as a JSON object.
+        """
+
+        res = entries
+        if self._no_duplicates is True:
+            labels = set()
+            add = labels.add
+            res = [x for x in res if not (x[LABEL_PROP] in labels
+                # If the label is not in the labels set, add it to the set.
+                # This works because set.add() returns None.
+                or add(x[LABEL_PROP]))]
+
+        elif self._no_duplicates:
+            # self._no_duplicates is a tuple - prioritize types defined in it
+            ranks = self._type_ranks
+            # The rank, index and whether the entry has types, of the most
+            # preferrable entry for each label
+            selected = {}
+            for i, x in enumerate(res):
+                x_label = x[LABEL_PROP].lower()
+                types = x['properties'][TYPE_PROP]
+                # The priority of this entry (lower is better)
+                rank = min((ranks[t] for t in types if t in ranks), default=float('inf'))
+                prev = selected.get(x_label)
+
+                if prev is None or not prev[2] or rank < prev[0]:
+                    # There is no previous entry (with types) with this label or
+                    # the current match has a higher priority preferred type
+                    selected[x_label] = (rank, i, bool(types))
+
+            keep = {i for _, i, _ in selected.values()}
+            res = [x for i, x in enumerate(res) if i in keep]
+
+        return res
+
+    def _filter_results(self, results, get_len, get_label, skip_remove_duplicates=False):
+        """
+        Internal filter function used by `arpa.Arpa._filter`.
+        """
+
+        # Filter ignored results
+        if self._ignore:
+            results = [x for x in results if get_label(x) not in self._ignore]
+
+        # Filter by minimum ngram length
+        if self._min_ngram_length > 1:
+            results = [x for x in results if get_len(x) >= self._min_ngram_length]
+
+        # Remove duplicates unless requested to skip
+        if skip_remove_duplicates:
+            return results
+        return self._remove_duplicates(results)
+
+    def _filter(self, results, candidates=False):
+        """
+        Filter matches based on `self._ignore` and remove matches that are
+        for ngrams with length less than `self.min_ngram_length`.
+
+        Return the response with the ignored matches removed.
+
+        `results` is the parsed ARPA service results.
+
+        `candidates` is whether or not the results contain just the candidates.
+        """
+
+        if candidates:
+            logger.debug('Filtering candidates')
+            get_len = lambda x: len(x.split())
+            get_label = lambda x: x.lower()
+            # No use in removing literal duplicates
+            skip_remove_duplicates = True
+        else:
+            logger.debug('Filtering results')
+            get_len = lambda x: len(x['properties']['ngram'][0].split())
+            get_label = lambda x: x[LABEL_PROP].lower()
+            skip_remove_duplicates = False
+
+        with self._stats.timer('filter_time'):
+            return self._filter_results(results, get_len, get_label, skip_remove_duplicates)
+
+    def _build_request(self, text, candidates=False):
+        """
+        Return the URL and the data for querying the ARPA service with `text`.
+        """
+
+        if not text:
+            raise ValueError('Empty ARPA query text')
+
+        url = self._url + ('?cgen' if candidates else '')
+
+        # Query the ARPA service with the text
+        data = {'text': text}
+
+        return url, data
+
+    def _parse_response(self, res, candidates=False):
+        """
+        Return the filtered results from the parsed ARPA service response `res`.
+        """
+
+        return self._filter(res.get('results', []), candidates)
+
+    def query(self, text, candidates=False):
+        """
+        Query the ARPA service and return the response results as JSON
+
+        Results will be filtered if a filter was specified at init.
+
+        `text` is the text used in the query.
+
+        If `candidates` is set, query for candidates only. The candidates are generated
+        in process if a candidate generator was specified at init.
+        """
+
+        if candidates and self._candidate_generator is not None:
+            return self._generate_candidates(text)
+
+        logger.debug('Query ARPA at %s with text %s', self._url, _Truncated(text))
+
+        url, data = self._build_request(text, candidates)
+
+        res = self._post(url, data)
+
+        return self._parse_response(res, candidates)
+
+    def _generate_candidates(self, text):
+        """
+        Return the filtered candidates of `text` from the candidate generator.
+        """
+
+        if not text:
+            raise ValueError('Empty ARPA query text')
+
+        logger.debug('Generating candidates for text %s', _Truncated(text))
+
+        with self._stats.timer('candidate_time'):
+            candidates = self._candidate_generator(text)
+
+        return self._filter(candidates, candidates=True)
+
+    def extract_uris(self, results):
+        """
+        Get the URIs from results.
+
+        `results` is the results as returned by `arpa.query`.
+        """
+        return [URIRef(x['id']) for x in results]
+
+    def get_distinct_mentions(self, results):
+        """
+        Get distinct mentions (i.e. matches) that yielded results.
+
+        `results` is the results as returned by `arpa.query`.
+        """
+        return {m for ml in [p['matches'] for p in results] for m in ml}
+
+    def get_uri_matches(self, text, *args, validator=None, **kwargs):
+        """
+        Query ARPA and return a dict with a list of uris of resources that match the text.
+
+        Return a dict where 'results' has the list of uris, 'mentions' has the mentions
+        that yielded results, and 'pre_validation_mentions' has mentions that yielded
+        results before running the `validator`.
+
+        `text` is the text to use in the query.
+
+        `validator` is an object that implements a `validate` method that takes
+        the results and `text` (and any other parameters passed to this method)
+        as parameters, and returns a subset of the results. See also
+        `arpa.Arpa.get_uri_matches_batch`.
+        """
+
+        logger.info('Getting URI matches: %s', _Truncated(text))
+
+        results = self.query(text)
+
+        return self._get_uri_match_dict(results, text, *args, validator=validator, **kwargs)
+
+    def _get_uri_match_dict(self, results, text, *args, validator=None, **kwargs):
+        """
+        Validate the query `results` and return the result dict as described in
+        `arpa.Arpa.get_uri_matches`.
+        """
+
+        pre_validation_mentions = set()
+
+        if validator and results:
+            pre_validation_mentions = self._get_pre_validation_mentions(results)
+            with self._stats.timer('validation_time'):
+                results = validator.validate(results, text, *args, **kwargs)
+
+        return self._make_uri_match_dict(results, pre_validation_mentions)
+
+    def _get_pre_validation_mentions(self, results):
+        logger.debug('Validating results: %s', _Truncated(results))
+        mentions = self.get_distinct_mentions(results)
+        logger.info('Distinct mentions before validation: %s (%s)',
+                len(mentions), _Truncated(mentions))
+        return mentions
+
+    def _make_uri_match_dict(self, results, pre_validation_mentions):
+        """
+        Return the result dict as described in `arpa.Arpa.get_uri_matches`
+        for the validated `results`.
+        """
+
+        post_validation_mentions = set()
+
+        if results:
+            logger.info('Found matches %s', _Truncated(results))
+            post_validation_mentions = self.get_distinct_mentions(results)
+            logger.info('Distinct mentions: %s (%s)',
+                    len(post_validation_mentions), _Truncated(post_validation_mentions))
+            results = self.extract_uris(results)
+        else:
+            logger.info('No matches found')
+
+        return {
+            'results': results,
+            'mentions': post_validation_mentions,
+            'pre_validation_mentions': pre_validation_mentions
+        }
+
+    def get_candidates(self, text, *args, **kwargs):
+        """
+        Get the candidates from `text` that would be used by the ARPA service
+        to query for matches.
+
+        A dict is returned for compatibility with `arpa.get_uri_matches`.
+
+        Return a dict where 'results' has the candidates as a list of rdflib Literals.
+        """
+
+        if not text:
+            raise ValueError('Empty ARPA query text')
+
+        res = self.query(text, candidates=True)
+
+        return self._get_candidate_dict(res)
+
+    def _get_candidate_dict(self, res):
+        """
+        Return the result dict as described in `arpa.Arpa.get_candidates`.
+        """
+
+        logger.debug('Received candidates: %s', _Truncated(res))
+
+        result = {'results': [Literal(candidate) for candidate in res]}
+
+        return result
+
+    def _query_each(self, texts, *args):
+        """
+        Query the texts one at a time. See `arpa.Arpa.query_batch`.
+        """
+
+        results = []
+        for text in texts:
+            try:
+                results.append(self.query(text, *args))
+            except (HTTPError, ValueError) as e:
+                results.append(e)
+        return results
+
+    def _get_text_batches(self, texts):
+        """
+        Split `texts` into batches so that the combined text of each batch fits
+        in `self._max_batch_bytes`. Yield lists of indices to `texts`.
+        """
+
+        separator_size = len(BATCH_SEPARATOR.encode())
+        batch = []
+        size = 0
+        for i, text in enumerate(texts):
+            text_size = len(text.encode())
+            if (batch and self._max_batch_bytes is not None
+                    and size + separator_size + text_size > self._max_batch_bytes):
+                yield batch
+                batch = []
+                size = 0
+            size += text_size + (separator_size if batch else 0)
+            batch.append(i)
+        if batch:
+            yield batch
+
+    def query_batch(self, texts, candidates=False):
+        """
+        Query the service with multiple texts, combining as many texts into
+        a single query as `max_batch_bytes` allows.
+
+        Return a list with the results for each text as returned by `arpa.Arpa.query`,
+        or the exception (HTTPError or ValueError) if the query for the text failed.
+
+        The texts are separated by `arpa.BATCH_SEPARATOR` in the query, and each match is
+        attributed to the texts that contain one of the strings in the 'matches' of the
+        match (as a sequence of words, ignoring case and punctuation). The 'matches' and
+        the 'ngram' property of the match are cut down to the strings found in each text,
+        and matches spanning multiple texts are dropped. The results are then filtered
+        separately for each text.
+
+        `texts` is the list of texts to query.
+
+        If `candidates` is set, query for candidates only. The candidates can not be
+        attributed to the texts, so in this case the texts are queried one at a time.
+        """
+
+        if candidates:
+            return self._query_each(texts, candidates)
+
+        results = [None] * len(texts)
+        indices = []
+        for i, text in enumerate(texts):
+            if text:
+                indices.append(i)
+            else:
+                results[i] = ValueError('Empty ARPA query text')
+
+        for batch in self._get_text_batches([texts[i] for i in indices]):
+            batch = [indices[j] for j in batch]
+
+            logger.debug('Query ARPA at %s with %s texts', self._url, len(batch))
+
+            url, data = self._build_request(BATCH_SEPARATOR.join(texts[i] for i in batch))
+            try:
+                res = self._post(url, data)
+            except HTTPError as e:
+                for i in batch:
+                    results[i] = e
+                continue
+
+            # Split the matches by text
+            normalized_texts = [(i, _normalize_words(texts[i])) for i in batch]
+            split_results = {i: [] for i in batch}
+            for entry in res.get('results', []):
+                entry_matches = [(m, _normalize_words(m)) for m in entry.get('matches', [])]
+                properties = entry.get('properties', {})
+                entry_ngrams = [(n, _normalize_words(n)) for n in properties.get('ngram', [])]
+                for i, text in normalized_texts:
+                    found = [m for m, nm in entry_matches if nm.strip() and nm in text]
+                    if not found:
+                        continue
+                    split_entry = dict(entry, matches=found)
+                    if 'ngram' in properties:
+                        ngrams = [n for n, nn in entry_ngrams if nn.strip() and nn in text]
+                        if not ngrams:
+                            continue
+                        split_entry['properties'] = dict(properties, ngram=ngrams)
+                    split_results[i].append(split_entry)
+
+            for i, text_results in split_results.items():
+                results[i] = self._parse_response({'results': text_results})
+
+        return results
+
+    def get_uri_matches_batch(self, texts, subjects, validator=None):
+        """
+        Batch version of `arpa.Arpa.get_uri_matches`.
+
+        Return a list with the result dict for each text, or the exception
+        (HTTPError or ValueError) if getting the matches for the text failed.
+
+        `texts` is the list of texts to query.
+
+        `subjects` is the list of the subjects the texts belong to. The subject
+        is passed to the `validator` with the corresponding text.
+
+        If the `validator` implements a `validate_batch` method, the results of all
+        the texts are validated with a single call to it. It takes a list of the results
+        of each text (that has any results), a list of the texts and a list of the subjects
+        as parameters, and returns a list with the validated results of each text.
+        Otherwise `validate` is called for each text.
+        """
+
+        logger.info('Getting URI matches for %s texts', len(texts))
+
+        results = list(self.query_batch(texts))
+
+        if _has_validate_batch(validator):
+            return self._get_uri_match_dicts(results, texts, subjects, validator)
+
+        for i, (text, s, res) in enumerate(zip(texts, subjects, results)):
+            if not isinstance(res, Exception):
+                try:
+                    results[i] = self._get_uri_match_dict(res, text, s, validator=validator)
+                except (HTTPError, ValueError) as e:
+                    results[i] = e
+        return results
+
+    def _get_uri_match_dicts(self, results, texts, subjects, validator):
+        """
+        Validate the query `results` of `texts` with `validator.validate_batch`,
+        and return the result dicts (or exceptions) as described in
+        `arpa.Arpa.get_uri_matches_batch`.
+        """
+
+        # Only the texts with results are validated
+        indices = [i for i, res in enumerate(results) if res and not isinstance(res, Exception)]
+        pre_validation_mentions = {i: self._get_pre_validation_mentions(results[i])
+                for i in indices}
+
+        if indices:
+            try:
+                with self._stats.timer('validation_time'):
+                    validated = validator.validate_batch([results[i] for i in indices],
+                            [texts[i] for i in indices], [subjects[i] for i in indices])
+            except (HTTPError, ValueError) as e:
+                logger.exception('Error validating the results of %s texts', len(indices))
+                for i in indices:
+                    results[i] = e
+            else:
+                if len(validated) != len(indices):
+                    raise ValueError('The validator returned {} results for {} texts'
+                            .format(len(validated), len(indices)))
+                for i, res in zip(indices, validated):
+                    results[i] = res
+
+        return [res if isinstance(res, Exception)
+                else self._make_uri_match_dict(res, pre_validation_mentions.get(i, set()))
+                for i, res in enumerate(results)]
+
+    def get_candidates_batch(self, texts, *args, **kwargs):
+        """
+        Batch version of `arpa.Arpa.get_candidates`.
+
+        Return a list with the result dict for each text, or the exception
+        (HTTPError or ValueError) if getting the candidates for the text failed.
+        """
+
+        return [res if isinstance(res, Exception) else self._get_candidate_dict(res)
+                for res in self.query_batch(texts, True)]
+
+
+class ArpaMimic(Arpa):
+    """
+    Class that behaves like `arpa.Arpa` except that it queries a SPARQL endpoint
+    instead of an ARPA service.
     """
 
     def __init__(self, query_template, *args, **kwargs):
         """
-        Initialize the ArpaMimic instance.
+        Initialize the ArpaMimic instance.
+
+        `query_template` is a SPARQL query template like ARPA uses.
+        """
+
+        self.query_template = query_template
+
+        super().__init__(*args, **kwargs)
+
+    def _build_request(self, text, url_params=''):
+        """
+        Return the URL and the data for querying the SPARQL endpoint with `text`.
+        """
+
+        if not text:
+            raise ValueError('Empty query text')
+
+        query = self.query_template.replace('<VALUES>', text)
+
+        url = self._url + url_params
+
+        # Query the endpoint with the text
+        data = {'query': query}
+
+        return url, data
+
+    def _parse_response(self, res, *args):
+        """
+        Map the SPARQL response `res` (or its result bindings) to the ARPA format
+        and return the filtered results.
+        """
+
+        res = map_results(res)
+
+        return self._filter(res.get('results', []))
+
+    def query(self, text, url_params=''):
+        """
+        Query a SPARQL endpoint and return the response results as JSON mapped
+        as if returned by ARPA.
+
+        `text` is the text used in the query.
+
+        `url_params` is any URL parameters to be added to the URL.
+        """
+
+        logger.debug('Querying %s with text %s using ArpaMimic', self._url, _Truncated(text))
+
+        url, data = self._build_request(text, url_params)
+
+        res = self._post(url, data)
+
+        return self._parse_response(res)
+
+    def _get_batches(self, values):
+        """
+        Split texts into batches so that the query for each batch fits
+        in `self._max_batch_bytes`.
+
+        Yield lists of indices to `values`.
+
+        `values` is a list of lists of values, one list per text.
+        """
+
+        base_size = len(self.query_template.encode())
+        batch = []
+        batch_values = set()
+        size = base_size
+        for i, text_values in enumerate(values):
+            new_values = set(text_values) - batch_values
+            # Each value is quoted and separated by a space
+            added_size = sum(len(v.encode()) + 3 for v in new_values)
+            if (batch and self._max_batch_bytes is not None
+                    and size + added_size > self._max_batch_bytes):
+                yield batch
+                batch = []
+                batch_values = set()
+                new_values = set(text_values)
+                size = base_size
+                added_size = sum(len(v.encode()) + 3 for v in new_values)
+            batch.append(i)
+            batch_values.update(new_values)
+            size += added_size
+        if batch:
+            yield batch
+
+    def query_batch(self, texts, url_params=''):
+        """
+        Query the SPARQL endpoint with multiple texts, using a single query for
+        as many texts as `max_batch_bytes` allows.
+
+        Return a list with the results for each text as returned by `arpa.ArpaMimic.query`,
+        or the exception (HTTPError or ValueError) if the query for the text failed.
+
+        Each text should consist of quoted values (see `arpa.combine_values`),
+        and the query template has to bind the `ngram` variable to the value that
+        produced the result row, so that the results can be attributed to the texts.
+        Texts that do not consist of quoted values are queried separately.
+
+        `texts` is the list of texts to query.
+
+        `url_params` is any URL parameters to be added to the URL.
+        """
+
+        results = [None] * len(texts)
+        values = []
+        batchable = []
+        for i, text in enumerate(texts):
+            text_values = split_values(text) if text else []
+            if text_values:
+                batchable.append(i)
+                values.append(text_values)
+            else:
+                try:
+                    results[i] = self.query(text, url_params)
+                except (HTTPError, ValueError) as e:
+                    results[i] = e
+
+        for batch in self._get_batches(values):
+            # Map each value to the indices of the texts that contain it
+            value_texts = {}
+            for j in batch:
+                for v in values[j]:
+                    indices = value_texts.setdefault(v, [])
+                    if not indices or indices[-1] != batchable[j]:
+                        indices.append(batchable[j])
+
+            logger.debug('Querying %s with %s texts (%s values) using ArpaMimic',
+                    self._url, len(batch), len(value_texts))
+
+            url, data = self._build_request(combine_values(value_texts), url_params)
+            try:
+                res = self._post(url, data)
+            except HTTPError as e:
+                for j in batch:
+                    results[batchable[j]] = e
+                continue
+
+            # Split the bindings by text, retaining their order
+            bindings = {batchable[j]: [] for j in batch}
+            for binding in res.get('results', {}).get('bindings', []):
+                ngram = binding.get('ngram', {}).get('value', '')
+                for i in value_texts.get(ngram, ()):
+                    bindings[i].append(binding)
+
+            for i, text_bindings in bindings.items():
+                results[i] = self._parse_response(text_bindings)
+
+        return results
+
+
+class AsyncArpa(Arpa):
+    """
+    Class that behaves like `arpa.Arpa` except that the querying methods are coroutines.
+
+    Requires [aiohttp](https://docs.aiohttp.org/).
+
+    The instance owns an `aiohttp.ClientSession` that is created on the first query.
+    The session should be closed with `arpa.AsyncArpa.close` (or by using the instance
+    as an async context manager) before the event loop is closed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initialize the AsyncArpa instance.
+
+        Takes the same parameters as `arpa.Arpa`. The connection pool allows at most
+        `pool_connections` * `pool_maxsize` connections in total, and `pool_maxsize`
+        connections per host. `pool_block` has no effect.
+        """
+
+        super().__init__(*args, **kwargs)
+
+        # The synchronous session is not used
+        super().close()
+        self._async_session = None
+
+    def _get_session(self):
+        if self._async_session is None or self._async_session.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self._pool_connections * self._pool_maxsize,
+                    limit_per_host=self._pool_maxsize, force_close=not self._keep_alive)
+            self._async_session = aiohttp.ClientSession(connector=connector)
+        return self._async_session
+
+    async def close(self):
+        """Close the HTTP session, if any."""
+
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def query(self, text, *args):
+        """
+        Query the service and return the response results as JSON.
+
+        See `arpa.Arpa.query`.
+        """
+
+        logger.debug('Query %s with text %s asynchronously', self._url, _Truncated(text))
+
+        url, data = self._build_request(text, *args)
+
+        res = await self._post_async(url, data)
+
+        return self._parse_response(res, *args)
+
+    async def _post_async(self, url, data):
+        """
+        Coroutine version of `arpa.Arpa._post`.
+        """
+
+        if self._cache is not None:
+            res = self._cache.get(url, data)
+            if res is not None:
+                logger.debug('Using cached response')
+                return res
+
+        res = await post_async(self._get_session(), url, data, retries=self._retries,
+                wait=self._wait, **self._get_post_kwargs())
+
+        if self._cache is not None:
+            self._cache.put(url, data, res)
+
+        return res
+
+    async def get_uri_matches(self, text, *args, validator=None, **kwargs):
+        """
+        Query the service and return a dict with a list of uris of resources that
+        match the text.
+
+        See `arpa.Arpa.get_uri_matches`.
+        """
+
+        logger.info('Getting URI matches: %s', _Truncated(text))
+
+        results = await self.query(text)
+
+        return self._get_uri_match_dict(results, text, *args, validator=validator, **kwargs)
+
+    async def get_candidates(self, text, *args, **kwargs):
+        """
+        Get the candidates from `text` that would be used by the ARPA service
+        to query for matches.
+
+        See `arpa.Arpa.get_candidates`.
+        """
+
+        if not text:
+            raise ValueError('Empty ARPA query text')
+
+        if self._candidate_generator is not None:
+            res = self._generate_candidates(text)
+        else:
+            res = await self.query(text, True)
+
+        return self._get_candidate_dict(res)
+
+
+class AsyncArpaMimic(AsyncArpa, ArpaMimic):
+    """
+    Class that behaves like `arpa.ArpaMimic` except that the querying methods are coroutines.
+
+    See `arpa.AsyncArpa`.
+    """
+
+
+class _LabelIndex:
+    """
+    Word-level Aho-Corasick automaton that finds all the occurrences of a set of
+    word sequences (patterns) in a sequence of words in a single pass.
+    """
+
+    def __init__(self):
+        # The transitions, failure link, pattern length and pattern values of each state
+        self._goto = [{}]
+        self._fail = [0]
+        self._depth = [0]
+        self._values = [None]
+        # The (length, values) of each pattern that ends in each state, set by `build`
+        self._out = [[]]
+        self.max_length = 0
+
+    def add(self, words, value):
+        """Add `value` to the values of the pattern `words` (a list of words)."""
+
+        state = 0
+        for word in words:
+            next_state = self._goto[state].get(word)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][word] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._depth.append(self._depth[state] + 1)
+                self._values.append(None)
+            state = next_state
+
+        if self._values[state] is None:
+            self._values[state] = []
+        self._values[state].append(value)
+        self.max_length = max(self.max_length, len(words))
+
+    def build(self):
+        """Compute the failure links. Has to be called after adding the patterns."""
+
+        goto, fail = self._goto, self._fail
+        out = [[(self._depth[state], values)] if values is not None else []
+                for state, values in enumerate(self._values)]
+
+        queue = deque((0,))
+        while queue:
+            state = queue.popleft()
+            for word, next_state in goto[state].items():
+                queue.append(next_state)
+                if state:
+                    f = fail[state]
+                    while f and word not in goto[f]:
+                        f = fail[f]
+                    fail[next_state] = goto[f].get(word, 0)
+                # The patterns that are suffixes of this one end here too
+                out[next_state] += out[fail[next_state]]
+
+        self._out = out
+
+    def find(self, words):
+        """
+        Yield the start and end index in `words` and the values of each occurrence
+        of a pattern, longest first for each end index.
+        """
+
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for i, word in enumerate(words):
+            while state and word not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(word, 0)
+            for length, values in out[state]:
+                yield i + 1 - length, i + 1, values
+
+
+class LocalArpa(Arpa):
+    """
+    Class that behaves like `arpa.Arpa` except that it matches the texts against the labels
+    of a vocabulary graph in process, instead of querying an ARPA service.
+
+    The labels are matched as sequences of words, ignoring case and punctuation.
+    No lemmatization is done, so inflected forms only match if they are labels themselves.
+    """
+
+    def __init__(self, graph, label_prop=SKOS.prefLabel, rdf_class=None, *args, **kwargs):
+        """
+        Initialize the LocalArpa instance.
+
+        `graph` is the vocabulary as an rdflib Graph. The labels of its subjects (the values
+        of `label_prop`, which can also be a list of properties) are matched against the texts.
+
+        `rdf_class` is the class of the subjects to include. Optional, all subjects with
+        a label are included by default.
+
+        The types (rdf:type) of the subjects are included in the results as the
+        `arpa.TYPE_PROP` property (an empty list for untyped subjects), so that
+        duplicates can be removed by type.
+
+        The rest of the arguments are passed to `arpa.Arpa`, except for the url.
+        Only `remove_duplicates`, `min_ngram_length`, `ignore` and `candidate_generator`
+        have an effect, as no requests are made. The candidates are the n-grams of the text
+        up to the length of the longest label by default.
+        """
+
+        super().__init__(None, *args, **kwargs)
+
+        if isinstance(label_prop, URIRef):
+            label_prop = [label_prop]
+
+        subjects = set(graph.subjects(RDF.type, rdf_class)) if rdf_class else None
+        # The result rows (SPARQL bindings without the ngram) of each subject
+        subject_rows = {}
+
+        self._index = _LabelIndex()
+        for prop in label_prop:
+            for s, label in graph.subject_objects(prop):
+                if subjects is not None and s not in subjects:
+                    continue
+                words = [w.lower() for w in _WORD_RE.findall(label)]
+                if not words:
+                    continue
+
+                rows = subject_rows.get(s)
+                if rows is None:
+                    types = [{'type': 'uri', 'value': str(t)} for t in graph.objects(s, RDF.type)]
+                    rows = [{'id': {'type': 'uri', 'value': str(s)}, TYPE_PROP: t}
+                            for t in types] or [{'id': {'type': 'uri', 'value': str(s)}}]
+                    subject_rows[s] = rows
+
+                label_binding = {'type': 'literal', 'value': str(label)}
+                for row in rows:
+                    self._index.add(words, dict(row, label=label_binding))
+
+        self._index.build()
+
+        if self._candidate_generator is None:
+            self._candidate_generator = CandidateGenerator(max_length=self._index.max_length or None)
+
+        logger.debug('Indexed %s labels of %s subjects', sum(map(len, subject_rows.values())),
+                len(subject_rows))
+
+    def query(self, text, candidates=False):
+        """
+        Match `text` against the labels and return the results in the format ARPA returns.
+
+        Results will be filtered if a filter was specified at init.
+
+        If `candidates` is set, return the candidates of the text instead.
+        """
+
+        if candidates:
+            return self._generate_candidates(text)
+
+        logger.debug('Matching text %s locally', _Truncated(text))
+
+        if not text:
+            raise ValueError('Empty ARPA query text')
+
+        with self._stats.timer('match_time'):
+            spans = [m.span() for m in _WORD_RE.finditer(text)]
+            words = [text[start:end].lower() for start, end in spans]
+
+            mapper = ResultMapper()
+            for start, end, rows in self._index.find(words):
+                ngram = {'type': 'literal', 'value': text[spans[start][0]:spans[end - 1][1]]}
+                for row in rows:
+                    mapper.add(dict(row, ngram=ngram))
+
+            results = mapper.get_results()
+            # Subjects without types have no type bindings
+            for entry in results['results']:
+                entry['properties'].setdefault(TYPE_PROP, [])
+
+        return self._parse_response(results)
+
+    def query_batch(self, texts, candidates=False):
+        """
+        Match multiple texts, see `arpa.Arpa.query_batch`.
+        As there are no requests to save, the texts are matched one at a time.
+        """
+
+        return self._query_each(texts, candidates)
+
+
+class Bar:
+    """
+    Mock progress bar implementation
+    """
+
+    def __init__(self, n, *args, **kwargs):
+        self.n = n
+
+    def update(self, *args, **kwargs):
+        pass
+
+
+def get_bar(n, use_pyprind):
+    """
+    Get a progress bar.
+
+    `n` is the number of iterations for the progress bar.
+
+    If `use_pyprind` is true, try to return a `pyprind.ProgBar` instance. Otherwise,
+    return a mock progress bar.
+    """
+
+    if use_pyprind:
+        try:
+            import pyprind
+            logger.debug('Using pyprind progress bar')
+            return pyprind.ProgBar(n)
+        except ImportError:
+            logger.warning('Tried to use pyprind progress bar but pyprind is not available')
+            pass
+
+    logger.debug('Using mock progress bar')
+    return Bar(n)
+
+
+class _SubjectView:
+    """
+    Lazy view of the (subject, object) pairs of a property in a graph,
+    optionally restricted to the instances of a class and to a shard of the subjects
+    (a tuple (index, count), see `arpa.get_shard`).
+
+    Nothing is copied from the graph, the pairs are read from it as they are iterated.
+    """
+
+    def __init__(self, graph, prop, rdf_class=None, shard=None):
+        self.graph = graph
+        self.prop = prop
+        self.rdf_class = rdf_class
+        self.shard = shard
+        self._len = None
+
+    def subject_objects(self):
+        """Iterate over the (subject, object) pairs."""
+
+        if self.shard is None:
+            return self._subject_objects()
+        index, count = self.shard
+        return ((s, o) for s, o in self._subject_objects() if get_shard(s, count) == index)
+
+    def _subject_objects(self):
+        if self.rdf_class:
+            # Filter out subjects that are not of the given type
+            for s in self.graph.subjects(RDF.type, self.rdf_class):
+                for o in self.graph.objects(s, self.prop):
+                    yield s, o
+        else:
+            yield from self.graph.subject_objects(self.prop)
+
+    def subjects(self):
+        """Iterate over the distinct subjects."""
+
+        seen = set()
+        for s, o in self.subject_objects():
+            if s not in seen:
+                seen.add(s)
+                yield s
+
+    def objects(self, s):
+        """Iterate over the objects of the subject `s`."""
+
+        return self.graph.objects(s, self.prop)
+
+    def __len__(self):
+        """Return the number of (subject, object) pairs. The count is computed once."""
+
+        if self._len is None:
+            self._len = sum(1 for _ in self.subject_objects())
+        return self._len
+
+
+def get_shard(s, count):
+    """
+    Return the index of the shard of subject `s` when the subjects are split into
+    `count` shards. The index is the same in every process and run.
+    """
+
+    return zlib.crc32(str(s).encode()) % count
+
+
+def split_graph(graph, count, source_prop=None, rdf_class=None):
+    """
+    Split `graph` into `count` subject-complete graphs: all the triples of a subject
+    are in the same graph, the shard of the subject (see `arpa.get_shard`).
+
+    If `source_prop` or `rdf_class` is given, only the subjects that have a value
+    for `source_prop` and are instances of `rdf_class` are split between the graphs,
+    and the rest of the triples are included in every graph, so that each graph can be
+    processed on its own.
+
+    The triples of a blank node that is the object of another subject's triples are
+    included in every graph that has those triples, so that nested blank node structures
+    stay with the subjects that refer to them.
+
+    Return the list of graphs.
+    """
+
+    if count < 1:
+        raise ValueError('The number of shards has to be at least 1, got {}'.format(count))
+
+    graphs = [Graph() for _ in range(count)]
+    for g in graphs:
+        g.namespace_manager = graph.namespace_manager
+
+    if source_prop is None and rdf_class is None:
+        selected = None
+    elif source_prop is None:
+        selected = set(graph.subjects(RDF.type, rdf_class))
+    else:
+        selected = set(_SubjectView(graph, source_prop, rdf_class).subjects())
+
+    every_graph = frozenset(range(count))
+
+    def get_indices(s):
+        if selected is not None and s not in selected:
+            return every_graph
+        return frozenset([get_shard(s, count)])
+
+    # The indices of the graphs of each subject
+    subject_indices = {}
+    nested = []
+    for s in set(graph.subjects()):
+        if isinstance(s, BNode) and (None, None, s) in graph:
+            nested.append(s)
+        else:
+            subject_indices[s] = get_indices(s)
+
+    def add_nested(subjects):
+        # Add the blank node objects of the subjects to the graphs of the subjects
+        pending = deque(subjects)
+        while pending:
+            s = pending.popleft()
+            for o in graph.objects(s):
+                if not isinstance(o, BNode):
+                    continue
+                indices = subject_indices.get(o, frozenset()) | subject_indices[s]
+                if indices != subject_indices.get(o):
+                    subject_indices[o] = indices
+                    pending.append(o)
+
+    add_nested(list(subject_indices))
+
+    # Blank nodes that are only referred to by each other
+    for s in nested:
+        if s not in subject_indices:
+            subject_indices[s] = get_indices(s)
+            add_nested([s])
+
+    for triple in graph:
+        for index in subject_indices[triple[0]]:
+            graphs[index].add(triple)
+
+    logger.info('Split {} subjects into {} shards'.format(len(subject_indices), count))
+
+    return graphs
+
+
+def _get_results_safe(get_results, text, s, validator):
+    """
+    Call `get_results` and return the result dict, or the exception if
+    a HTTPError or a ValueError was raised.
+    """
+
+    try:
+        return get_results(text, s, validator=validator)
+    except (HTTPError, ValueError) as e:
+        logger.exception('Error getting matches from ARPA')
+        return e
+
+
+def _get_batch_results_safe(get_batch_results, batch, validator):
+    """
+    Call `get_batch_results` for the (subject, text) pairs in `batch`,
+    and return a list of (subject, result) tuples.
+    """
+
+    subjects = [s for s, text in batch]
+    texts = [text for s, text in batch]
+    try:
+        results = get_batch_results(texts, subjects, validator=validator)
+    except (HTTPError, ValueError) as e:
+        logger.exception('Error getting matches from ARPA')
+        results = [e] * len(batch)
+    return list(zip(subjects, results))
+
+
+def _get_batches(items, batch_size):
+    """Yield lists of at most `batch_size` consecutive items from `items`."""
+
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _iter_results(get_results, items, validator=None, workers=None,
+        get_batch_results=None, batch_size=None):
+    """
+    Query results for each (subject, text) pair in `items`.
+
+    Yield (subject, result) tuples in the same order as `items`, where result is
+    either the result dict returned by `get_results` or the exception raised by it.
+
+    If `batch_size` is set, query the items in batches of that size with
+    `get_batch_results` instead.
+
+    If `workers` is greater than 1, run the queries in a thread pool of that size.
+    At most a few queries per worker are kept pending at a time.
+    """
+
+    if batch_size:
+        def run(batch):
+            return _get_batch_results_safe(get_batch_results, batch, validator)
+        batches = _get_batches(items, batch_size)
+    else:
+        def run(batch):
+            s, text = batch
+            return [(s, _get_results_safe(get_results, text, s, validator))]
+        batches = items
+
+    if not workers or workers <= 1:
+        for batch in batches:
+            yield from run(batch)
+        return
+
+    logger.debug('Using a thread pool of {} workers'.format(workers))
+
+    max_pending = workers * 4
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batches:
+            pending.append(executor.submit(run, batch))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _get_result_functions(arpa, candidates_only, batch_size):
+    """
+    Return the methods of `arpa` for querying a single text and a batch of texts.
+    """
+
+    if candidates_only:
+        get_results = arpa.get_candidates
+        get_batch_results = getattr(arpa, 'get_candidates_batch', None)
+    else:
+        get_results = arpa.get_uri_matches
+        get_batch_results = getattr(arpa, 'get_uri_matches_batch', None)
+    if batch_size and get_batch_results is None:
+        raise ValueError('Batch queries are not supported by {}'.format(type(arpa).__name__))
+
+    return get_results, get_batch_results
+
+
+def _get_validation_window(arpa, candidates_only, batch_size, validator, validation_window):
+    """
+    Return the number of subjects whose results are validated together, or None
+    if the results are validated as part of the queries.
+
+    The results are validated in windows only if the texts are not queried in batches,
+    and `validator` implements `validate_batch`.
+    """
+
+    if (not batch_size and not candidates_only and validation_window
+            and _has_validate_batch(validator)
+            and getattr(arpa, 'get_uri_matches_batch', None) is not None):
+        return validation_window
+    return None
+
+
+def _iter_validated_results(arpa, items, validator, workers, validation_window):
+    """
+    Query each (subject, text) pair in `items` like `arpa._iter_results` without
+    validating the results, and validate the results in windows of `validation_window`
+    subjects with `validator.validate_batch` as they come in.
+
+    Yield (subject, result) tuples in the same order as `items`.
+    """
 
-        `query_template` is a SPARQL query template like ARPA uses.
-        """
+    def query(text, s, validator=None):
+        logger.info('Getting URI matches: %s', _Truncated(text))
+        return text, arpa.query(text)
 
-        self.query_template = query_template
+    for window in _get_batches(_iter_results(query, items, workers=workers), validation_window):
+        subjects = [s for s, res in window]
+        texts = [None if isinstance(res, Exception) else res[0] for s, res in window]
+        results = [res if isinstance(res, Exception) else res[1] for s, res in window]
+        try:
+            results = arpa._get_uri_match_dicts(results, texts, subjects, validator)
+        except ValueError as e:
+            logger.exception('Error validating the results of %s texts', len(window))
+            results = [e] * len(window)
+        yield from zip(subjects, results)
 
-        super().__init__(*args, **kwargs)
 
-    def query(self, text, url_params=''):
-        """
-        Query a SPARQL endpoint and return the response results as JSON mapped
-        as if returned by ARPA.
+class _ResultCollector:
+    """
+    Add `arpa.arpafy` results to the output graph and keep count of them.
 
-        `text` is the text used in the query.
+    If `checkpoint` (an `arpa.Checkpoint`) is given, journal the results, and
+    replay the journaled results of the pairs passed to `resume`.
 
-        `url_params` is any URL parameters to be added to the URL.
+    If `manifest` (an `arpa.Manifest`) is given, add the results to it, and reuse
+    the previous results of the unchanged subjects passed to `reuse`.
+
+    The time spent in the phases of the run is accumulated in `stats` (an `arpa.Stats`).
+    """
+
+    def __init__(self, output_graph, target_prop, arpa=None, checkpoint=None, manifest=None):
+        self.output_graph = output_graph
+        self.target_prop = target_prop
+        self.arpa = arpa
+        self.checkpoint = checkpoint
+        self.manifest = manifest
+        self.stats = Stats()
+        self.start_time = _perf_counter()
+        self.initial_stats = self._get_arpa_stats()
+        self.resumed = 0
+        self.reused = 0
+        # The source values and fingerprints of the queried pairs,
+        # in the order their results are added
+        self._pending = deque()
+        self.triple_match_count = 0
+        self.subject_match_count = 0
+        self.pre_validation_mention_count = 0
+        self.post_validation_mention_count = 0
+        self.processed = 0
+        self.errors = []
+
+    def add(self, s, result_dict):
         """
+        Add the results for subject `s`.
 
-        logger.debug('Querying {} with text {} using ArpaMimic'.format(self._url, text))
+        `result_dict` is the dict returned by `arpa.Arpa.get_uri_matches` (or
+        `arpa.Arpa.get_candidates`), or an exception if the query failed.
+        """
 
-        if not text:
-            raise ValueError('Empty query text')
+        self.processed += 1
 
-        query = self.query_template.replace('<VALUES>', text)
+        if self.checkpoint is not None or self.manifest is not None:
+            o, fingerprint = self._pending.popleft()
+            if not isinstance(result_dict, Exception):
+                self._record(s, o, fingerprint, result_dict)
 
-        url = self._url + url_params
+        self._add(s, result_dict)
 
-        # Query the endpoint with the text
-        data = {'query': query}
+    def _record(self, s, o, fingerprint, result_dict):
+        if self.checkpoint is not None:
+            self.checkpoint.add(s, o, result_dict)
+        if self.manifest is not None:
+            self.manifest.add(s, fingerprint, result_dict)
 
-        res = post(url, data, retries=self._retries, wait=self._wait)
+    def _add(self, s, result_dict):
+        if isinstance(result_dict, Exception):
+            self.errors.append(result_dict)
+            return
 
-        res = map_results(res)
+        results = result_dict['results']
+        self.triple_match_count += len(results)
+        self.pre_validation_mention_count += len(result_dict.get('pre_validation_mentions', []))
+        if results:
+            self.subject_match_count += 1
+            self.post_validation_mention_count += len(result_dict.get('mentions', []))
+            # Add each result as a value of the target property
+            with self.stats.timer('write_time'):
+                for result in results:
+                    self.output_graph.add((s, self.target_prop, result))
 
-        return self._filter(res.get('results', []))
+    def resume(self, s, o):
+        """
+        Return `True` if subject `s` and source value `o` have been journaled in
+        the checkpoint, and add their journaled results. Otherwise return `False`.
+        """
 
+        if self.checkpoint is None:
+            return False
 
-class Bar:
-    """
-    Mock progress bar implementation
-    """
+        result_dict = self.checkpoint.get(s, o)
+        if result_dict is None:
+            return False
 
-    def __init__(self, n, *args, **kwargs):
-        self.n = n
+        self.processed += 1
+        self.resumed += 1
+        self._add(s, result_dict)
+        return True
 
-    def update(self, *args, **kwargs):
-        pass
+    def reuse(self, s, o, text):
+        """
+        Return `True` if subject `s` with the (preprocessed) source text `text` is
+        unchanged since the run of the manifest, and add its previous results.
+        Otherwise return `False`, and expect the results of the pair to be added
+        next with `add`.
+        """
 
+        fingerprint = None
+        if self.manifest is not None:
+            fingerprint = self.manifest.get_fingerprint(text)
+            result_dict = self.manifest.get(s, fingerprint)
+            if result_dict is not None:
+                self.processed += 1
+                self.reused += 1
+                self._record(s, o, fingerprint, result_dict)
+                self._add(s, result_dict)
+                return True
+
+        if self.checkpoint is not None or self.manifest is not None:
+            self._pending.append((o, fingerprint))
+        return False
+
+    def _get_arpa_stats(self):
+        get_stats = getattr(self.arpa, 'get_stats', None)
+        return get_stats() if get_stats else {}
+
+    def get_result_dict(self):
+        """
+        Log a summary and return the result dict as described in `arpa.arpafy`.
+        """
 
-def get_bar(n, use_pyprind):
-    """
-    Get a progress bar.
+        res = {
+            'graph': self.output_graph,
+            'processed': self.processed,
+            'matches': self.triple_match_count,
+            'subjects_matched': self.subject_match_count,
+            'pre_validation_mention_count': self.pre_validation_mention_count,
+            'post_validation_mention_count': self.post_validation_mention_count,
+            'errors': self.errors
+        }
 
-    `n` is the number of iterations for the progress bar.
+        logger.info('Processed {} triples, found {} matches from {} mentions'
+                    ' with {} total mentions ({} errors)'
+                    .format(res['processed'], res['matches'], res['post_validation_mention_count'],
+                        res['pre_validation_mention_count'], len(res['errors'])))
 
-    If `use_pyprind` is true, try to return a `pyprind.ProgBar` instance. Otherwise,
-    return a mock progress bar.
-    """
+        # Add the statistics of this run
+        for key, value in self._get_arpa_stats().items():
+            res[key] = value - self.initial_stats.get(key, 0)
 
-    if use_pyprind:
-        try:
-            import pyprind
-            logger.debug('Using pyprind progress bar')
-            return pyprind.ProgBar(n)
-        except ImportError:
-            logger.warning('Tried to use pyprind progress bar but pyprind is not available')
-            pass
+        if 'cache_hits' in res:
+            logger.info('Cache hits: {}, misses: {}'.format(res['cache_hits'], res['cache_misses']))
 
-    logger.debug('Using mock progress bar')
-    return Bar(n)
+        res.update(self.stats.as_dict())
+        res['arpafy_time'] = _perf_counter() - self.start_time
 
+        # Add the current limits
+        get_limits = getattr(self.arpa, 'get_limits', None)
+        limits = get_limits() if get_limits else {}
+        if limits:
+            res.update(limits)
+            logger.info('Query limits: {}'.format(limits))
 
-def _get_subgraph(graph, source_prop, rdf_class=None):
-    subgraph = Graph()
+        if self.manifest is not None:
+            res['reused'] = self.reused
+            logger.info('Reused the results of {} unchanged subjects from manifest {}'
+                    .format(self.reused, self.manifest.path))
 
-    if rdf_class:
-        # Filter out subjects that are not of the given type
-        for s in graph.subjects(RDF.type, rdf_class):
-            subgraph += graph.triples((s, source_prop, None))
-    else:
-        subgraph += graph.triples((None, source_prop, None))
+        if self.checkpoint is not None:
+            self.checkpoint.flush()
+            res['resumed'] = self.resumed
+            logger.info('Resumed {} results from checkpoint {}'
+                    .format(self.resumed, self.checkpoint.path))
 
-    return subgraph
+        return res
 
 
 def arpafy(graph, target_prop, arpa, source_prop=None, rdf_class=None,
             output_graph=None, preprocessor=None, validator=None,
-            candidates_only=False, progress=None):
+            candidates_only=False, progress=None, workers=None, batch_size=None,
+            checkpoint=None, shard=None, manifest=None,
+            validation_window=DEFAULT_VALIDATION_WINDOW):
     """
     Link a property to resources using ARPA. Modify the graph in place,
     unless `output_graph` is given.
 
     Return a dict with the amount of processed triples (processed), the resulting graph (graph),
-    match count (matches) and errors encountered (errors).
+    match count (matches) and errors encountered (errors). The statistics returned by
+    `arpa.Arpa.get_stats` for this run are included as well (e.g. requests and http_time),
+    as are the seconds spent selecting the subjects (selection_time), preprocessing
+    (preprocessing_time), adding the results to the output graph (write_time) and in total
+    (arpafy_time),
+    as are the current limits returned by `arpa.Arpa.get_limits` (concurrency_limit and rate_limit).
+    If `checkpoint` is given, the number of results replayed from it is included (resumed),
+    and if `manifest` is given, the number of results reused from it (reused).
 
     `graph` is the graph to link (will be modified unless `output_graph` is defined.
 
@@ -593,76 +3108,181 @@ def arpafy(graph, target_prop, arpa, source_prop=None, rdf_class=None,
 
     `validator` is an object with a `validate` method that takes the ARPA results, query text, and the processed
     subject as parameters, and returns a subset of the results (that have been validated based on the subject,
-    graph and results). Optional.
+    graph and results). The validator can also implement a `validate_batch` method for validating the results
+    of multiple subjects at once, see `arpa.Arpa.get_uri_matches_batch`. Optional.
 
     If `candidates_only` is set, get candidates (n-grams) only from ARPA.
 
     If `progress` is `True`, show a progress bar. Requires pyprind.
+
+    `workers` is the number of threads used for querying ARPA concurrently.
+    The graph is only modified in the calling thread, and the results are
+    handled in the same order as in a serial run, so the output is the same.
+    The `validator` has to be thread-safe if `workers` is greater than 1.
+    Optional, by default the queries are run serially.
+
+    If `batch_size` is set, query the texts of up to `batch_size` subjects at a time
+    with `arpa.Arpa.get_uri_matches_batch` (or `arpa.Arpa.get_candidates_batch`).
+    Optional.
+
+    `checkpoint` is an `arpa.Checkpoint` where the results are journaled as they are
+    received. The subjects already journaled in it are not queried, and their journaled
+    results are added instead. Optional.
+
+    `shard` is a tuple (index, count). If given, only process the subjects in shard
+    `index` of `count` (see `arpa.get_shard`). Optional.
+
+    `validation_window` is the number of subjects whose results are validated together if
+    the `validator` implements `validate_batch`. The texts of the subjects are still queried
+    one at a time (by `workers` threads), and the results are validated as they come in,
+    unless `batch_size` is set, in which case the results of each batch are validated
+    together instead. Default is `arpa.DEFAULT_VALIDATION_WINDOW`.
+
+    `manifest` is an `arpa.Manifest` of a previous run. Only the subjects whose preprocessed
+    source text is new or has changed since that run are queried, the previous results of
+    the rest are added instead, and the results of this run are added to the manifest.
+    The subjects resumed from `checkpoint` are not added to it. Optional.
     """
 
     if source_prop is None:
         source_prop = SKOS['prefLabel']
     if output_graph is None:
         output_graph = graph
-    if candidates_only:
-        get_results = arpa.get_candidates
+    get_results, get_batch_results = _get_result_functions(arpa, candidates_only, batch_size)
+    validation_window = _get_validation_window(arpa, candidates_only, batch_size, validator,
+            validation_window)
+
+    subgraph = _SubjectView(graph, source_prop, rdf_class, shard)
+
+    bar = get_bar(len(subgraph) if progress else 0, progress)
+    collector = _ResultCollector(output_graph, target_prop, arpa, checkpoint, manifest)
+
+    def get_items():
+        pairs = subgraph.subject_objects()
+        while True:
+            with collector.stats.timer('selection_time'):
+                pair = next(pairs, None)
+            if pair is None:
+                return
+            s, o = pair
+            if collector.resume(s, o):
+                bar.update()
+                continue
+            text = o
+            if preprocessor:
+                with collector.stats.timer('preprocessing_time'):
+                    text = preprocessor(o, s, graph)
+            if collector.reuse(s, o, text):
+                bar.update()
+                continue
+            yield s, text
+
+    if validation_window:
+        results = _iter_validated_results(arpa, get_items(), validator, workers,
+                validation_window)
     else:
-        get_results = arpa.get_uri_matches
+        results = _iter_results(get_results, get_items(), validator, workers,
+                get_batch_results, batch_size)
 
-    subgraph = _get_subgraph(graph, source_prop, rdf_class)
+    for s, result_dict in results:
+        collector.add(s, result_dict)
+        bar.update()
 
-    triple_match_count = 0
-    subject_match_count = 0
-    pre_validation_mention_count = 0
-    post_validation_mention_count = 0
-    errors = []
+    return collector.get_result_dict()
 
-    bar = get_bar(len(subgraph), progress)
 
-    for s, o in subgraph.subject_objects():
-        o = preprocessor(o, s, graph) if preprocessor else o
+async def _get_results_safe_async(get_results, text, s, validator, semaphore):
+    """
+    Coroutine version of `arpa._get_results_safe`. Limit concurrency with `semaphore`.
+    """
+
+    async with semaphore:
         try:
-            result_dict = get_results(o, s, validator=validator)
+            return await get_results(text, s, validator=validator)
         except (HTTPError, ValueError) as e:
             logger.exception('Error getting matches from ARPA')
-            errors.append(e)
-        else:
-            results = result_dict['results']
-            triple_match_count += len(results)
-            pre_validation_mention_count += len(result_dict.get('pre_validation_mentions', []))
-            if results:
-                subject_match_count += 1
-                post_validation_mention_count += len(result_dict.get('mentions', []))
-                # Add each result as a value of the target property
-                for result in results:
-                    output_graph.add((s, target_prop, result))
-        bar.update()
+            return e
 
-    res = {
-        'graph': output_graph,
-        'processed': len(subgraph),
-        'matches': triple_match_count,
-        'subjects_matched': subject_match_count,
-        'pre_validation_mention_count': pre_validation_mention_count,
-        'post_validation_mention_count': post_validation_mention_count,
-        'errors': errors
-    }
 
-    logger.info('Processed {} triples, found {} matches from {} mentions'
-                ' with {} total mentions ({} errors)'
-                .format(res['processed'], res['matches'], res['post_validation_mention_count'],
-                    res['pre_validation_mention_count'], len(res['errors'])))
+async def arpafy_async(graph, target_prop, arpa, source_prop=None, rdf_class=None,
+            output_graph=None, preprocessor=None, validator=None,
+            candidates_only=False, progress=None, concurrency=100, checkpoint=None,
+            manifest=None):
+    """
+    Coroutine version of `arpa.arpafy` that uses an `arpa.AsyncArpa` instance.
+
+    Return a dict as described in `arpa.arpafy`.
 
-    return res
+    `arpa` is the `arpa.AsyncArpa` (or `arpa.AsyncArpaMimic`) instance.
+    Its HTTP session is closed when done.
+
+    `concurrency` is the maximum number of queries in flight at the same time.
+    Default is 100.
+
+    For the other parameters, see `arpa.arpafy`. The results are handled in the same
+    order as in `arpa.arpafy`, so the output is the same.
+    """
+
+    if concurrency < 1:
+        raise ValueError('Concurrency has to be at least 1, got {}'.format(concurrency))
+
+    if source_prop is None:
+        source_prop = SKOS['prefLabel']
+    if output_graph is None:
+        output_graph = graph
+    if candidates_only:
+        get_results = arpa.get_candidates
+    else:
+        get_results = arpa.get_uri_matches
+
+    subgraph = _SubjectView(graph, source_prop, rdf_class)
+
+    bar = get_bar(len(subgraph) if progress else 0, progress)
+    collector = _ResultCollector(output_graph, target_prop, arpa, checkpoint, manifest)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    max_pending = concurrency * 4
+    pending = deque()
+
+    async def handle_next():
+        s, task = pending.popleft()
+        collector.add(s, await task)
+        bar.update()
+
+    async with arpa:
+        try:
+            for s, o in subgraph.subject_objects():
+                if collector.resume(s, o):
+                    bar.update()
+                    continue
+                text = o
+                if preprocessor:
+                    with collector.stats.timer('preprocessing_time'):
+                        text = preprocessor(o, s, graph)
+                if collector.reuse(s, o, text):
+                    bar.update()
+                    continue
+                pending.append((s, asyncio.ensure_future(
+                    _get_results_safe_async(get_results, text, s, validator, semaphore))))
+                if len(pending) >= max_pending:
+                    await handle_next()
+            while pending:
+                await handle_next()
+        finally:
+            for s, task in pending:
+                task.cancel()
+
+    return collector.get_result_dict()
 
 
 def prune_candidates(graph, source_prop, pruner, rdf_class=None,
-            output_graph=None, progress=None):
+            output_graph=None, progress=None, cache_size=DEFAULT_PRUNE_CACHE_SIZE):
     """
     Prune undesired candidates.
 
     Return a dict with the amount of candidates left after pruning (result_count),
-    and the resulting graph (graph).
+    the resulting graph (graph), and the hits and misses of the pruner cache
+    (pruner_cache_hits, pruner_cache_misses).
 
     `graph` is the graph containing the candidates. Will be modified if `output_graph`
     is not given.
@@ -678,7 +3298,14 @@ def prune_candidates(graph, source_prop, pruner, rdf_class=None,
 
     `output_graph` is the graph to which the results should be added.
     If not given, the results will be added to the input `graph`,
-    and the old candidates removed.
+    and the old candidates removed (except those left unchanged by `pruner`).
+    The graph is modified after all the candidates have been pruned.
+
+    `cache_size` is the maximum number of candidates whose pruning results are cached,
+    so that `pruner` is called only once for each distinct candidate (as long as it stays
+    in the cache). `pruner` has to return the same result for the same candidate.
+    Set to 0 to call `pruner` for every candidate.
+    Default is `arpa.DEFAULT_PRUNE_CACHE_SIZE`.
     """
 
     logger.info('Pruning candidates')
@@ -686,27 +3313,51 @@ def prune_candidates(graph, source_prop, pruner, rdf_class=None,
     if output_graph is None:
         output_graph = graph
 
-    subgraph = _get_subgraph(graph, source_prop, rdf_class)
+    subgraph = _SubjectView(graph, source_prop, rdf_class)
 
-    bar = get_bar(len(subgraph), progress)
+    bar = get_bar(len(subgraph) if progress else 0, progress)
 
-    result_count = 0
+    def prune(candidate):
+        result = pruner(candidate)
+        return Literal(result) if result else None
 
+    if cache_size:
+        prune = lru_cache(maxsize=cache_size)(prune)
+
+    in_place = output_graph is graph
+    result_count = 0
+    removed = []
+    added = []
     for s, o in subgraph.subject_objects():
-        result = pruner(str(o))
-        # Remove the original candidate
-        output_graph.remove((s, source_prop, o))
-        if result:
+        result = prune(str(o))
+        if result is not None:
             result_count += 1
-            # Add the pruned candidate to the output graph
-            output_graph.add((s, source_prop, Literal(result)))
+        # Unchanged candidates are left as is when pruning in place
+        if not in_place or result != o:
+            removed.append((s, source_prop, o))
+            if result is not None:
+                added.append((s, source_prop, result, output_graph))
         bar.update()
 
+    # Remove the original candidates
+    if in_place or len(output_graph):
+        for triple in removed:
+            output_graph.remove(triple)
+
+    # Add the pruned candidates to the output graph
+    output_graph.addN(added)
+
     res = {
         'graph': output_graph,
         'result_count': result_count
     }
 
+    if cache_size:
+        cache_info = prune.cache_info()
+        res['pruner_cache_hits'] = cache_info.hits
+        res['pruner_cache_misses'] = cache_info.misses
+        logger.info('Pruner cache hits: {}, misses: {}'.format(cache_info.hits, cache_info.misses))
+
     logger.info('Candidate pruning complete')
 
     return res
@@ -758,6 +3409,12 @@ def parse_args(args):
         help="Terms that should be ignored even if matched")
     argparser.add_argument("--min_ngram", default=1, metavar="N", type=int,
         help="The minimum ngram length that is considered a match. Default is 1.")
+    argparser.add_argument("--local_candidates", action="store_true",
+        help="""Generate the candidates (n-grams) in process instead of querying them
+        from ARPA. Only has an effect with --candidates_only.""")
+    argparser.add_argument("--max_ngram", metavar="N", type=int,
+        help="""The maximum length of the candidates generated with --local_candidates.
+        Not limited by default.""")
     argparser.add_argument("--no_duplicates", nargs="*", default=False, metavar="TYPE",
         help="""Remove duplicate matches based on the 'label' returned by the ARPA service.
         Here 'duplicate' means a subject with the same label as another subject in
@@ -771,6 +3428,69 @@ def parse_args(args):
     argparser.add_argument("-w", "--wait", default=1, metavar="N", type=int,
         help="""The number of seconds to wait between retries. Only has an effect if number
         of retries is set. Default is 1 second.""")
+    argparser.add_argument("--backoff", default=1, metavar="FACTOR", type=float,
+        help="""The factor by which the wait time is multiplied after each retry.
+        Default is 1 (constant wait time).""")
+    argparser.add_argument("--max_wait", metavar="SECONDS", type=float,
+        help="The maximum number of seconds to wait between retries. Not limited by default.")
+    argparser.add_argument("--jitter", default=0, metavar="FRACTION", type=float,
+        help="The fraction (0-1) of the wait time that is randomly subtracted from it. Default is 0.")
+    argparser.add_argument("--breaker_threshold", metavar="N", type=int,
+        help="""Pause all queries after N consecutive failed queries (circuit breaker).
+        Not used by default.""")
+    argparser.add_argument("--breaker_timeout", default=30, metavar="SECONDS", type=float,
+        help="The number of seconds the queries are paused by the circuit breaker. Default is 30.")
+    argparser.add_argument("--workers", default=1, metavar="N", type=int,
+        help="The number of concurrent queries to the ARPA service. Default is 1.")
+    argparser.add_argument("--adaptive", action="store_true",
+        help="""Adapt the number of concurrent queries between 1 and --workers based on
+        the errors and latency of the responses.""")
+    argparser.add_argument("--max_rate", metavar="N", type=float,
+        help="The maximum number of queries per second. Not limited by default.")
+    argparser.add_argument("--processes", default=1, metavar="N", type=int,
+        help="""The number of processes the subjects are split between. Each process
+        runs (and with --adaptive, adapts) --workers concurrent queries, and --max_rate
+        is divided between the processes. Can not be used with --stream, --checkpoint,
+        --manifest, --breaker_threshold or --cache. Default is 1.""")
+    argparser.add_argument("--batch_size", metavar="N", type=int,
+        help="""Query the texts of up to N subjects in a single request when possible.
+        Batching is not used by default.""")
+    argparser.add_argument("--batch_bytes", metavar="N", type=int,
+        help="The maximum size of a batch query in bytes. Not limited by default.")
+    argparser.add_argument("--validation_window", default=DEFAULT_VALIDATION_WINDOW, metavar="N",
+        type=int, help="""The number of subjects whose results are validated together,
+        if the validator supports it. Default is {}.""".format(DEFAULT_VALIDATION_WINDOW))
+    argparser.add_argument("--stream", action="store_true",
+        help="""Process the input file line by line instead of loading it into memory.
+        The input format has to be N-Triples or N-Quads, and the output is written
+        in the same format.""")
+    argparser.add_argument("--stream_links", action="store_true",
+        help="""With --new_graph, write each link to the output file as N-Triples as soon
+        as it is found, instead of collecting the links into a graph and serializing it at
+        the end. The output is N-Triples regardless of --fo.""")
+    argparser.add_argument("--cache", metavar="FILE",
+        help="""Cache the ARPA service responses in the given SQLite database file,
+        and use the cached responses when available.""")
+    argparser.add_argument("--cache_size", metavar="N", type=int,
+        help="The maximum number of cached responses. Not limited by default.")
+    argparser.add_argument("--cache_ttl", metavar="SECONDS", type=float,
+        help="The number of seconds after which a cached response expires. Never by default.")
+    argparser.add_argument("--checkpoint", metavar="FILE",
+        help="""Journal the results in the given file as they are received, so that
+        an interrupted run can be resumed with --resume.""")
+    argparser.add_argument("--checkpoint_interval", default=100, metavar="N", type=int,
+        help="""The number of results after which the checkpoint journal is flushed to disk.
+        Default is 100.""")
+    argparser.add_argument("--resume", action="store_true",
+        help="""Resume an interrupted run from the --checkpoint journal: the journaled
+        subjects are not queried again, and their results are added to the output as is.""")
+    argparser.add_argument("--manifest", metavar="FILE",
+        help="""Link incrementally: only query the subjects whose source text is new or
+        has changed since the previous run with the same manifest file, and reuse the
+        previous results of the rest. The manifest is updated when the run completes.""")
+    argparser.add_argument("--report", metavar="FILE",
+        help="""Write a JSON report of the run with the time spent in each phase and
+        the number of requests, retries and bytes transferred.""")
     argparser.add_argument("--log_level", default="INFO",
         choices=["NOTSET", "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
         help="Logging level, default is INFO.")
@@ -790,6 +3510,47 @@ def parse_args(args):
 
     args.tprop = URIRef(args.tprop)
 
+    if args.workers < 1:
+        argparser.error('The number of workers has to be at least 1')
+
+    if args.max_rate is not None and args.max_rate <= 0:
+        argparser.error('The maximum query rate has to be positive')
+
+    if args.backoff < 1:
+        argparser.error('The backoff factor has to be at least 1')
+
+    if not 0 <= args.jitter <= 1:
+        argparser.error('The jitter has to be between 0 and 1')
+
+    if args.breaker_threshold is not None and args.breaker_threshold < 1:
+        argparser.error('The circuit breaker threshold has to be at least 1')
+
+    if args.batch_size is not None and args.batch_size < 1:
+        argparser.error('The batch size has to be at least 1')
+
+    if args.validation_window < 1:
+        argparser.error('The validation window has to be at least 1')
+
+    if args.max_ngram is not None and args.max_ngram < max(args.min_ngram, 1):
+        argparser.error('The maximum ngram length has to be at least the minimum ngram length')
+
+    if args.resume and not args.checkpoint:
+        argparser.error('--resume requires --checkpoint')
+
+    if args.stream_links and not args.new_graph:
+        argparser.error('--stream_links requires --new_graph')
+
+    if args.processes < 1:
+        argparser.error('The number of processes has to be at least 1')
+
+    if args.processes > 1 and (args.stream or args.checkpoint or args.manifest
+            or args.breaker_threshold or args.cache):
+        argparser.error('--processes can not be used with --stream, --checkpoint, --manifest,'
+                ' --breaker_threshold or --cache')
+
+    if args.checkpoint_interval < 1:
+        argparser.error('The checkpoint interval has to be at least 1')
+
     if args.no_duplicates == []:
         args.no_duplicates = True
 
@@ -803,6 +3564,15 @@ def combine_values(values):
     return '"' + '" "'.join(values) + '"'
 
 
+_VALUE_RE = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+
+def split_values(text):
+    """Split a string combined with `arpa.combine_values` back into a list of values."""
+
+    return [v.replace('\\"', '"') for v in _VALUE_RE.findall(str(text))]
+
+
 def combine_candidates(graph, prop, output_graph=None, rdf_class=None, progress=None):
     """
     Combine each subject's candidates into a single string.
@@ -822,18 +3592,18 @@ def combine_candidates(graph, prop, output_graph=None, rdf_class=None, progress=
     If `progress` is set, display a progress bar.
     """
 
-    subgraph = _get_subgraph(graph, prop, rdf_class)
+    subgraph = _SubjectView(graph, prop, rdf_class)
 
     logger.info('Combining candidates')
 
     if output_graph is None:
         output_graph = graph
 
-    subjects = subgraph.subjects()
-    bar = get_bar(len(subgraph), progress)
+    subjects = list(subgraph.subjects())
+    bar = get_bar(len(subjects), progress)
 
     for s in subjects:
-        combined = combine_values(subgraph.objects(s))
+        combined = combine_values(list(subgraph.objects(s)))
         # Remove the original candidate
         output_graph.remove((s, None, None))
         output_graph.add((s, prop, Literal(combined)))
@@ -844,8 +3614,101 @@ def combine_candidates(graph, prop, output_graph=None, rdf_class=None, progress=
     return output_graph
 
 
+_shard_args = None
+"""The arguments of `arpa._arpafy_shard`, inherited by the worker processes."""
+
+
+def _arpafy_shard(index):
+    """
+    Run `arpa.arpafy` for shard `index` in a worker process of `arpa._arpafy_processes`.
+    Return the results dict with the output triples as a list instead of a graph.
+    """
+
+    graph, target_prop, arpa, count, kwargs = _shard_args
+
+    reconnect = getattr(arpa, '_reconnect', None)
+    if reconnect:
+        reconnect()
+    share_limits = getattr(arpa, '_share_limits', None)
+    if share_limits:
+        share_limits(count)
+
+    output_graph = Graph()
+    res = arpafy(graph, target_prop, arpa, output_graph=output_graph, shard=(index, count),
+            **kwargs)
+    res['graph'] = list(output_graph)
+    return res
+
+
+_SHARD_LIMIT_KEYS = ('concurrency_limit', 'rate_limit')
+
+
+def _arpafy_processes(graph, target_prop, arpa, processes, output_graph=None,
+        checkpoint=None, **kwargs):
+    """
+    Run `arpa.arpafy` in `processes` worker processes, each processing the subjects
+    of one shard (see `arpa.get_shard`), and add the results to `output_graph`.
+
+    The worker processes are forked, so that they share the graph, `arpa` and the validator
+    with the calling process. The results are added in the order of the shards, and the
+    counts and times of the shards are summed.
+
+    Each worker process gets a copy of the `arpa.Throttle` of `arpa`, with the rate limit
+    divided between the processes. The concurrency limit applies to each process.
+    A circuit breaker or an `arpa.QueryCache` can not be shared between the processes,
+    so they can not be used.
+
+    Return the results dict as described in `arpa.arpafy`.
+    """
+
+    global _shard_args
+
+    if checkpoint is not None or kwargs.get('manifest') is not None:
+        raise ValueError('A checkpoint or a manifest can not be used with multiple processes')
+    if getattr(arpa, '_circuit_breaker', None) is not None:
+        raise ValueError('A circuit breaker can not be shared by multiple processes')
+    if getattr(arpa, '_cache', None) is not None:
+        raise ValueError('A query cache can not be shared by multiple processes')
+    if output_graph is None:
+        output_graph = graph
+
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:
+        raise ValueError('Multiple processes require the fork start method, '
+                'which is not available on this platform')
+
+    logger.info('Running arpafy in {} processes'.format(processes))
+
+    start_time = _perf_counter()
+    _shard_args = (graph, target_prop, arpa, processes, kwargs)
+    try:
+        with context.Pool(processes) as pool:
+            shard_results = pool.map(_arpafy_shard, range(processes))
+    finally:
+        _shard_args = None
+
+    res = {'graph': output_graph, 'errors': []}
+    merge_start = _perf_counter()
+    for shard_res in shard_results:
+        output_graph.addN((s, p, o, output_graph) for s, p, o in shard_res.pop('graph'))
+        res['errors'].extend(shard_res.pop('errors'))
+        for key, value in shard_res.items():
+            if key not in _SHARD_LIMIT_KEYS:
+                res[key] = res.get(key, 0) + value
+    res['merge_time'] = _perf_counter() - merge_start
+    res['arpafy_time'] = _perf_counter() - start_time
+    res['processes'] = processes
+
+    logger.info('Processed {} triples in {} processes, found {} matches ({} errors)'
+            .format(res['processed'], processes, res['matches'], len(res['errors'])))
+
+    return res
+
+
 def process_graph(graph, target_prop=None, arpa=None, new_graph=False, prune=False, join_candidates=False,
-        run_arpafy=True, source_prop=None, rdf_class=None, pruner=None, progress=None, **kwargs):
+        run_arpafy=True, source_prop=None, rdf_class=None, pruner=None, progress=None,
+        processes=None, output_graph=None, **kwargs):
     """
     Convenience function for running different tasks related to linking.
 
@@ -857,7 +3720,9 @@ def process_graph(graph, target_prop=None, arpa=None, new_graph=False, prune=Fal
     `arpa` is the `arpa.Arpa` class instance.
     Used only if `run_arpafy` is True.
 
-    If `new_graph` is set, use a new empty graph for adding the results.
+    If `new_graph` is set, use a new empty graph for adding the results, or `output_graph`
+    if given. `output_graph` can also be a graph-like sink, such as an `arpa.LinkWriter`,
+    if only `arpa.arpafy` is run.
 
     If `prune` is set, prune candidates using `arpa.prune_candidates`.
 
@@ -873,37 +3738,57 @@ def process_graph(graph, target_prop=None, arpa=None, new_graph=False, prune=Fal
 
     If `progress` is `True`, show a progress bar. Requires pyprind.
 
+    If `processes` is greater than 1, run `arpa.arpafy` in that many worker processes,
+    each processing the subjects of one shard (split by subject hash, see `arpa.get_shard`).
+    The worker processes are forked, so this is only available on platforms that support
+    the fork start method, and a checkpoint, a manifest, a circuit breaker or a query cache
+    can not be used.
+    The rate limit of the `arpa.Throttle` of `arpa` is divided between the processes, but the
+    concurrency limit (and its adaptation) applies to each process separately. The results are
+    merged in the order of the shards, so the output is the same as in a single process run.
+    No progress bar is shown for the processes. Optional.
+
     All other arguments are passed to `arpa.arpafy` (if run).
 
-    Return the results dict as returned by `arpa.arpafy`.
+    Return the results dict as returned by `arpa.arpafy` (or `arpa.prune_candidates`),
+    with the total runtime in seconds (runtime) and the seconds spent pruning (prune_time)
+    and combining candidates (join_time), if run.
     """
 
     if new_graph:
         logger.debug('Output to new graph')
-        output_graph = Graph()
-        output_graph.namespace_manager = graph.namespace_manager
+        if output_graph is None:
+            output_graph = Graph()
+            output_graph.namespace_manager = graph.namespace_manager
     else:
         output_graph = graph
 
     logger.info('Begin processing')
     start_time = time.monotonic()
+    stats = Stats()
 
     if prune:
         logger.info('Prune candidates')
-        res = prune_candidates(graph, source_prop, pruner,
-                rdf_class=rdf_class, output_graph=output_graph,
-                progress=progress)
+        with stats.timer('prune_time'):
+            res = prune_candidates(graph, source_prop, pruner,
+                    rdf_class=rdf_class, output_graph=output_graph,
+                    progress=progress)
         graph = res['graph']
 
     if join_candidates:
         logger.debug('Combine candidates')
-        output_graph = combine_candidates(graph, source_prop,
-                output_graph=output_graph, rdf_class=rdf_class,
-                progress=progress)
+        with stats.timer('join_time'):
+            output_graph = combine_candidates(graph, source_prop,
+                    output_graph=output_graph, rdf_class=rdf_class,
+                    progress=progress)
         graph = output_graph
         res = {'graph': output_graph}
 
-    if run_arpafy:
+    if run_arpafy and processes and processes > 1:
+        logger.info('Start arpafy')
+        res = _arpafy_processes(graph, target_prop, arpa, processes, source_prop=source_prop,
+                rdf_class=rdf_class, output_graph=output_graph, **kwargs)
+    elif run_arpafy:
         logger.info('Start arpafy')
         res = arpafy(graph, target_prop=target_prop, arpa=arpa, source_prop=source_prop, rdf_class=rdf_class,
                 output_graph=output_graph, progress=progress, **kwargs)
@@ -912,11 +3797,14 @@ def process_graph(graph, target_prop=None, arpa=None, new_graph=False, prune=Fal
     logger.info('Processing complete, runtime {}'.
             format(timedelta(seconds=(end_time - start_time))))
 
+    res.update(stats.as_dict())
+    res['runtime'] = end_time - start_time
+
     return res
 
 
 def process(input_file, input_format, output_file, output_format, *args,
-        validator_class=None, **kwargs):
+        validator_class=None, stream=False, report_file=None, stream_links=False, **kwargs):
     """
     Parse the given input file, run `arpa.arpafy`, and serialize the resulting
     graph on disk.
@@ -933,30 +3821,379 @@ def process(input_file, input_format, output_file, output_format, *args,
     a `validate` method. See `arpa.arpafy` for more information.
     This overrides any validator object given as the `arpa.arpafy` `validator` parameter.
 
-    All other arguments are passed to `arpa.process_graph`.
+    If `stream` is set, process the file line by line with `arpa.process_stream`
+    instead of loading it into memory. The input format has to be line-based,
+    and `validator_class` and multiple `processes` can not be used.
+
+    `report_file` is the name of a file where the results dict is written as JSON,
+    without the graph and with the errors as strings. Optional.
+
+    If `stream_links` is set, write the links to the output file as N-Triples with an
+    `arpa.LinkWriter` as soon as they are found, instead of serializing the output graph
+    at the end. `output_format` is ignored, and 'graph' in the results dict is the
+    `arpa.LinkWriter`. Requires `new_graph`, and only linking is supported. Has no effect
+    if `stream` is set, as the output is streamed anyway.
+
+    All other arguments are passed to `arpa.process_graph` (or `arpa.process_stream`).
 
-    Return the results dict as returned by `arpa.arpafy`.
+    Return the results dict as returned by `arpa.process_graph`, with the seconds spent
+    parsing (parse_time) and serializing (serialization_time) added.
     """
 
+    if stream:
+        if validator_class:
+            raise ValueError('A validator class can not be used when streaming')
+        if (kwargs.pop('processes', None) or 1) > 1:
+            raise ValueError('Multiple processes can not be used when streaming')
+        res = process_stream(input_file, input_format, output_file, output_format,
+                *args, **kwargs)
+        _log_timings(res, report_file)
+        return res
+
+    if stream_links and (not kwargs.get('new_graph') or kwargs.get('prune')
+            or kwargs.get('join_candidates') or not kwargs.get('run_arpafy', True)):
+        raise ValueError('Streaming the links requires new_graph, and only linking is supported')
+
+    start_time = _perf_counter()
     g = Graph()
     logger.info('Parsing file {}'.format(input_file))
     g.parse(input_file, format=input_format)
     logger.info('Parsing complete')
+    parse_time = _perf_counter() - start_time
 
     if validator_class:
         kwargs['validator'] = validator_class(g)
 
-    res = process_graph(g, *args, **kwargs)
+    writer = None
+    if stream_links:
+        writer = kwargs['output_graph'] = LinkWriter(output_file)
+
+    try:
+        res = process_graph(g, *args, **kwargs)
+    finally:
+        if writer is not None:
+            writer.close()
 
     output_graph = res['graph']
 
-    logger.info('Serializing graph as {}'.format(output_file))
-    output_graph.serialize(destination=output_file, format=output_format)
-    logger.info('Serialization complete')
+    start_time = _perf_counter()
+    if writer is not None:
+        logger.info('Wrote {} links to {} ({} duplicates skipped)'
+                .format(writer.written, output_file, writer.duplicates))
+    else:
+        logger.info('Serializing graph as {}'.format(output_file))
+        output_graph.serialize(destination=output_file, format=output_format)
+        logger.info('Serialization complete')
+
+    res['parse_time'] = parse_time
+    res['serialization_time'] = _perf_counter() - start_time
+
+    _log_timings(res, report_file)
+
+    return res
+
+
+def _log_timings(res, report_file=None):
+    """
+    Log the phase timings and the request counts in the results dict `res`,
+    and write `res` as JSON to `report_file`, if given.
+    """
+
+    timings = ', '.join('{} {:.3f}s'.format(key[:-len('_time')], value)
+            for key, value in sorted(res.items()) if key.endswith('_time'))
+    logger.info('Timings: {}'.format(timings))
+    if 'requests' in res:
+        logger.info('Requests: {}, retries: {}, bytes sent: {}, bytes received: {}'.format(
+            res['requests'], res.get('retries', 0), res['bytes_sent'], res['bytes_received']))
+
+    if report_file:
+        report = {key: value for key, value in res.items() if key not in ('graph', 'errors')}
+        report['errors'] = [str(e) for e in res.get('errors', [])]
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        logger.info('Wrote run report to {}'.format(report_file))
+
+
+def _nt_term(term):
+    """Return the N-Triples representation of an rdflib term."""
+
+    if isinstance(term, Literal):
+        value = (str(term).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n').replace('\r', '\\r'))
+        if term.language:
+            return '"{}"@{}'.format(value, term.language)
+        if term.datatype:
+            return '"{}"^^<{}>'.format(value, term.datatype)
+        return '"{}"'.format(value)
+    return term.n3()
+
+
+class _NTriplesWriter:
+    """
+    Graph-like sink that writes added triples to a file as N-Triples lines.
+    """
+
+    def __init__(self, f):
+        self.file = f
+
+    def add(self, triple):
+        self.file.write('{} {} {} .\n'.format(*(_nt_term(t) for t in triple)))
+
+
+class LinkWriter:
+    """
+    Append-only, graph-like sink that writes the added triples to an N-Triples file
+    as they are added, skipping duplicates. The lines are written in chunks of
+    `buffer_size` lines, so the file has all but the last chunk of triples even if
+    the run is interrupted.
+
+    Only a hash of each written triple is kept in memory for removing the duplicates.
+    Can be used as the output graph of `arpa.arpafy` and `arpa.process_graph`,
+    see `arpa.process`.
+    """
+
+    def __init__(self, path, buffer_size=1000, remove_duplicates=True):
+        """
+        Open the output file `path` for writing. An existing file is overwritten.
+
+        `buffer_size` is the number of lines written to the file at a time. Default is 1000.
+
+        If `remove_duplicates` is unset, every added triple is written.
+        """
+
+        if buffer_size < 1:
+            raise ValueError('The buffer size has to be at least 1, got {}'.format(buffer_size))
+
+        self.path = path
+        self.buffer_size = buffer_size
+        self.written = 0
+        self.duplicates = 0
+        self._seen = set() if remove_duplicates else None
+        self._buffer = []
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def __len__(self):
+        """Return the number of triples written (or buffered)."""
+
+        return self.written
+
+    def add(self, triple):
+        """Write the triple `triple`, unless it has been written already."""
+
+        line = '{} {} {} .\n'.format(*(_nt_term(t) for t in triple))
+        if self._seen is not None:
+            key = hashlib.blake2b(line.encode(), digest_size=16).digest()
+            if key in self._seen:
+                self.duplicates += 1
+                return
+            self._seen.add(key)
+
+        self._buffer.append(line)
+        self.written += 1
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def addN(self, quads):
+        """Write the triples of the (subject, predicate, object, graph) tuples in `quads`."""
+
+        for s, p, o, _ in quads:
+            self.add((s, p, o))
+
+    def flush(self):
+        """Write the buffered lines to the file."""
+
+        if self._buffer:
+            self._file.write(''.join(self._buffer))
+            self._buffer = []
+        self._file.flush()
+
+    def close(self):
+        """Write the buffered lines and close the file."""
+
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _LineParser:
+    """
+    Parse single N-Triples or N-Quads lines into triples.
+    The graph of a quad is ignored.
+    """
+
+    _GRAPH_RE = re.compile(r'\s+(<[^<>\s]*>|_:\S+)\s*\.\s*$')
+
+    def __init__(self):
+        self._parser = NTriplesParser(self)
+        self._triple = None
+
+    def triple(self, s, p, o, *args):
+        self._triple = (s, p, o)
+
+    def parse(self, line):
+        """
+        Return the triple on `line`. Blank node subjects keep their label.
+        Raise a ParseError if the line is not a valid triple or quad.
+        """
+
+        try:
+            self._parser.parsestring(line)
+        except ParseError:
+            # Probably a quad, remove the graph
+            self._parser.parsestring(self._GRAPH_RE.sub(' .', line))
+        s, p, o = self._triple
+        subject_token = line.split(None, 1)[0]
+        if subject_token.startswith('_:'):
+            s = BNode(subject_token[2:])
+        return s, p, o
+
+
+def _get_stream_class_subjects(input_file, rdf_class):
+    """
+    Return the set of the N-Triples representations of the subjects that have
+    the type `rdf_class` in the line-based RDF file `input_file`.
+    """
+
+    type_token = _nt_term(RDF.type)
+    class_token = _nt_term(rdf_class)
+    subjects = set()
+    with open(input_file, encoding='utf-8') as f:
+        for line in f:
+            parts = line.split(None, 3)
+            if len(parts) > 2 and parts[1] == type_token and parts[2] == class_token:
+                subjects.add(parts[0])
+    return subjects
+
+
+def process_stream(input_file, input_format, output_file, output_format=None,
+        target_prop=None, arpa=None, new_graph=False, prune=False, join_candidates=False,
+        run_arpafy=True, source_prop=None, rdf_class=None, progress=None,
+        preprocessor=None, validator=None, candidates_only=False, workers=None,
+        batch_size=None, checkpoint=None, manifest=None,
+        validation_window=DEFAULT_VALIDATION_WINDOW):
+    """
+    Link a line-based RDF file (N-Triples or N-Quads) without loading it into memory.
+
+    The input file is read line by line, the subjects with the `source_prop`
+    property (and the type `rdf_class`, if given) are linked as in `arpa.arpafy`,
+    and the input triples (unless `new_graph` is set) and the new `target_prop`
+    triples are written to the output file as they are processed.
+
+    Return a dict as described in `arpa.arpafy`, except that 'graph' is `None`.
+
+    `input_format` has to be one of `arpa.LINE_FORMATS`. The output file is written in
+    the same format, so `output_format` is ignored. With N-Quads, the new triples are
+    added to the default graph.
+
+    If `rdf_class` is given, the input file is read twice, and the subjects
+    of the given type are kept in memory.
+
+    Only linking is supported, i.e. `prune` and `join_candidates` have to be unset,
+    and `run_arpafy` set. The `preprocessor` receives `None` as the graph.
+    A progress bar is not supported.
+
+    For the other parameters, see `arpa.arpafy`.
+    """
+
+    if input_format not in LINE_FORMATS:
+        raise ValueError('Streaming requires a line-based input format ({}), got {}'
+                .format(', '.join(LINE_FORMATS), input_format))
+    if prune or join_candidates or not run_arpafy:
+        raise ValueError('Only linking is supported when streaming')
+    if output_format and output_format != input_format:
+        logger.warning('Writing the output as {} instead of {}'.format(input_format, output_format))
+
+    if source_prop is None:
+        source_prop = SKOS['prefLabel']
+
+    get_results, get_batch_results = _get_result_functions(arpa, candidates_only, batch_size)
+    validation_window = _get_validation_window(arpa, candidates_only, batch_size, validator,
+            validation_window)
+
+    class_subjects = None
+    if rdf_class:
+        logger.info('Finding subjects of type {} in {}'.format(rdf_class, input_file))
+        class_subjects = _get_stream_class_subjects(input_file, rdf_class)
+
+    source_token = _nt_term(source_prop)
+    parser = _LineParser()
+
+    logger.info('Streaming {} to {}'.format(input_file, output_file))
+
+    with open(input_file, encoding='utf-8') as f, \
+            open(output_file, 'w', encoding='utf-8') as out:
+
+        def get_items():
+            for line in f:
+                if not new_graph:
+                    out.write(line if line.endswith('\n') else line + '\n')
+                parts = line.split(None, 2)
+                if len(parts) < 3 or parts[1] != source_token:
+                    continue
+                if class_subjects is not None and parts[0] not in class_subjects:
+                    continue
+                s, p, o = parser.parse(line)
+                if collector.resume(s, o):
+                    continue
+                text = o
+                if preprocessor:
+                    with collector.stats.timer('preprocessing_time'):
+                        text = preprocessor(o, s, None)
+                if collector.reuse(s, o, text):
+                    continue
+                yield s, text
+
+        collector = _ResultCollector(_NTriplesWriter(out), target_prop, arpa, checkpoint,
+                manifest)
+
+        if validation_window:
+            results = _iter_validated_results(arpa, get_items(), validator, workers,
+                    validation_window)
+        else:
+            results = _iter_results(get_results, get_items(), validator, workers,
+                    get_batch_results, batch_size)
+
+        for s, result_dict in results:
+            collector.add(s, result_dict)
+
+    logger.info('Streaming complete')
+
+    res = collector.get_result_dict()
+    res['graph'] = None
 
     return res
 
 
+def get_candidate_generator(args):
+    """
+    Return the `arpa.CandidateGenerator` configured by the parsed command line `args`,
+    or `None` if the candidates are not generated in process.
+    """
+
+    if not args.local_candidates:
+        return None
+    return CandidateGenerator(max(args.min_ngram, 1), args.max_ngram)
+
+
+_MANIFEST_CONFIG_ARGS = ('arpa', 'candidates_only', 'ignore', 'min_ngram', 'local_candidates',
+        'max_ngram', 'no_duplicates')
+
+
+def get_manifest_config(args):
+    """
+    Return the configuration of the parsed command line `args` that affects the results,
+    as a dict for `arpa.Manifest`.
+    """
+
+    return {key: getattr(args, key) for key in _MANIFEST_CONFIG_ARGS}
+
+
 def main(args):
     """
     Main function for running via the command line.
@@ -968,12 +4205,37 @@ def main(args):
 
     log_to_file(args.log_file, args.log_level)
 
-    arpa = Arpa(args.arpa, args.no_duplicates, args.min_ngram, args.ignore, args.retries)
+    cache = QueryCache(args.cache, args.cache_size, args.cache_ttl) if args.cache else None
+
+    circuit_breaker = (CircuitBreaker(args.breaker_threshold, args.breaker_timeout)
+            if args.breaker_threshold else None)
+
+    throttle = (Throttle(args.workers if args.adaptive else None, rate=args.max_rate)
+            if args.adaptive or args.max_rate else None)
+
+    arpa = Arpa(args.arpa, args.no_duplicates, args.min_ngram, args.ignore, args.retries,
+            args.wait, pool_maxsize=max(DEFAULT_POOL_SIZE, args.workers), cache=cache,
+            max_batch_bytes=args.batch_bytes, backoff=args.backoff, max_wait=args.max_wait,
+            jitter=args.jitter, circuit_breaker=circuit_breaker, throttle=throttle,
+            candidate_generator=get_candidate_generator(args))
+
+    checkpoint = (Checkpoint(args.checkpoint, args.resume, args.checkpoint_interval)
+            if args.checkpoint else None)
+
+    manifest = Manifest(args.manifest, get_manifest_config(args)) if args.manifest else None
 
     # Query the ARPA service, add the matches and serialize graph to disk
-    process(args.input, args.fi, args.output, args.fo, target_prop=args.tprop,
-            arpa=arpa, source_prop=args.prop, rdf_class=args.rdf_class,
-            new_graph=args.new_graph, progress=True, candidates_only=args.candidates_only)
+    with manifest or nullcontext():
+        process(args.input, args.fi, args.output, args.fo, target_prop=args.tprop,
+                arpa=arpa, source_prop=args.prop, rdf_class=args.rdf_class,
+                new_graph=args.new_graph, progress=True, candidates_only=args.candidates_only,
+                workers=args.workers, batch_size=args.batch_size, stream=args.stream,
+                checkpoint=checkpoint, report_file=args.report, processes=args.processes,
+                stream_links=args.stream_links, manifest=manifest,
+                validation_window=args.validation_window)
+
+    if checkpoint:
+        checkpoint.close()
 
     logging.shutdown()
 
@@ -0,0 +1,927 @@
+"""
+Benchmarks for the ARPA linker.
+
+Run from this directory:
+
+`$ python3 benchmarks.py BENCHMARK [options]`
+
+See `python3 benchmarks.py -h` for the available benchmarks.
+"""
+
+import sys
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import tracemalloc
+import threading
+import time
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from rdflib import Graph, URIRef, Literal
+from rdflib.namespace import RDF, SKOS
+from arpa import Arpa, ArpaMimic, CandidateGenerator, ResultMapper, post, process, combine_values, split_values, \
+    split_graph, prune_candidates, get_bar, _get_value, _nt_term, _SubjectView, _Truncated, LABEL_PROP, \
+    TYPE_PROP
+
+EMPTY_RESULT = {'locale': 'fi', 'results': []}
+
+
+class LocalServer:
+    """
+    A local HTTP/1.1 server that responds to every POST request with the same JSON.
+
+    `response` is the response body as a dict.
+    """
+
+    def __init__(self, response=EMPTY_RESULT):
+        body = json.dumps(response).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeArpaServer:
+    """
+    A local HTTP/1.1 stand-in for an ARPA service and a SPARQL endpoint.
+
+    A request with a 'text' parameter is answered like ARPA: with `result_size` matches
+    from the words of the text, or with the n-grams of the text if '?cgen' is in the URL.
+    A request with a 'query' parameter is answered like a SPARQL endpoint queried by
+    `arpa.ArpaMimic`: with `result_size` result rows per quoted value in the query.
+
+    Every response is delayed by `latency` seconds, and a `error_rate` fraction
+    of the requests get a 503 response instead.
+    """
+
+    def __init__(self, latency=0, error_rate=0, result_size=2, seed=0):
+        server = self
+        rnd = random.Random(seed)
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                params = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                        .decode())
+                with lock:
+                    server.requests += 1
+                    fail = rnd.random() < error_rate
+                if latency:
+                    time.sleep(latency)
+
+                if fail:
+                    body = b''
+                    self.send_response(503)
+                else:
+                    if 'query' in params:
+                        response = server.sparql_response(params['query'][0])
+                    else:
+                        response = server.arpa_response(params['text'][0], '?cgen' in self.path)
+                    body = json.dumps(response).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.result_size = result_size
+        self.requests = 0
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    def arpa_response(self, text, candidates):
+        words = text.split()
+        if candidates:
+            ngrams = [' '.join(words[i:i + n]) for n in (1, 2) for i in range(len(words) - n + 1)]
+            return {'locale': 'fi', 'results': {ngram: [ngram] for ngram in ngrams}}
+        results = [{
+            'id': 'http://ldf.fi/places/{}_{}'.format(word, i),
+            'label': word,
+            'matches': [word],
+            'properties': {'type': ['<http://ldf.fi/schema/Place>']},
+        } for word in words[:self.result_size] for i in range(self.result_size)]
+        return {'locale': 'fi', 'results': results}
+
+    def sparql_response(self, query):
+        bindings = [{
+            'id': {'type': 'uri', 'value': 'http://ldf.fi/places/{}_{}'.format(value, i)},
+            'ngram': {'type': 'literal', 'value': value},
+            'label': {'type': 'literal', 'value': value},
+        } for value in split_values(query) for i in range(self.result_size)]
+        return {'head': {'vars': ['id', 'ngram', 'label']}, 'results': {'bindings': bindings}}
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def timed(f, *args, **kwargs):
+    """Call `f` and return the elapsed time in seconds."""
+
+    start = time.perf_counter()
+    f(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def traced(f, *args, **kwargs):
+    """Call `f` and return the elapsed time in seconds and the peak traced memory in bytes."""
+
+    tracemalloc.start()
+    try:
+        elapsed = timed(f, *args, **kwargs)
+        return elapsed, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def write_ntriples(path, n, triples_per_subject=5):
+    """
+    Write a synthetic N-Triples file with `n` subjects, each having a skos:prefLabel
+    and `triples_per_subject` - 1 other triples.
+    """
+
+    with open(path, 'w') as f:
+        for i in range(n):
+            s = '<http://ldf.fi/events/event_{}>'.format(i)
+            f.write('{} <http://www.w3.org/2004/02/skos/core#prefLabel> "Tapahtuma {}"@fi .\n'
+                    .format(s, i))
+            for j in range(triples_per_subject - 1):
+                f.write('{} <http://ldf.fi/schema/p{}> "Arvo {} {}" .\n'.format(s, j, i, j))
+
+
+PLACE_NAMES = ['Hanko', 'Helsinki', 'Viipuri', 'Kuhmo', 'Suomussalmi', 'Tolvajärvi', 'Summa',
+        'Taipale', 'Kollaa', 'Salla', 'Petsamo', 'Lemetti', 'Raate', 'Kitelä', 'Ilomantsi']
+
+SOURCE_PROP = SKOS.prefLabel
+CANDIDATE_PROP = URIRef('http://ldf.fi/schema/candidate')
+TARGET_PROP = URIRef('http://ldf.fi/schema/place')
+
+
+def write_linking_input(path, n, words=4, seed=0):
+    """
+    Write a synthetic N-Triples file for linking with `n` subjects.
+
+    Each subject has a text of `words` place names and other words as its
+    skos:prefLabel, the place names of the text as separate candidates, and
+    a few other triples.
+    """
+
+    rnd = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(n):
+            s = '<http://ldf.fi/events/event_{}>'.format(i)
+            places = rnd.sample(PLACE_NAMES, words)
+            text = ' '.join('{} ja'.format(place) for place in places)
+            f.write('{} {} {} .\n'.format(s, _nt_term(SOURCE_PROP), _nt_term(Literal(text))))
+            for place in places:
+                f.write('{} {} {} .\n'.format(s, _nt_term(CANDIDATE_PROP), _nt_term(Literal(place))))
+            f.write('{} <http://ldf.fi/schema/date> "1940-01-{:02}" .\n'.format(s, i % 28 + 1))
+            f.write('{} {} <http://ldf.fi/schema/Event> .\n'.format(s, _nt_term(RDF.type)))
+
+
+def write_joined_input(path, n, words=4, seed=0):
+    """
+    Write a synthetic N-Triples file with `n` subjects, each with their candidates
+    joined into a single value, as the input of the 'disambiguate' stage.
+    """
+
+    rnd = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(n):
+            s = '<http://ldf.fi/events/event_{}>'.format(i)
+            combined = combine_values(rnd.sample(PLACE_NAMES, words))
+            f.write('{} {} {} .\n'.format(s, _nt_term(CANDIDATE_PROP), _nt_term(Literal(combined))))
+
+
+def percentile(values, p):
+    """Return the `p`th percentile (0-100) of `values` by the nearest rank."""
+
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def get_peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def report(name, n, elapsed, unit='requests'):
+    print('{:<30} {:>8} {} in {:>8.3f} s, {:>10.1f} {}/s'.format(
+        name, n, unit, elapsed, n / elapsed, unit))
+
+
+def bench_pooling(args):
+    """Compare requests per second with and without connection pooling."""
+
+    def run(n, session=None):
+        for i in range(n):
+            post(server.url, {'text': 'Hanko {}'.format(i)}, session=session)
+
+    with LocalServer() as server:
+        # Warm up
+        run(10)
+
+        report('new connection per request', args.n, timed(run, args.n))
+
+        with Arpa(server.url) as arpa:
+            report('pooled session', args.n, timed(run, args.n, session=arpa._session))
+
+
+def make_bindings(n, rows_per_id=2):
+    """Generate `n` SPARQL result bindings with `n / rows_per_id` distinct ids."""
+
+    return [{
+        'id': {'type': 'uri', 'value': 'http://ldf.fi/warsa/actors/person_{}'.format(i // rows_per_id)},
+        'ngram': {'type': 'literal', 'value': 'ngram {}'.format(i % rows_per_id)},
+        'label': {'type': 'literal', 'value': 'Person {}'.format(i // rows_per_id)},
+        'rank': {'type': 'literal', 'value': 'rank {}'.format(i)},
+    } for i in range(n)]
+
+
+def map_results_quadratic(results):
+    """The previous list-based implementation of `arpa.map_results`, for comparison."""
+
+    res = []
+    for obj in results['results']['bindings']:
+        o_id = obj['id']['value']
+
+        idx = next((index for (index, d) in enumerate(res) if d['id'] == o_id), None)
+        if idx is None:
+            props = {key: [_get_value(value)] for key, value in obj.items()}
+            o = {
+                'id': o_id,
+                'label': obj.get('label', {}).get('value', ''),
+                'matches': [obj.get('ngram', {}).get('value', '')],
+                'properties': props
+            }
+            res.append(o)
+        else:
+            o = res[idx]
+            ngram = obj.get('ngram', {}).get('value', '')
+            if ngram not in o['matches']:
+                o['matches'].append(ngram)
+            for k, v in obj.items():
+                p = o.get('properties').get(k, None)
+                if p:
+                    p.append(_get_value(v))
+                else:
+                    o['properties'][k] = [_get_value(v)]
+
+    return {'results': res}
+
+
+def bench_map_results(args):
+    """Compare the scaling of SPARQL result mapping by result size."""
+
+    def map_linear(results):
+        mapper = ResultMapper()
+        mapper.add_all(results['results']['bindings'])
+        return mapper.get_results()
+
+    for n in args.sizes:
+        results = {'results': {'bindings': make_bindings(n, args.rows_per_id)}}
+        assert map_linear(results) == map_results_quadratic(results)
+        report('list-based (previous)', n, timed(map_results_quadratic, results), 'rows')
+        report('dict-indexed', n, timed(map_linear, results), 'rows')
+
+
+def bench_candidates(args):
+    """Compare getting candidates from the service and generating them in process."""
+
+    rng = random.Random(0)
+    texts = [' '.join(rng.choice(PLACE_NAMES) for _ in range(args.words)) for _ in range(args.n)]
+    generator = CandidateGenerator(max_length=args.max_ngram)
+    # The service responds with the candidates of the first text to every query
+    response = {'locale': 'fi', 'results': {c: [c] for c in generator(texts[0])}}
+
+    def run(arpa):
+        for text in texts:
+            arpa.get_candidates(text)
+
+    with LocalServer(response) as server:
+        with Arpa(server.url) as arpa:
+            run(arpa)
+            report('service (?cgen)', args.n, timed(run, arpa), 'texts')
+        with Arpa(server.url, candidate_generator=generator) as arpa:
+            report('in process', args.n, timed(run, arpa), 'texts')
+
+
+def read_place_types():
+    """Read the preferred place types from the example arg file arpa.args."""
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'arpa.args')) as f:
+        lines = [line.strip() for line in f]
+    start = lines.index('--no_duplicates') + 1
+    return [line for line in lines[start:] if line.startswith('http')]
+
+
+def remove_duplicates_quadratic(no_duplicates, res):
+    """
+    The previous implementation of prioritized duplicate removal in
+    `arpa.Arpa._remove_duplicates`, for comparison.
+    """
+
+    items = {}
+    for x in res:
+        x_label = x[LABEL_PROP].lower()
+        prev_match_types = items.get(x_label, {}).get('properties', {}).get(TYPE_PROP, [])
+        prev_pref = set(prev_match_types).intersection(set(no_duplicates))
+        try:
+            prev_idx = min([no_duplicates.index(t) for t in prev_pref])
+        except ValueError:
+            prev_idx = float('inf')
+        pref = set(x['properties'][TYPE_PROP]).intersection(no_duplicates)
+        try:
+            idx = min([no_duplicates.index(t) for t in pref])
+        except ValueError:
+            idx = float('inf')
+
+        if (not prev_match_types) or idx < prev_idx:
+            items[x_label] = x
+
+    return [x for x in res if x in items.values()]
+
+
+def bench_duplicates(args):
+    """Compare prioritized duplicate removal with many same-label matches."""
+
+    place_types = read_place_types()
+    types = ['<{}>'.format(t) for t in place_types] + ['<http://ldf.fi/other_type>']
+    rnd = random.Random(0)
+    arpa = Arpa('http://url', remove_duplicates=place_types)
+
+    for n in args.sizes:
+        entries = [{
+            'id': 'http://ldf.fi/places/{}'.format(i),
+            LABEL_PROP: 'Label {}'.format(i % args.labels),
+            'properties': {TYPE_PROP: [rnd.choice(types)]},
+        } for i in range(n)]
+
+        assert (arpa._remove_duplicates(entries)
+                == remove_duplicates_quadratic(arpa._no_duplicates, entries))
+        report('set and index based (previous)', n,
+                timed(remove_duplicates_quadratic, arpa._no_duplicates, entries), 'matches')
+        report('precomputed ranks', n, timed(arpa._remove_duplicates, entries), 'matches')
+
+
+def prune_candidates_per_triple(graph, source_prop, pruner, rdf_class=None,
+            output_graph=None, progress=None):
+    """
+    The previous implementation of `arpa.prune_candidates` that calls the pruner and
+    modifies the graph for each candidate, for comparison.
+    """
+
+    if output_graph is None:
+        output_graph = graph
+
+    subgraph = _SubjectView(graph, source_prop, rdf_class)
+
+    bar = get_bar(len(subgraph) if progress else 0, progress)
+
+    result_count = 0
+
+    pairs = subgraph.subject_objects()
+    if output_graph is graph:
+        # The graph is modified while iterating
+        pairs = list(pairs)
+
+    for s, o in pairs:
+        result = pruner(str(o))
+        # Remove the original candidate
+        output_graph.remove((s, source_prop, o))
+        if result:
+            result_count += 1
+            # Add the pruned candidate to the output graph
+            output_graph.add((s, source_prop, Literal(result)))
+        bar.update()
+
+    return {'graph': output_graph, 'result_count': result_count}
+
+
+STOP_WORDS = frozenset(['ja', 'tai', 'sekä', 'kylä', 'joki', 'järvi'])
+
+
+def prune_place(candidate):
+    """A pruner that drops stop word candidates, and removes the stop words from the rest."""
+
+    words = candidate.split()
+    kept = [w for w in words if w.lower() not in STOP_WORDS]
+    if len(kept) == len(words):
+        return candidate
+    if len(kept) < 2:
+        return None
+    return ' '.join(kept)
+
+
+def bench_prune(args):
+    """Compare pruning with a memoized pruner and bulk graph updates to the per-triple version."""
+
+    rnd = random.Random(0)
+    # The pruner leaves the place names as is, and changes or drops the rest
+    changed_names = ['{} {}'.format(a, b) for a in PLACE_NAMES for b in STOP_WORDS] + list(STOP_WORDS)
+    graph = Graph()
+    for i in range(args.n):
+        s = URIRef('http://ldf.fi/events/event_{}'.format(i))
+        for j in range(args.candidates):
+            names = changed_names if rnd.random() < args.changed else PLACE_NAMES
+            graph.add((s, CANDIDATE_PROP, Literal('{} {}'.format(rnd.choice(names), j))))
+        graph.add((s, RDF.type, URIRef('http://ldf.fi/schema/Event')))
+    n = len(graph) - args.n
+
+    for name, f in (('per triple (previous)', prune_candidates_per_triple),
+            ('memoized and bulk', prune_candidates)):
+        g = Graph()
+        g += graph
+        elapsed = timed(f, g, CANDIDATE_PROP, prune_place)
+        report(name, n, elapsed, 'candidates')
+        del g
+
+    for rdf_class in (None, URIRef('http://ldf.fi/schema/Event')):
+        expected, g = Graph(), Graph()
+        expected += graph
+        g += graph
+        prune_candidates_per_triple(expected, CANDIDATE_PROP, prune_place, rdf_class)
+        res = prune_candidates(g, CANDIDATE_PROP, prune_place, rdf_class)
+        assert set(g) == set(expected)
+
+    hits, misses = res['pruner_cache_hits'], res['pruner_cache_misses']
+    print('Pruner cache hits: {}, misses: {} (hit rate {:.1%})'
+            .format(hits, misses, hits / (hits + misses)))
+
+
+def bench_stream(args):
+    """Compare the peak memory of in-memory and streaming processing by input size."""
+
+    target = 'http://ldf.fi/schema/place'
+    with LocalServer() as server, tempfile.TemporaryDirectory() as tmp_dir:
+        input_file = os.path.join(tmp_dir, 'input.nt')
+        output_file = os.path.join(tmp_dir, 'output.nt')
+        for n in args.sizes:
+            write_ntriples(input_file, n)
+            for name, stream in (('in-memory', False), ('streaming', True)):
+                with Arpa(server.url, pool_maxsize=args.workers) as arpa:
+                    elapsed, peak = traced(process, input_file, 'nt', output_file, 'nt',
+                            target_prop=target, arpa=arpa, workers=args.workers, stream=stream)
+                report(name, n, elapsed, 'subjects')
+                print('{:<30} peak memory {:>8.1f} MiB'.format('', peak / 2 ** 20))
+
+
+def make_arpa_result(n):
+    """Generate an ARPA result with `n` matches."""
+
+    return {'locale': 'fi', 'results': [{
+        'id': 'http://ldf.fi/warsa/places/municipalities/m_place_{}'.format(i),
+        'label': 'Place {}'.format(i),
+        'matches': ['Place {}'.format(i)],
+        'properties': {'type': ['<http://ldf.fi/warsa/places/place_types/Kunta>']},
+    } for i in range(n)]}
+
+
+class FakeResponse:
+    """A successful response to every request, without any network traffic."""
+
+    status_code = 200
+
+    def __init__(self, result):
+        self._result = result
+        self.content = json.dumps(result).encode()
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._result
+
+
+class FakeSession:
+    def __init__(self, result):
+        self._response = FakeResponse(result)
+
+    def post(self, *args, **kwargs):
+        return self._response
+
+    def close(self):
+        pass
+
+
+class FormattingHandler(logging.Handler):
+    """A handler that formats every record like a file handler would, but discards it."""
+
+    def emit(self, record):
+        self.format(record)
+
+
+def log_eager(logger, url, text, data, res):
+    """The previous eagerly formatted log calls of a single query, for comparison."""
+
+    logger.info('Getting URI matches: {}'.format(text))
+    logger.debug('Query ARPA at {} with text {}'.format(url, text))
+    logger.debug('Sending request to {} with data: {}'.format(url, data))
+    logger.debug('Success, received: {}'.format(res))
+    logger.info('Found matches {}'.format(res))
+
+
+def log_lazy(logger, url, text, data, res):
+    """The lazily formatted, truncated log calls of a single query."""
+
+    logger.info('Getting URI matches: %s', _Truncated(text))
+    logger.debug('Query ARPA at %s with text %s', url, _Truncated(text))
+    logger.debug('Sending request to %s with data: %s', url, _Truncated(data))
+    logger.debug('Success, received: %s', _Truncated(res))
+    logger.info('Found matches %s', _Truncated(res))
+
+
+def bench_logging(args):
+    """Compare the per-query cost of eager and lazy logging by log level and result size."""
+
+    logger = logging.getLogger('arpa')
+    handler = FormattingHandler()
+    logger.addHandler(handler)
+    logger.propagate = False
+    url = 'http://localhost/arpa'
+
+    print('{:<8} {:>8} {:>14} {:>14} {:>14}'.format(
+        'level', 'matches', 'eager us/q', 'lazy us/q', 'query us/q'))
+    try:
+        for level in args.levels:
+            logger.setLevel(level)
+            for n in args.sizes:
+                res = make_arpa_result(n)
+                text = ' '.join(match['label'] for match in res['results'])
+                data = {'text': text}
+
+                eager = timed(lambda: [log_eager(logger, url, text, data, res)
+                    for _ in range(args.n)])
+                lazy = timed(lambda: [log_lazy(logger, url, text, data, res)
+                    for _ in range(args.n)])
+
+                arpa = Arpa(url)
+                arpa._session = FakeSession(res)
+                query = timed(lambda: [arpa.get_uri_matches(text) for _ in range(args.n)])
+
+                print('{:<8} {:>8} {:>14.1f} {:>14.1f} {:>14.1f}'.format(level, n,
+                    eager / args.n * 1e6, lazy / args.n * 1e6, query / args.n * 1e6))
+    finally:
+        logger.removeHandler(handler)
+        logger.propagate = True
+
+
+def get_subgraph_copy(graph, source_prop, rdf_class=None):
+    """The previous subject selection that copied the triples into a new graph, for comparison."""
+
+    subgraph = Graph()
+
+    if rdf_class:
+        for s in graph.subjects(RDF.type, rdf_class):
+            subgraph += graph.triples((s, source_prop, None))
+    else:
+        subgraph += graph.triples((None, source_prop, None))
+
+    return subgraph
+
+
+def make_graph(n, triples_per_subject=5):
+    """Generate a graph with `n` subjects, every other of which is an instance of a class."""
+
+    event_class = URIRef('http://ldf.fi/schema/Event')
+    g = Graph()
+    for i in range(n):
+        s = URIRef('http://ldf.fi/events/event_{}'.format(i))
+        g.add((s, SKOS.prefLabel, Literal('Tapahtuma {}'.format(i), lang='fi')))
+        if i % 2:
+            g.add((s, RDF.type, event_class))
+        for j in range(triples_per_subject - 2):
+            g.add((s, URIRef('http://ldf.fi/schema/p{}'.format(j)), Literal('Arvo {}'.format(j))))
+    return g, event_class
+
+
+def bench_subjects(args):
+    """Compare subject selection by copying to a new graph and by a lazy view."""
+
+    def select(f, graph, rdf_class):
+        subgraph = f(graph, SKOS.prefLabel, rdf_class)
+        len(subgraph)
+        for pair in subgraph.subject_objects():
+            pass
+
+    for n in args.sizes:
+        graph, event_class = make_graph(n)
+        for rdf_class in (None, event_class):
+            suffix = ' (rdf_class)' if rdf_class else ''
+            for name, f in (('copy to graph', get_subgraph_copy), ('lazy view', _SubjectView)):
+                elapsed, peak = traced(select, f, graph, rdf_class)
+                report(name + suffix, n, elapsed, 'subjects')
+                print('{:<30} peak memory {:>8.1f} MiB'.format('', peak / 2 ** 20))
+
+
+class LatencyRecorder:
+    """Mixin for `arpa.Arpa` classes that records the duration of each query in `latencies`."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def _post(self, url, data):
+        start = time.perf_counter()
+        try:
+            return super()._post(url, data)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+class RecordingArpa(LatencyRecorder, Arpa):
+    pass
+
+
+class RecordingArpaMimic(LatencyRecorder, ArpaMimic):
+    pass
+
+
+MIMIC_QUERY = """
+PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+SELECT ?id ?label ?ngram {
+    VALUES ?ngram { <VALUES> }
+    ?id skos:prefLabel ?label .
+    FILTER(LCASE(STR(?label)) = LCASE(?ngram))
+}
+"""
+
+
+def run_mode(mode, input_file, output_file, url, workers, batch_size, retries):
+    """
+    Run a linking stage like `link_helper.process_stage` does, in the current process.
+    Return a dict of the processed subject count, elapsed time, query latencies, errors
+    and peak RSS.
+    """
+
+    # rdflib warns about the default encoding of N-Triples output
+    warnings.simplefilter('ignore', UserWarning)
+    # Hide the logged query errors
+    logging.getLogger('arpa').setLevel(logging.CRITICAL)
+
+    start = time.perf_counter()
+    arpa_kwargs = dict(retries=retries, wait_between_tries=0.01, pool_maxsize=max(10, workers))
+    kwargs = dict(new_graph=True, workers=workers, batch_size=batch_size)
+    arpa = None
+
+    if mode in ('raw', 'candidates_only'):
+        arpa = RecordingArpa(url, **arpa_kwargs)
+        res = process(input_file, 'nt', output_file, 'nt', TARGET_PROP, arpa,
+                source_prop=SOURCE_PROP, candidates_only=mode == 'candidates_only', **kwargs)
+    elif mode == 'disambiguate':
+        arpa = RecordingArpaMimic(MIMIC_QUERY, url, **arpa_kwargs)
+        res = process(input_file, 'nt', output_file, 'nt', TARGET_PROP, arpa,
+                source_prop=CANDIDATE_PROP, **kwargs)
+    elif mode == 'prune':
+        res = process(input_file, 'nt', output_file, 'nt', TARGET_PROP, prune=True,
+                pruner=lambda c: c if c[0].isupper() else None, source_prop=CANDIDATE_PROP,
+                run_arpafy=False)
+    elif mode == 'join':
+        res = process(input_file, 'nt', output_file, 'nt', TARGET_PROP, join_candidates=True,
+                source_prop=CANDIDATE_PROP, run_arpafy=False, new_graph=True)
+
+    elapsed = time.perf_counter() - start
+    if 'processed' not in res:
+        res['processed'] = len(set(res['graph'].subjects(CANDIDATE_PROP)))
+
+    return {
+        'processed': res['processed'],
+        'elapsed': elapsed,
+        'errors': len(res.get('errors', [])),
+        'latencies': arpa.latencies if arpa else [],
+        'peak_rss': get_peak_rss(),
+    }
+
+
+THROUGHPUT_MODES = ('raw', 'candidates_only', 'disambiguate', 'prune', 'join')
+
+
+def bench_throughput(args):
+    """
+    Measure the end-to-end throughput of each linking stage against a fake ARPA server.
+    """
+
+    # Each run in a new process, so that the peak RSS is that of the run
+    context = multiprocessing.get_context('spawn')
+
+    print('{:<16} {:>8} {:>10} {:>12} {:>9} {:>9} {:>9} {:>7} {:>9}'.format('mode', 'subjects',
+        'seconds', 'subjects/s', 'p50 ms', 'p99 ms', 'requests', 'errors', 'RSS MiB'))
+
+    with FakeArpaServer(args.latency, args.error_rate, args.result_size) as server, \
+            tempfile.TemporaryDirectory() as tmp_dir:
+        input_file = os.path.join(tmp_dir, 'input.nt')
+        joined_file = os.path.join(tmp_dir, 'joined.nt')
+        output_file = os.path.join(tmp_dir, 'output.nt')
+        write_linking_input(input_file, args.n, args.words)
+        write_joined_input(joined_file, args.n, args.words)
+
+        for mode in args.modes:
+            requests = server.requests
+            with context.Pool(1) as pool:
+                res = pool.apply(run_mode, (mode, joined_file if mode == 'disambiguate'
+                    else input_file, output_file, server.url, args.workers, args.batch_size,
+                    args.retries))
+
+            elapsed = res['elapsed']
+            latencies = res['latencies']
+            print('{:<16} {:>8} {:>10.3f} {:>12.1f} {:>9.2f} {:>9.2f} {:>9} {:>7} {:>9.1f}'.format(
+                mode, res['processed'], elapsed, res['processed'] / elapsed,
+                percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+                server.requests - requests, res['errors'], res['peak_rss'] / 2 ** 20))
+
+
+def split_file(input_file, output_file, count):
+    """Split `input_file` like the shard stage of `link_helper.process_stage` does."""
+
+    graph = Graph()
+    graph.parse(input_file, format='nt')
+    output_files = []
+    for i, part in enumerate(split_graph(graph, count, SOURCE_PROP)):
+        output_files.append(output_file.format(i))
+        part.serialize(destination=output_files[-1], format='nt', encoding='utf-8')
+    return output_files
+
+
+def merge_files(input_files, output_file):
+    """Merge `input_files` like the merge stage of `link_helper.process_stage` does."""
+
+    graph = Graph()
+    for input_file in input_files:
+        graph.parse(input_file, format='nt')
+    graph.serialize(destination=output_file, format='nt', encoding='utf-8')
+    return graph
+
+
+def bench_shards(args):
+    """
+    Measure how a linking job scales when it is split into shards that are linked in
+    parallel, as on separate machines, and merged.
+    """
+
+    context = multiprocessing.get_context('spawn')
+
+    print('{:>6} {:>8} {:>9} {:>9} {:>9} {:>9} {:>12} {:>8}'.format('shards', 'subjects',
+        'split s', 'link s', 'merge s', 'total s', 'subjects/s', 'speedup'))
+
+    with FakeArpaServer(args.latency) as server, tempfile.TemporaryDirectory() as tmp_dir:
+        input_file = os.path.join(tmp_dir, 'input.nt')
+        write_linking_input(input_file, args.n, args.words)
+        expected = None
+        baseline = None
+
+        for count in args.counts:
+            start = time.perf_counter()
+            parts = split_file(input_file, os.path.join(tmp_dir, 'part_{}.nt'), count)
+            split_time = time.perf_counter() - start
+
+            outputs = [os.path.join(tmp_dir, 'output_{}.nt'.format(i)) for i in range(count)]
+            with context.Pool(count) as pool:
+                results = pool.starmap(run_mode, [('raw', part, output, server.url,
+                    args.workers, None, 3) for part, output in zip(parts, outputs)])
+            # The shards run in parallel, excluding the process startup
+            link_time = max(res['elapsed'] for res in results)
+
+            start = time.perf_counter()
+            merged = merge_files(outputs, os.path.join(tmp_dir, 'merged.nt'))
+            merge_time = time.perf_counter() - start
+
+            if expected is None:
+                expected = set(merged)
+            assert set(merged) == expected, 'The merged output differs'
+
+            processed = sum(res['processed'] for res in results)
+            total = split_time + link_time + merge_time
+            baseline = baseline or total
+            print('{:>6} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>12.1f} {:>8.2f}'.format(
+                count, processed, split_time, link_time, merge_time, total, processed / total,
+                baseline / total))
+
+
+BENCHMARKS = {
+    'pooling': (bench_pooling, [
+        (('-n',), {'type': int, 'default': 2000, 'help': 'Number of requests'}),
+    ]),
+    'map_results': (bench_map_results, [
+        (('--sizes',), {'type': int, 'nargs': '+', 'default': [100, 1000, 10000, 20000],
+            'help': 'Numbers of result rows'}),
+        (('--rows_per_id',), {'type': int, 'default': 2, 'help': 'Result rows per id'}),
+    ]),
+    'candidates': (bench_candidates, [
+        (('-n',), {'type': int, 'default': 2000, 'help': 'Number of texts'}),
+        (('--words',), {'type': int, 'default': 8, 'help': 'Words per text'}),
+        (('--max_ngram',), {'type': int, 'default': 4, 'help': 'Maximum candidate length'}),
+    ]),
+    'duplicates': (bench_duplicates, [
+        (('--sizes',), {'type': int, 'nargs': '+', 'default': [1000, 10000],
+            'help': 'Numbers of matches'}),
+        (('--labels',), {'type': int, 'default': 500, 'help': 'Number of distinct labels'}),
+    ]),
+    'prune': (bench_prune, [
+        (('-n',), {'type': int, 'default': 10000, 'help': 'Number of subjects'}),
+        (('--candidates',), {'type': int, 'default': 10, 'help': 'Candidates per subject'}),
+        (('--changed',), {'type': float, 'default': 0.2,
+            'help': 'Fraction of the candidates that the pruner changes or drops'}),
+    ]),
+    'subjects': (bench_subjects, [
+        (('--sizes',), {'type': int, 'nargs': '+', 'default': [10000, 50000],
+            'help': 'Numbers of subjects'}),
+    ]),
+    'logging': (bench_logging, [
+        (('-n',), {'type': int, 'default': 1000, 'help': 'Number of queries'}),
+        (('--sizes',), {'type': int, 'nargs': '+', 'default': [10, 100, 1000],
+            'help': 'Numbers of matches per query'}),
+        (('--levels',), {'nargs': '+', 'default': ['WARNING', 'INFO', 'DEBUG'],
+            'help': 'The log levels to compare'}),
+    ]),
+    'throughput': (bench_throughput, [
+        (('-n',), {'type': int, 'default': 2000, 'help': 'Number of subjects'}),
+        (('--modes',), {'nargs': '+', 'choices': THROUGHPUT_MODES, 'default': THROUGHPUT_MODES,
+            'help': 'The linking stages to run'}),
+        (('--words',), {'type': int, 'default': 4, 'help': 'Place names per text'}),
+        (('--latency',), {'type': float, 'default': 0.005,
+            'help': 'Response latency of the fake server in seconds'}),
+        (('--error_rate',), {'type': float, 'default': 0,
+            'help': 'Fraction of requests that fail with 503'}),
+        (('--result_size',), {'type': int, 'default': 2,
+            'help': 'Matches per word (ARPA) or value (SPARQL) in the responses'}),
+        (('--workers',), {'type': int, 'default': 8, 'help': 'Number of workers'}),
+        (('--batch_size',), {'type': int, 'help': 'Batch size, no batching by default'}),
+        (('--retries',), {'type': int, 'default': 3, 'help': 'Retries per query'}),
+    ]),
+    'shards': (bench_shards, [
+        (('-n',), {'type': int, 'default': 1000, 'help': 'Number of subjects'}),
+        (('--counts',), {'type': int, 'nargs': '+', 'default': [1, 2, 4, 8],
+            'help': 'Numbers of shards'}),
+        (('--words',), {'type': int, 'default': 4, 'help': 'Place names per text'}),
+        (('--latency',), {'type': float, 'default': 0.05,
+            'help': 'Response latency of the fake server in seconds'}),
+        (('--workers',), {'type': int, 'default': 4, 'help': 'Number of workers per shard'}),
+    ]),
+    'stream': (bench_stream, [
+        (('--sizes',), {'type': int, 'nargs': '+', 'default': [500, 2000],
+            'help': 'Numbers of subjects'}),
+        (('--workers',), {'type': int, 'default': 8, 'help': 'Number of workers'}),
+    ]),
+}
+
+
+def main(argv):
+    argparser = argparse.ArgumentParser(description='Run ARPA linker benchmarks.')
+    subparsers = argparser.add_subparsers(dest='benchmark', required=True)
+    for name, (f, arguments) in BENCHMARKS.items():
+        subparser = subparsers.add_parser(name, help=f.__doc__)
+        for flags, kwargs in arguments:
+            subparser.add_argument(*flags, **kwargs)
+        subparser.set_defaults(func=f)
+
+    args = argparser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,4 +1,12 @@
-from arpa_linker.arpa import Arpa, ArpaMimic, process, log_to_file, parse_args
+from arpa_linker.arpa import Arpa, ArpaMimic, QueryCache, Checkpoint, Manifest, CircuitBreaker, \
+    Throttle, process, process_graph, split_graph, log_to_file, parse_args, \
+    get_candidate_generator, get_manifest_config, DEFAULT_POOL_SIZE
+from contextlib import nullcontext
+from rdflib import Graph, URIRef
+from rdflib.util import guess_format
+import argparse
+import json
+import shlex
 import time
 import logging
 
@@ -9,71 +17,420 @@ def init_log(name, level, file_prefix=''):
     log_to_file('{}{}_{}.log'.format(file_prefix, name, time.strftime('%Y%m%d_%H%M%S')), level)
 
 
-def process_stage(argv, ignore=None, validator_class=None, preprocessor=None, pruner=None,
-        remove_duplicates=False, log_level='INFO'):
+def get_arpa_kwargs(args):
+    """Get the keyword arguments for initializing an Arpa instance from parsed `args`."""
+
+    cache = QueryCache(args.cache, args.cache_size, args.cache_ttl) if args.cache else None
+    circuit_breaker = (CircuitBreaker(args.breaker_threshold, args.breaker_timeout)
+            if args.breaker_threshold else None)
+    throttle = (Throttle(args.workers if args.adaptive else None, rate=args.max_rate)
+            if args.adaptive or args.max_rate else None)
+
+    return dict(retries=args.retries, wait_between_tries=args.wait,
+            pool_maxsize=max(DEFAULT_POOL_SIZE, args.workers), cache=cache,
+            max_batch_bytes=args.batch_bytes, backoff=args.backoff, max_wait=args.max_wait,
+            jitter=args.jitter, circuit_breaker=circuit_breaker, throttle=throttle,
+            candidate_generator=get_candidate_generator(args))
+
+
+def get_checkpoint(args):
+    """Open the checkpoint journal given in parsed `args`, or return `None` if there is none."""
+
+    if not args.checkpoint:
+        return None
+    return Checkpoint(args.checkpoint, args.resume, args.checkpoint_interval)
+
+
+def get_manifest(args, **config):
+    """
+    Open the manifest given in parsed `args`, or return `None` if there is none.
+    `config` is added to the configuration of the manifest.
+    """
+
+    if not args.manifest:
+        return None
+    return Manifest(args.manifest, dict(get_manifest_config(args), **config))
+
+
+def parse_shard_args(args):
+    """Parse the arguments of the shard stage."""
+
+    argparser = argparse.ArgumentParser(prog='shard', description="""Split an RDF file into
+        subject-complete parts that can be processed separately. Blank nodes are replaced
+        with IRIs in the parts, and restored by the merge stage.""")
+    argparser.add_argument("count", metavar="N", type=int, help="The number of parts")
+    argparser.add_argument("input", help="Input rdf file")
+    argparser.add_argument("output", help="""Output file name, where {} is replaced with
+        the index of the part (e.g. part_{}.ttl)""")
+    argparser.add_argument("--fi", metavar="INPUT_FORMAT",
+        help="Input file format (rdflib parser). Will be guessed if omitted.")
+    argparser.add_argument("--fo", metavar="OUTPUT_FORMAT",
+        help="Output file format (rdflib serializer). Default is turtle.", default="turtle")
+    argparser.add_argument("--rdf_class", metavar="CLASS",
+        help="""Split only the subjects of the given type, and include the rest of the
+        triples in every part.""")
+    argparser.add_argument("--prop", metavar="PROPERTY",
+        help="""Split only the subjects with a value for the given property, and include
+        the rest of the triples in every part.""")
+
+    args = argparser.parse_args(args)
+
+    if args.count < 1:
+        argparser.error('The number of parts has to be at least 1')
+    if '{}' not in args.output:
+        argparser.error('The output file name has to include {}')
+
+    args.fi = args.fi or guess_format(args.input)
+    args.prop = URIRef(args.prop) if args.prop else None
+    args.rdf_class = URIRef(args.rdf_class) if args.rdf_class else None
+
+    return args
+
+
+def parse_merge_args(args):
+    """Parse the arguments of the merge stage."""
+
+    argparser = argparse.ArgumentParser(prog='merge', description="""Merge RDF files,
+        such as the outputs of the stages run on each part of a shard stage, into one file
+        without duplicate triples.""")
+    argparser.add_argument("output", help="Output file")
+    argparser.add_argument("input", nargs="+", help="Input rdf files")
+    argparser.add_argument("--fi", metavar="INPUT_FORMAT",
+        help="Input file format (rdflib parser). Will be guessed if omitted.")
+    argparser.add_argument("--fo", metavar="OUTPUT_FORMAT",
+        help="Output file format (rdflib serializer). Default is turtle.", default="turtle")
+
+    return argparser.parse_args(args)
+
+
+def shard_file(input_file, input_format, output_file, output_format, count, source_prop=None,
+        rdf_class=None):
+    """
+    Split `input_file` into `count` subject-complete files with `arpa.split_graph`.
+
+    The blank nodes are replaced with IRIs (skolemized), so that the blank nodes
+    included in multiple parts are identical in them. `merge_files` replaces the IRIs
+    with blank nodes again.
+
+    `output_file` is the output file name, where {} is replaced with the index of the part.
 
-    if argv[1] == 'prune':
+    Return the list of output file names.
+    """
+
+    g = Graph()
+    logger.info('Parsing file {}'.format(input_file))
+    g.parse(input_file, format=input_format)
+
+    output_files = []
+    for i, part in enumerate(split_graph(g, count, source_prop, rdf_class)):
+        output_files.append(output_file.format(i))
+        logger.info('Serializing part {} as {}'.format(i, output_files[-1]))
+        part = part.skolemize()
+        part.namespace_manager = g.namespace_manager
+        part.serialize(destination=output_files[-1], format=output_format)
+
+    return output_files
+
+
+def merge_files(input_files, input_format, output_file, output_format):
+    """
+    Merge `input_files` into `output_file`, removing duplicate triples.
+    The blank nodes skolemized by `shard_file` are restored.
+
+    `input_format` is the format of the input files. Guessed for each file if `None`.
+
+    Return the number of triples in the output.
+    """
+
+    g = Graph()
+    for input_file in input_files:
+        logger.info('Parsing file {}'.format(input_file))
+        g.parse(input_file, format=input_format or guess_format(input_file))
+    g = g.de_skolemize()
+
+    logger.info('Serializing {} triples as {}'.format(len(g), output_file))
+    g.serialize(destination=output_file, format=output_format)
+
+    return len(g)
+
+
+def get_stage(argv, ignore=None, validator_class=None, preprocessor=None, pruner=None,
+        remove_duplicates=False):
+    """
+    Parse the arguments of a linking stage.
+
+    `argv` is the name of the stage (prune, join, disambiguate, disambiguate_validate
+    or raw) followed by its arguments, or just the arguments of the default stage.
+
+    Return the name of the stage's log file (or `None` if the stage is not logged),
+    the parsed arguments, and the keyword arguments of `arpa.process` for running
+    the stage.
+    """
+
+    if argv[0] == 'prune':
         # Remove ngrams that will not match anything for sure
-        args = parse_args(argv[2:])
-        init_log('_prune', log_level, args.log_file)
-        process(args.input, args.fi, args.output, args.fo, args.tprop, prune=True,
-                pruner=pruner, source_prop=args.prop, rdf_class=args.rdf_class,
-                new_graph=args.new_graph, run_arpafy=False, progress=True)
+        args = parse_args(argv[1:])
+        return '_prune', args, dict(target_prop=args.tprop, prune=True, pruner=pruner,
+                source_prop=args.prop, rdf_class=args.rdf_class, new_graph=args.new_graph,
+                run_arpafy=False, progress=True, report_file=args.report)
 
-    elif argv[1] == 'join':
+    if argv[0] == 'join':
         # Merge ngrams into a single value
-        args = parse_args(argv[2:])
-        process(args.input, args.fi, args.output, args.fo, args.tprop, source_prop=args.prop,
+        args = parse_args(argv[1:])
+        return None, args, dict(target_prop=args.tprop, source_prop=args.prop,
                 rdf_class=args.rdf_class, new_graph=args.new_graph, join_candidates=True,
-                run_arpafy=False, progress=True)
+                run_arpafy=False, progress=True, report_file=args.report)
 
-    elif 'disambiguate' in argv[1]:
+    if 'disambiguate' in argv[0]:
         # Link (with possible validation)
-        args = parse_args(argv[3:])
+        args = parse_args(argv[2:])
 
-        f = open(argv[2])
+        f = open(argv[1])
         qry = f.read()
         f.close()
 
-        if argv[1] == 'disambiguate_validate':
-            init_log('_validate', log_level, args.log_file)
+        if argv[0] == 'disambiguate_validate':
+            log_name = '_validate'
             val = validator_class
             dupl = remove_duplicates
         else:
-            init_log('_disambiguate', log_level, args.log_file)
+            log_name = '_disambiguate'
             val = None
             dupl = False
 
-        arpa = ArpaMimic(qry, args.arpa, dupl, args.min_ngram, ignore,
-                retries=args.retries, wait_between_tries=args.wait)
+        arpa = ArpaMimic(qry, args.arpa, dupl, args.min_ngram, ignore, **get_arpa_kwargs(args))
 
-        process(args.input, args.fi, args.output, args.fo, args.tprop, arpa=arpa,
-                validator_class=val, source_prop=args.prop, rdf_class=args.rdf_class,
-                new_graph=args.new_graph, progress=True)
+        return log_name, args, dict(target_prop=args.tprop, arpa=arpa, validator_class=val,
+                source_prop=args.prop, rdf_class=args.rdf_class, new_graph=args.new_graph,
+                progress=True, workers=args.workers, batch_size=args.batch_size,
+                stream=args.stream, checkpoint=get_checkpoint(args), processes=args.processes,
+                stream_links=args.stream_links, report_file=args.report,
+                manifest=get_manifest(args, stage=argv[0], query=qry),
+                validation_window=args.validation_window)
 
-    elif 'raw' in argv[1]:
+    if 'raw' in argv[0]:
         # No preprocessing or validation
+        args = parse_args(argv[1:])
+        arpa = Arpa(args.arpa, **get_arpa_kwargs(args))
 
-        args = parse_args(argv[2:])
-        init_log('_raw', log_level, args.log_file)
-        arpa = Arpa(args.arpa, retries=args.retries, wait_between_tries=args.wait)
+        return '_raw', args, dict(target_prop=args.tprop, arpa=arpa, source_prop=args.prop,
+                rdf_class=args.rdf_class, new_graph=args.new_graph, progress=True,
+                candidates_only=args.candidates_only, workers=args.workers,
+                batch_size=args.batch_size, stream=args.stream, checkpoint=get_checkpoint(args),
+                processes=args.processes, stream_links=args.stream_links, report_file=args.report,
+                manifest=get_manifest(args, stage='raw'))
 
-        # Query the ARPA service, add the matches and serialize the graph to disk.
-        process(args.input, args.fi, args.output, args.fo, args.tprop, arpa,
-                source_prop=args.prop, rdf_class=args.rdf_class, new_graph=args.new_graph,
-                progress=True, candidates_only=args.candidates_only)
+    args = parse_args(argv)
+    arpa = Arpa(args.arpa, args.no_duplicates, args.min_ngram, ignore, **get_arpa_kwargs(args))
+
+    return '_arpa', args, dict(target_prop=args.tprop, arpa=arpa, source_prop=args.prop,
+            rdf_class=args.rdf_class, new_graph=args.new_graph, preprocessor=preprocessor,
+            validator_class=validator_class, progress=True, candidates_only=args.candidates_only,
+            workers=args.workers, batch_size=args.batch_size, stream=args.stream,
+            checkpoint=get_checkpoint(args), processes=args.processes,
+            stream_links=args.stream_links, report_file=args.report, manifest=get_manifest(args),
+            validation_window=args.validation_window)
+
+
+def parse_pipeline_args(args):
+    """Parse the arguments of the pipeline stage."""
+
+    argparser = argparse.ArgumentParser(prog='pipeline', description="""Run multiple stages
+        on a graph in memory, parsing the input and serializing the output only once.""")
+    argparser.add_argument("config", help="""Pipeline file with one stage per line: the name
+        of the stage followed by its arguments without the input and output files.
+        Empty lines and lines starting with # are ignored.""")
+    argparser.add_argument("input", help="Input rdf file")
+    argparser.add_argument("output", help="Output file")
+    argparser.add_argument("--fi", metavar="INPUT_FORMAT",
+        help="Input file format (rdflib parser). Will be guessed if omitted.")
+    argparser.add_argument("--fo", metavar="OUTPUT_FORMAT",
+        help="Output file format (rdflib serializer). Default is turtle.", default="turtle")
+    argparser.add_argument("--report", metavar="FILE",
+        help="Write a JSON report of each stage to FILE.")
+
+    args = argparser.parse_args(args)
+    args.fi = args.fi or guess_format(args.input)
+
+    return args
+
+
+def read_pipeline(config_file):
+    """
+    Read the stages from the pipeline file `config_file`.
+    Return a list with the arguments of each stage as a list.
+    """
+
+    with open(config_file) as f:
+        lines = [line.strip() for line in f]
+    return [shlex.split(line) for line in lines if line and not line.startswith('#')]
+
+
+def close_stage(stage_kwargs, completed=True):
+    """
+    Close the checkpoint and the manifest of a stage. The manifest is replaced
+    only if the stage was `completed`.
+    """
+
+    if stage_kwargs.get('checkpoint'):
+        stage_kwargs['checkpoint'].close()
+    if stage_kwargs.get('manifest'):
+        stage_kwargs['manifest'].close(replace=completed)
+
+
+def get_pipeline_stages(stages, input_file, output_file, **kwargs):
+    """
+    Parse the arguments of all the `stages` of a pipeline with `get_stage`, so that
+    invalid arguments are found before any stage is run.
+
+    `stages` is a list of stage arguments as returned by `read_pipeline`. `input_file`
+    and `output_file` are passed to the argument parser of each stage, but the stages
+    do not read or write any files.
+
+    The rest of the arguments are passed to `get_stage`.
+
+    Return a list of (name, keyword arguments of `arpa.process_graph`) tuples.
+    """
+
+    parsed = []
+    try:
+        for stage in stages:
+            name = stage[0]
+            # Insert the file arguments after the name of the stage (and the query file)
+            if 'disambiguate' in name:
+                n = 2
+            elif name in ('prune', 'join') or 'raw' in name:
+                n = 1
+            else:
+                n = 0
+            stage_argv = stage[:n] + [input_file, output_file] + stage[n:]
+            stage_kwargs = get_stage(stage_argv, **kwargs)[2]
+            parsed.append((name, stage_kwargs))
+
+            stream = stage_kwargs.pop('stream', False)
+            stream_links = stage_kwargs.pop('stream_links', False)
+            if stream or stream_links:
+                raise ValueError('The stages of a pipeline can not be streamed')
+            stage_kwargs.pop('report_file')
+    except BaseException:
+        for name, stage_kwargs in parsed:
+            close_stage(stage_kwargs, completed=False)
+        raise
+
+    return parsed
+
+
+def run_pipeline(graph, stages, input_file, output_file, **kwargs):
+    """
+    Run the `stages` on `graph` in memory with `arpa.process_graph`, each stage getting
+    the resulting graph of the previous stage.
+
+    The arguments of all the stages are parsed with `get_pipeline_stages` before
+    the first stage is run. For the arguments, see `get_pipeline_stages`.
+
+    Return a list of the results dicts of the stages.
+    """
+
+    parsed = get_pipeline_stages(stages, input_file, output_file, **kwargs)
+
+    results = []
+    try:
+        for name, stage_kwargs in parsed:
+            validator_class = stage_kwargs.pop('validator_class', None)
+            if validator_class:
+                stage_kwargs['validator'] = validator_class(graph)
+
+            logger.info('Running pipeline stage {}'.format(name))
+            res = process_graph(graph, **stage_kwargs)
+            close_stage(stage_kwargs)
+
+            graph = res['graph']
+            res['stage'] = name
+            results.append(res)
+    except BaseException:
+        for name, stage_kwargs in parsed[len(results):]:
+            close_stage(stage_kwargs, completed=False)
+        raise
+
+    return results
+
+
+def process_pipeline(argv, log_level='INFO', **kwargs):
+    """
+    Run the pipeline stage: parse the input file, run the stages of the pipeline file
+    in memory and serialize the result.
+
+    `argv` is the arguments of the pipeline stage. The rest of the arguments are
+    passed to `get_stage`.
+
+    Return the results dict of the last stage, with the results of all the stages
+    as a list (stages) and the seconds spent parsing (parse_time) and serializing
+    (serialization_time).
+    """
+
+    args = parse_pipeline_args(argv)
+    stages = read_pipeline(args.config)
+    init_log('_pipeline', log_level)
+
+    start_time = time.perf_counter()
+    g = Graph()
+    logger.info('Parsing file {}'.format(args.input))
+    g.parse(args.input, format=args.fi)
+    parse_time = time.perf_counter() - start_time
+
+    results = run_pipeline(g, stages, args.input, args.output, **kwargs)
+
+    start_time = time.perf_counter()
+    output_graph = results[-1]['graph'] if results else g
+    logger.info('Serializing graph as {}'.format(args.output))
+    output_graph.serialize(destination=args.output, format=args.fo)
+
+    res = dict(results[-1]) if results else {'graph': output_graph}
+    res['stages'] = results
+    res['parse_time'] = parse_time
+    res['serialization_time'] = time.perf_counter() - start_time
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump([{key: value for key, value in stage_res.items() if key != 'graph'}
+                    for stage_res in results], f, indent=2, sort_keys=True, default=str)
+
+    return res
+
+
+def process_stage(argv, ignore=None, validator_class=None, preprocessor=None, pruner=None,
+        remove_duplicates=False, log_level='INFO'):
+
+    stage_kwargs = dict(ignore=ignore, validator_class=validator_class,
+            preprocessor=preprocessor, pruner=pruner, remove_duplicates=remove_duplicates)
+
+    if argv[1] == 'shard':
+        # Split the input into parts that can be processed separately
+        args = parse_shard_args(argv[2:])
+        shard_file(args.input, args.fi, args.output, args.fo, args.count, args.prop,
+                args.rdf_class)
+
+    elif argv[1] == 'merge':
+        # Combine the outputs of the parts
+        args = parse_merge_args(argv[2:])
+        merge_files(args.input, args.fi, args.output, args.fo)
+
+    elif argv[1] == 'pipeline':
+        # Run multiple stages in memory
+        process_pipeline(argv[2:], log_level, **stage_kwargs)
 
     else:
-        args = parse_args(argv[1:])
-        init_log('_arpa', log_level, args.log_file)
-        arpa = Arpa(args.arpa, args.no_duplicates, args.min_ngram, ignore,
-                retries=args.retries, wait_between_tries=args.wait)
+        log_name, args, kwargs = get_stage(argv[1:], **stage_kwargs)
+        if log_name:
+            init_log(log_name, log_level, args.log_file)
 
-        # Query the ARPA service, add the matches and serialize the graph to disk.
-        process(args.input, args.fi, args.output, args.fo, args.tprop, arpa,
-                source_prop=args.prop, rdf_class=args.rdf_class, new_graph=args.new_graph,
-                preprocessor=preprocessor, validator_class=validator_class, progress=True,
-                candidates_only=args.candidates_only)
+        # Query the ARPA service (unless pruning or joining), and serialize the graph to disk.
+        try:
+            with kwargs.get('manifest') or nullcontext():
+                process(args.input, args.fi, args.output, args.fo, **kwargs)
+        finally:
+            if kwargs.get('checkpoint'):
+                kwargs['checkpoint'].close()
 
 
 if __name__ == '__main__':
@@ -1,13 +1,33 @@
 import unittest
+import requests
 import responses
 import logging
 import re
+import json
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest import TestCase
 from unittest.mock import patch, Mock
+from urllib.parse import parse_qs
 from requests.exceptions import HTTPError
-from rdflib import Graph, Literal, URIRef
+from rdflib import Graph, Literal, URIRef, BNode, Dataset
+from rdflib.namespace import RDF, SKOS
+from rdflib.compare import isomorphic
 from arpa import Arpa, ArpaMimic, arpafy, process, parse_args, post, prune_candidates, \
-    map_results, combine_candidates, combine_values
+    map_results, combine_candidates, combine_values, AsyncArpa, AsyncArpaMimic, arpafy_async, \
+    QueryCache, split_values, BATCH_SEPARATOR, ResultMapper, process_stream, Checkpoint, \
+    Manifest, CircuitBreaker, Throttle, LocalArpa, CandidateGenerator, get_candidate_generator, \
+    get_shard, process_graph, split_graph, LinkWriter, _Truncated
+from arpa_linker import link_helper
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 candidate_response = {
     "locale": "fi",
@@ -406,11 +426,82 @@ matches = {
 
 match_uris = {URIRef(x['id']) for x in matches['results']}
 
+# TestProcess replaces Graph.parse and Graph.serialize
+graph_parse = Graph.parse
+graph_serialize = Graph.serialize
+
 
 def do_nothing(*args, **kwargs):
     pass
 
 
+class BatchValidator:
+    """Validator that rejects the matches of Helsinki, and records its batches."""
+
+    def __init__(self):
+        self.batches = []
+        self.subjects = []
+
+    def validate(self, results, text, s):
+        return [r for r in results if r['label'] != 'Helsinki']
+
+    def validate_batch(self, results, texts, subjects):
+        self.batches.append(texts)
+        self.subjects.extend(subjects)
+        return [self.validate(r, text, s) for r, text, s in zip(results, texts, subjects)]
+
+
+class StandInServer:
+    """
+    A local HTTP server that responds to POST requests with JSON.
+
+    `responses` maps a request path (including the query string) to the response body
+    (dict) or to a status code (int).
+
+    If `keep_alive` is set, keep connections open between requests.
+    """
+
+    def __init__(self, responses, keep_alive=False):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' if keep_alive else 'HTTP/1.0'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                server.clients.add(self.client_address)
+                server.requests.append((self.path, self.rfile.read(length).decode()))
+                body = server.responses.get(self.path, 404)
+                if isinstance(body, int):
+                    self.send_response(body)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.responses = responses
+        self.requests = []
+        self.clients = set()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
 def setUpModule():
     logging.disable(logging.CRITICAL)
 
@@ -483,6 +574,27 @@ class TestArpa(TestCase):
         self.assertEqual(str(res[0]), 'http://ldf.fi/warsa/places/municipalities/m_place_506')
         self.assertEqual(str(res[1]), 'http://ldf.fi/warsa/places/municipalities/m_place_504')
 
+    def test_prioritized_duplicate_removal_order(self):
+        def entry(id_, label, types):
+            return {'id': id_, 'label': label, 'properties': {'type': types}}
+
+        t1, t2, t3 = 'http://t1', 'http://t2', 'http://t3'
+        entries = [
+            entry('a', 'X', ['<http://t3>']),
+            entry('b', 'x', ['<http://other>', '<http://t1>']),
+            entry('c', 'X', []),
+            entry('d', 'Y', ['<http://other>']),
+            entry('e', 'X', ['<http://t1>']),
+            entry('f', 'Z', []),
+            entry('g', 'Z', ['<http://other>']),
+            entry('h', 'Y', ['<http://t2>', '<http://t3>']),
+        ]
+        arpa = Arpa('http://url', remove_duplicates=[t1, t2, t3, t1])
+
+        res = arpa._remove_duplicates(entries)
+
+        self.assertEqual([x['id'] for x in res], ['b', 'g', 'h'])
+
     @responses.activate
     def test_min_ngram_length(self):
         responses.add(responses.POST, 'http://url',
@@ -521,6 +633,23 @@ class TestArpa(TestCase):
         self.assertRaises(HTTPError, arpa.get_uri_matches, 'Hanko Hanko')
         self.assertEqual(len(responses.calls), 1)
 
+    @responses.activate
+    def test_stats(self):
+        responses.add(responses.POST, 'http://url', body='error', status=503)
+        responses.add(responses.POST, 'http://url', json=matches, status=200)
+
+        arpa = Arpa('http://url', retries=1, wait_between_tries=0)
+        arpa.get_uri_matches('Hanko Hanko')
+        stats = arpa.get_stats()
+
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['retries'], 1)
+        self.assertEqual(stats['bytes_sent'], 2 * len('text=Hanko+Hanko'))
+        self.assertEqual(stats['bytes_received'], len('error') + len(json.dumps(matches)))
+        self.assertGreater(stats['http_time'], 0)
+        self.assertIn('decode_time', stats)
+        self.assertIn('filter_time', stats)
+
     def test_invalid_retries(self):
         self.assertRaises(ValueError, Arpa, 'url', retries=-1)
         self.assertRaises(TypeError, Arpa, 'url', retries=None)
@@ -574,6 +703,28 @@ class TestArpa(TestCase):
         self.assertRaises(ValueError, arpa.get_uri_matches, '')
         self.assertEqual(len(responses.calls), 0)
 
+    def test_connection_pool(self):
+        arpa = Arpa('http://url', pool_connections=2, pool_maxsize=5, pool_block=True)
+        adapter = arpa._session.get_adapter('http://url')
+
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertEqual(adapter._pool_maxsize, 5)
+        self.assertTrue(adapter._pool_block)
+        self.assertEqual(arpa._session.headers['Connection'], 'keep-alive')
+
+        arpa = Arpa('http://url', keep_alive=False)
+
+        self.assertEqual(arpa._session.headers['Connection'], 'close')
+
+    def test_connection_reuse(self):
+        with StandInServer({'/': matches}, keep_alive=True) as server:
+            with Arpa(server.url) as arpa:
+                for i in range(3):
+                    arpa.get_uri_matches('Hanko')
+
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(len(server.clients), 1)
+
 
 class TestArpaMimic(TestCase):
     def setUp(self):
@@ -690,6 +841,522 @@ class TestArpaMimic(TestCase):
         self.assertEqual(len(responses.calls), 0)
 
 
+helsinki_match = {
+    "id": "http://ldf.fi/warsa/places/municipalities/m_place_1",
+    "label": "Helsinki",
+    "matches": ["Helsinki", "Helsingin"],
+    "properties": {
+        "id": ["<http://ldf.fi/warsa/places/municipalities/m_place_1>"],
+        "label": ["\"Helsinki\"@fi"],
+        "ngram": ["\"Helsinki\""],
+        "type": ["<http://www.yso.fi/onto/suo/kunta>"]
+    }
+}
+
+
+mannerheim_match = {
+    "id": "http://ldf.fi/warsa/actors/person_1",
+    "label": "Gustaf Mannerheim",
+    "matches": ["Gustaf Mannerheim", "Mannerheim"],
+    "properties": {
+        "id": ["<http://ldf.fi/warsa/actors/person_1>"],
+        "label": ["\"Gustaf Mannerheim\"@fi"],
+        "ngram": ["\"Gustaf Mannerheim\"", "\"Mannerheim\""],
+        "type": ["<http://ldf.fi/schema/warsa/Person>"]
+    }
+}
+
+def arpa_text_callback(request):
+    """
+    `responses` callback that emulates the ARPA service: return the matches
+    (and match strings and ngrams) that occur in the query text as words.
+    """
+
+    words = ' {} '.format(' '.join(re.findall(r'\w+', parse_qs(request.body)['text'][0].lower())))
+    results = []
+    for entry in matches['results'] + [helsinki_match, mannerheim_match]:
+        found = [m for m in entry['matches'] if ' {} '.format(m.lower()) in words]
+        if found:
+            properties = dict(entry['properties'], ngram=['"{}"'.format(m) for m in found])
+            results.append(dict(entry, matches=found, properties=properties))
+    return (200, {}, json.dumps({'locale': 'fi', 'results': results}))
+
+
+def sparql_values_callback(request):
+    """
+    `responses` callback that emulates a SPARQL endpoint: return the rows of
+    `sparql_result` whose ngram is one of the quoted values in the query.
+    """
+
+    query = parse_qs(request.body)['query'][0]
+    values = set(split_values(query))
+    bindings = [b for b in sparql_result['results']['bindings']
+            if b['ngram']['value'] in values]
+    return (200, {}, json.dumps({'head': sparql_result['head'],
+        'results': {'bindings': bindings}}))
+
+
+class TestArpaMimicBatch(TestCase):
+    def setUp(self):
+        self.texts = ['"Gustaf Mannerheim" "Hanko"', '"Joku Toinen" "kapteeni Joku Toinen"',
+                '"Hanko"', '"Carl Gustaf Mannerheim" "Joku Toinen"']
+
+    def add_response(self):
+        responses.add_callback(responses.POST, 'http://url',
+                callback=sparql_values_callback, content_type='application/json')
+
+    @responses.activate
+    def test_query_batch(self):
+        self.add_response()
+        arpa = ArpaMimic('VALUES ?ngram { <VALUES> }', 'http://url')
+
+        expected = [arpa.query(text) for text in self.texts]
+        responses.calls.reset()
+
+        res = arpa.query_batch(self.texts)
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(res, expected)
+        self.assertEqual(res[2], [])
+        self.assertEqual(res[0][0]['matches'], ['Gustaf Mannerheim'])
+
+    @responses.activate
+    def test_max_batch_bytes(self):
+        self.add_response()
+        template = 'VALUES ?ngram { <VALUES> }'
+        arpa = ArpaMimic(template, 'http://url', max_batch_bytes=len(template) + 45)
+
+        expected = [arpa.query(text) for text in self.texts]
+        responses.calls.reset()
+
+        res = arpa.query_batch(self.texts)
+
+        self.assertEqual(len(responses.calls), 3)
+        for call in responses.calls:
+            self.assertLessEqual(len(parse_qs(call.request.body)['query'][0]), len(template) + 45)
+        self.assertEqual(res, expected)
+
+    @responses.activate
+    def test_unquoted_and_empty_texts(self):
+        self.add_response()
+        arpa = ArpaMimic('<VALUES>', 'http://url')
+
+        res = arpa.query_batch(['"Joku Toinen"', '', 'Joku Toinen'])
+
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(len(res[0]), 1)
+        self.assertIsInstance(res[1], ValueError)
+        self.assertEqual(res[2], [])
+
+    @responses.activate
+    def test_error(self):
+        responses.add(responses.POST, 'http://url', body='error', status=503)
+        arpa = ArpaMimic('<VALUES>', 'http://url')
+
+        res = arpa.query_batch(self.texts)
+
+        self.assertEqual(len(responses.calls), 1)
+        for r in res:
+            self.assertIsInstance(r, HTTPError)
+
+    @responses.activate
+    def test_arpafy_batch(self):
+        self.add_response()
+        prop = URIRef('http://warsa/place')
+        tprop = URIRef('http://warsa/target')
+        graph = Graph()
+        for i, text in enumerate(self.texts * 5):
+            graph.add((URIRef('http://warsa/event_{}'.format(i)), prop, Literal(text)))
+
+        arpa = ArpaMimic('<VALUES>', 'http://url', remove_duplicates=True)
+        serial_graph = Graph()
+        serial_res = arpafy(graph, tprop, arpa, source_prop=prop, output_graph=serial_graph)
+        responses.calls.reset()
+
+        batch_graph = Graph()
+        batch_res = arpafy(graph, tprop, arpa, source_prop=prop, output_graph=batch_graph,
+                batch_size=8, workers=2)
+
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(set(serial_graph), set(batch_graph))
+        for key in ('processed', 'matches', 'subjects_matched', 'errors'):
+            self.assertEqual(serial_res[key], batch_res[key])
+
+
+class TestArpaBatch(TestCase):
+    def setUp(self):
+        self.texts = ['Hanko Hanko', 'Helsinki, Hanko.', 'Kotka', 'Helsingin ja Helsinki',
+                'hanko']
+
+    def add_response(self):
+        responses.add_callback(responses.POST, 'http://url',
+                callback=arpa_text_callback, content_type='application/json')
+
+    @responses.activate
+    def test_query_batch(self):
+        self.add_response()
+        arpa = Arpa('http://url', remove_duplicates=True)
+
+        expected = [arpa.query(text) for text in self.texts]
+        responses.calls.reset()
+
+        res = arpa.query_batch(self.texts)
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(parse_qs(responses.calls[0].request.body)['text'][0],
+                BATCH_SEPARATOR.join(self.texts))
+        self.assertEqual(res, expected)
+        self.assertEqual(res[2], [])
+        self.assertEqual(res[3][0]['matches'], ['Helsinki', 'Helsingin'])
+        self.assertEqual(res[1][0]['matches'], ['Hanko'])
+
+    @responses.activate
+    def test_match_spanning_texts(self):
+        self.add_response()
+        arpa = Arpa('http://url')
+
+        res = arpa.query_batch(['Kotka Hanko', 'Hanko Kotka'])
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual({r['label'] for r in res[0]}, {'Hanko'})
+        self.assertEqual({r['label'] for r in res[1]}, {'Hanko'})
+
+    @responses.activate
+    def test_query_batch_min_ngram_length(self):
+        self.add_response()
+        arpa = Arpa('http://url', min_ngram_length=2)
+        texts = ['Mannerheim rode', 'Gustaf Mannerheim']
+
+        expected = [arpa.query(text) for text in texts]
+        responses.calls.reset()
+
+        res = arpa.query_batch(texts)
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(res, expected)
+        self.assertEqual(res[0], [])
+        self.assertEqual(res[1][0]['properties']['ngram'], ['"Gustaf Mannerheim"', '"Mannerheim"'])
+
+    @responses.activate
+    def test_max_batch_bytes(self):
+        self.add_response()
+        arpa = Arpa('http://url', max_batch_bytes=30)
+
+        expected = [arpa.query(text) for text in self.texts]
+        responses.calls.reset()
+
+        res = arpa.query_batch(self.texts)
+
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(res, expected)
+
+    @responses.activate
+    def test_empty_text_and_error(self):
+        responses.add(responses.POST, 'http://url', body='error', status=503)
+        arpa = Arpa('http://url')
+
+        res = arpa.query_batch(['Hanko', '', 'Helsinki'])
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertIsInstance(res[0], HTTPError)
+        self.assertIsInstance(res[1], ValueError)
+        self.assertIsInstance(res[2], HTTPError)
+
+    @responses.activate
+    def test_candidates(self):
+        responses.add(responses.POST, 'http://url?cgen',
+                json=candidate_response, status=200)
+        arpa = Arpa('http://url')
+
+        res = arpa.get_candidates_batch(['Hanko', 'Hanko'])
+
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(set(res[0]['results']), candidate_values)
+
+    @responses.activate
+    def test_arpafy_batch(self):
+        self.add_response()
+        prop = URIRef('http://warsa/place')
+        tprop = URIRef('http://warsa/target')
+        graph = Graph()
+        for i, text in enumerate(self.texts * 4):
+            graph.add((URIRef('http://warsa/event_{}'.format(i)), prop, Literal(text)))
+
+        arpa = Arpa('http://url', remove_duplicates=['http://www.yso.fi/onto/suo/kunta'])
+        serial_graph = Graph()
+        serial_res = arpafy(graph, tprop, arpa, source_prop=prop, output_graph=serial_graph)
+        responses.calls.reset()
+
+        batch_graph = Graph()
+        batch_res = arpafy(graph, tprop, arpa, source_prop=prop, output_graph=batch_graph,
+                batch_size=6)
+
+        self.assertEqual(len(responses.calls), 4)
+        self.assertEqual(set(serial_graph), set(batch_graph))
+        for key in ('processed', 'matches', 'subjects_matched', 'errors',
+                'post_validation_mention_count'):
+            self.assertEqual(serial_res[key], batch_res[key])
+
+
+    @responses.activate
+    def test_validate_batch(self):
+        self.add_response()
+        arpa = Arpa('http://url')
+        validator = BatchValidator()
+        subjects = [URIRef('http://warsa/event_{}'.format(i)) for i in range(len(self.texts))]
+
+        expected = [arpa.get_uri_matches(text, s, validator=validator)
+                for text, s in zip(self.texts, subjects)]
+        responses.calls.reset()
+
+        res = arpa.get_uri_matches_batch(self.texts, subjects, validator)
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(res, expected)
+        # Kotka has no results to validate
+        self.assertEqual(validator.batches, [[self.texts[i] for i in (0, 1, 3, 4)]])
+        self.assertEqual(validator.subjects, [subjects[i] for i in (0, 1, 3, 4)])
+        self.assertEqual(res[3]['pre_validation_mentions'], {'Helsinki', 'Helsingin'})
+        self.assertEqual(res[3]['mentions'], set())
+
+    @responses.activate
+    def test_validate_batch_error(self):
+        self.add_response()
+        arpa = Arpa('http://url')
+        validator = BatchValidator()
+        validator.validate_batch = Mock(side_effect=ValueError('Validation failed'))
+
+        res = arpa.get_uri_matches_batch(['Hanko', 'Kotka', ''], [None] * 3, validator)
+
+        self.assertIsInstance(res[0], ValueError)
+        self.assertEqual(res[1]['results'], [])
+        self.assertIsInstance(res[2], ValueError)
+
+        validator.validate_batch = Mock(return_value=[])
+        self.assertRaises(ValueError, arpa.get_uri_matches_batch, ['Hanko'], [None], validator)
+
+    @responses.activate
+    def test_arpafy_validate_batch(self):
+        self.add_response()
+        prop = URIRef('http://warsa/place')
+        tprop = URIRef('http://warsa/target')
+        graph = Graph()
+        for i, text in enumerate(self.texts * 4):
+            graph.add((URIRef('http://warsa/event_{}'.format(i)), prop, Literal(text)))
+
+        arpa = Arpa('http://url')
+        serial_graph = Graph()
+        serial_res = arpafy(graph, tprop, arpa, source_prop=prop, output_graph=serial_graph,
+                validator=Mock(validate=BatchValidator().validate))
+
+        validator = BatchValidator()
+        window_graph = Graph()
+        window_res = arpafy(graph, tprop, arpa, source_prop=prop, output_graph=window_graph,
+                validator=validator, validation_window=6, workers=2)
+
+        # The texts were queried one at a time, and validated in windows of 6 subjects
+        self.assertEqual(len(responses.calls), 2 * 20)
+        # Kotka has no results to validate
+        self.assertEqual(len(validator.batches), 4)
+        self.assertEqual(sum(map(len, validator.batches)), 16)
+        self.assertEqual(set(serial_graph), set(window_graph))
+        for key in ('processed', 'matches', 'subjects_matched', 'errors',
+                'post_validation_mention_count', 'pre_validation_mention_count'):
+            self.assertEqual(serial_res[key], window_res[key])
+
+        validator = BatchValidator()
+        arpafy(graph, tprop, arpa, source_prop=prop, output_graph=Graph(),
+                validator=validator, batch_size=10)
+        self.assertEqual(len(responses.calls), 2 * 20 + 2)
+        self.assertEqual(len(validator.batches), 2)
+        self.assertEqual(sum(map(len, validator.batches)), 16)
+
+    @responses.activate
+    def test_arpafy_validate_batch_workers(self):
+        # Each query waits for another one to arrive, which fails unless they run concurrently
+        barrier = threading.Barrier(2)
+        broken = []
+
+        def callback(request):
+            try:
+                barrier.wait(timeout=2)
+            except threading.BrokenBarrierError:
+                broken.append(request)
+            return arpa_text_callback(request)
+
+        responses.add_callback(responses.POST, 'http://url', callback=callback,
+                content_type='application/json')
+        prop = URIRef('http://warsa/place')
+        graph = Graph()
+        for i, text in enumerate(self.texts * 4):
+            graph.add((URIRef('http://warsa/event_{}'.format(i)), prop, Literal(text)))
+
+        validator = BatchValidator()
+        res = arpafy(graph, URIRef('http://warsa/target'), Arpa('http://url'),
+                source_prop=prop, output_graph=Graph(), validator=validator,
+                validation_window=6, workers=2)
+
+        self.assertEqual(broken, [])
+        self.assertEqual(len(responses.calls), 20)
+        self.assertEqual(res['errors'], [])
+        self.assertEqual(len(validator.batches), 4)
+        self.assertEqual(sum(map(len, validator.batches)), 16)
+
+
+class TestLocalArpa(TestCase):
+    def setUp(self):
+        self.ns = 'http://ldf.fi/warsa/places/'
+        self.graph = Graph()
+        for id_, label, type_ in [('karjala', 'Karjala', 'Alue'), ('ita_karjala', 'Itä-Karjala', 'Alue'),
+                ('hanko_kunta', 'Hanko', 'Kunta'), ('hanko_kyla', 'Hanko', 'Kyla'),
+                ('summa', 'Summa', 'Kyla')]:
+            s = URIRef(self.ns + id_)
+            self.graph.add((s, SKOS.prefLabel, Literal(label, lang='fi')))
+            self.graph.add((s, RDF.type, URIRef(self.ns + type_)))
+        self.graph.add((URIRef(self.ns + 'summa'), SKOS.altLabel, Literal('Summan kylä')))
+
+    def uri(self, id_):
+        return URIRef(self.ns + id_)
+
+    def test_query(self):
+        arpa = LocalArpa(self.graph)
+        res = arpa.query('Taistelut Itä karjalassa ja HANKO.')
+
+        self.assertEqual([r['id'] for r in res], [self.ns + 'hanko_kunta', self.ns + 'hanko_kyla'])
+        self.assertEqual(res[0]['label'], 'Hanko')
+        self.assertEqual(res[0]['matches'], ['HANKO'])
+        self.assertEqual(res[0]['properties']['type'], ['<{}Kunta>'.format(self.ns)])
+        self.assertEqual(res[0]['properties']['ngram'], ['"HANKO"'])
+
+    def test_overlapping_matches(self):
+        arpa = LocalArpa(self.graph)
+        res = arpa.get_uri_matches('Itä-Karjala, Hanko')
+
+        self.assertEqual(res['results'], [self.uri('ita_karjala'), self.uri('karjala'),
+            self.uri('hanko_kunta'), self.uri('hanko_kyla')])
+        self.assertEqual(res['mentions'], {'Itä-Karjala', 'Karjala', 'Hanko'})
+
+    def test_label_props(self):
+        arpa = LocalArpa(self.graph)
+        self.assertEqual(arpa.query('Summan kylä'), [])
+
+        arpa = LocalArpa(self.graph, [SKOS.prefLabel, SKOS.altLabel])
+        res = arpa.query('Summan kylä')
+        self.assertEqual([r['id'] for r in res], [self.ns + 'summa'])
+        self.assertEqual(res[0]['matches'], ['Summan kylä'])
+
+    def test_rdf_class(self):
+        arpa = LocalArpa(self.graph, rdf_class=self.uri('Kyla'))
+        res = arpa.get_uri_matches('Hanko Karjala Summa')
+        self.assertEqual(res['results'], [self.uri('hanko_kyla'), self.uri('summa')])
+
+    def test_filter(self):
+        arpa = LocalArpa(self.graph, remove_duplicates=[self.ns + 'Kyla'])
+        res = arpa.get_uri_matches('Hanko')
+        self.assertEqual(res['results'], [self.uri('hanko_kyla')])
+
+        arpa = LocalArpa(self.graph, min_ngram_length=2, ignore=['itä-karjala'])
+        self.assertEqual(arpa.query('Itä-Karjala ja Hanko'), [])
+
+    def test_untyped_subjects(self):
+        self.graph.add((self.uri('hanko'), SKOS.prefLabel, Literal('Hanko')))
+        self.graph.add((self.uri('kotka'), SKOS.prefLabel, Literal('Kotka')))
+        arpa = LocalArpa(self.graph, remove_duplicates=[self.ns + 'Kyla'])
+
+        res = arpa.query('Kotka')
+        self.assertEqual([r['id'] for r in res], [self.ns + 'kotka'])
+        self.assertEqual(res[0]['properties']['type'], [])
+
+        res = arpa.get_uri_matches('Hanko ja Kotka')
+        self.assertEqual(res['results'], [self.uri('hanko_kyla'), self.uri('kotka')])
+
+    def test_candidates(self):
+        arpa = LocalArpa(self.graph)
+        res = arpa.get_candidates('Itä-Karjala ja Hanko')
+        self.assertEqual(res['results'], [Literal(c) for c in
+            ['Itä', 'Itä Karjala', 'Karjala', 'Karjala ja', 'ja', 'ja Hanko', 'Hanko']])
+
+    def test_empty_text(self):
+        arpa = LocalArpa(self.graph)
+        self.assertRaises(ValueError, arpa.query, '')
+        self.assertEqual(arpa.query('...'), [])
+
+    def test_arpafy(self):
+        prop = URIRef('http://ldf.fi/schema/place')
+        tprop = URIRef('http://ldf.fi/schema/place_link')
+        graph = Graph()
+        for i, text in enumerate(['Hanko', 'Summa ja Itä-Karjala', 'Helsinki']):
+            graph.add((URIRef('http://ldf.fi/event_{}'.format(i)), prop, Literal(text)))
+
+        arpa = LocalArpa(self.graph, remove_duplicates=True)
+        res = arpafy(graph, tprop, arpa, source_prop=prop, batch_size=2, workers=2)
+
+        self.assertEqual(res['processed'], 3)
+        self.assertEqual(res['matches'], 4)
+        self.assertEqual(set(graph.objects(URIRef('http://ldf.fi/event_1'), tprop)),
+            {self.uri('summa'), self.uri('ita_karjala'), self.uri('karjala')})
+        self.assertIn('match_time', arpa.get_stats())
+
+
+class TestCandidateGenerator(TestCase):
+    def test_ngrams(self):
+        generator = CandidateGenerator()
+        self.assertEqual(generator('Hanko, Itä-Karjala'), ['Hanko', 'Hanko Itä',
+            'Hanko Itä Karjala', 'Itä', 'Itä Karjala', 'Karjala'])
+        self.assertEqual(generator('Hanko hanko Hanko'), ['Hanko', 'Hanko hanko',
+            'Hanko hanko Hanko', 'hanko', 'hanko Hanko'])
+        self.assertEqual(generator('...'), [])
+
+    def test_length(self):
+        generator = CandidateGenerator(2, 3)
+        self.assertEqual(generator('a b c d'), ['a b', 'a b c', 'b c', 'b c d', 'c d'])
+        self.assertEqual(generator('a'), [])
+
+        self.assertRaises(ValueError, CandidateGenerator, 0)
+        self.assertRaises(ValueError, CandidateGenerator, 2, 1)
+
+    def test_normalize(self):
+        generator = CandidateGenerator(max_length=1, normalize=str.lower)
+        self.assertEqual(generator('Hanko hanko HANKO Summa'), ['hanko', 'summa'])
+
+        generator = CandidateGenerator(max_length=1,
+                normalize=lambda ngram: [ngram, ngram.rstrip('n')] if ngram.endswith('n') else [])
+        self.assertEqual(generator('Hangon Summan ja Kuhmo'), ['Hangon', 'Hango', 'Summan', 'Summa'])
+
+    def test_tokenize(self):
+        generator = CandidateGenerator(tokenize=str.split)
+        self.assertEqual(generator('Itä-Karjala, Hanko'), ['Itä-Karjala,', 'Itä-Karjala, Hanko', 'Hanko'])
+
+    def test_arpa(self):
+        # No requests are made: responses raises an error for any request
+        with responses.RequestsMock():
+            arpa = Arpa('http://url', min_ngram_length=2, ignore=['b c'],
+                    candidate_generator=CandidateGenerator(max_length=2))
+            res = arpa.get_candidates('a b c')
+            self.assertEqual(res, {'results': [Literal('a b')]})
+            self.assertIn('candidate_time', arpa.get_stats())
+
+            self.assertRaises(ValueError, arpa.get_candidates, '')
+            res = arpa.get_candidates_batch(['a b', ''])
+            self.assertEqual(res[0], {'results': [Literal('a b')]})
+            self.assertIsInstance(res[1], ValueError)
+
+    @responses.activate
+    def test_arpafy(self):
+        prop = URIRef('http://ldf.fi/schema/place')
+        tprop = URIRef('http://ldf.fi/schema/candidate')
+        graph = Graph()
+        graph.add((URIRef('http://ldf.fi/event'), prop, Literal('Hanko Summa')))
+
+        arpa = Arpa('http://url', candidate_generator=CandidateGenerator())
+        res = arpafy(graph, tprop, arpa, source_prop=prop, candidates_only=True)
+
+        self.assertEqual(res['matches'], 3)
+        self.assertEqual(set(graph.objects(URIRef('http://ldf.fi/event'), tprop)),
+                {Literal('Hanko'), Literal('Hanko Summa'), Literal('Summa')})
+        self.assertEqual(len(responses.calls), 0)
+
+
 class TestArpafy(TestCase):
     def setUp(self):
         self.matches = matches
@@ -800,6 +1467,180 @@ class TestArpafy(TestCase):
         self.assertEqual(len(responses.calls), 1, responses.calls[0].request.body)
         self.assertEqual(responses.calls[0].request.body, 'text=' + replaced)
 
+    @responses.activate
+    def test_rdf_class(self):
+        responses.add(responses.POST, 'http://url',
+                json=self.matches, status=200)
+
+        event_class = URIRef('http://warsa/Event')
+        event = URIRef('http://warsa/event_2')
+        self.graph.add((event, self.prop, Literal('Hanko')))
+        self.graph.add((event, self.prop, Literal('Helsinki')))
+        self.graph.add((event, RDF.type, event_class))
+
+        res = arpafy(self.graph, self.tprop, Arpa('http://url'), source_prop=self.prop,
+                rdf_class=event_class)
+
+        self.assertEqual(res['processed'], 2)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(set(self.graph.subjects(self.tprop)), {event})
+
+    @responses.activate
+    def test_workers(self):
+        responses.add(responses.POST, 'http://url',
+                json=self.matches, status=200)
+
+        for i in range(20):
+            self.graph.add((URIRef('http://warsa/event_{}'.format(i)), self.prop,
+                Literal('Hanko {}'.format(i))))
+
+        arpa = Arpa('http://url')
+        serial_graph = Graph()
+        serial_res = arpafy(self.graph, self.tprop, arpa, source_prop=self.prop,
+                output_graph=serial_graph)
+
+        concurrent_graph = Graph()
+        concurrent_res = arpafy(self.graph, self.tprop, arpa, source_prop=self.prop,
+                output_graph=concurrent_graph, workers=4)
+
+        self.assertEqual(len(responses.calls), 42)
+        self.assertEqual(set(serial_graph), set(concurrent_graph))
+        for key in ('processed', 'matches', 'subjects_matched', 'errors'):
+            self.assertEqual(serial_res[key], concurrent_res[key])
+
+    @responses.activate
+    def test_workers_with_errors(self):
+        responses.add(responses.POST, 'http://url',
+                body='error', status=503)
+
+        self.graph.add((URIRef('http://warsa/event_2'), self.prop, Literal('Hanko')))
+
+        arpa = Arpa('http://url')
+        res = arpafy(self.graph, self.tprop, arpa, source_prop=self.prop, workers=2)
+
+        self.assertEqual(len(res['errors']), 2)
+        self.assertEqual(res['matches'], 0)
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not available')
+class TestAsyncArpa(TestCase):
+    def setUp(self):
+        self.prop = URIRef('http://warsa/place')
+        self.tprop = URIRef('http://warsa/target')
+        self.graph = Graph()
+        for i in range(10):
+            self.graph.add((URIRef('http://warsa/event_{}'.format(i)), self.prop,
+                Literal('Hanko {}'.format(i))))
+
+    def test_matches_are_retrieved(self):
+        async def get_matches(url):
+            async with AsyncArpa(url, remove_duplicates=True) as arpa:
+                return await arpa.get_uri_matches('Hanko Hanko')
+
+        with StandInServer({'/': matches}) as server:
+            res = asyncio.run(get_matches(server.url))
+            expected = Arpa(server.url, remove_duplicates=True).get_uri_matches('Hanko Hanko')
+
+        self.assertEqual(res, expected)
+        self.assertEqual(len(res['results']), 2)
+
+    def test_candidates_are_retrieved(self):
+        async def get_candidates(url):
+            async with AsyncArpa(url) as arpa:
+                return await arpa.get_candidates('Hanko')
+
+        with StandInServer({'/?cgen': candidate_response}) as server:
+            res = asyncio.run(get_candidates(server.url))
+
+        self.assertEqual(set(res['results']), candidate_values)
+
+    def test_mimic(self):
+        async def get_matches(url):
+            async with AsyncArpaMimic('<VALUES>', url, min_ngram_length=2) as arpa:
+                return await arpa.get_uri_matches('Hanko Hanko')
+
+        with StandInServer({'/': sparql_result_with_duplicates}) as server:
+            res = asyncio.run(get_matches(server.url))
+
+        self.assertEqual(res['results'], [URIRef('http://ldf.fi/warsa/actors/person_1')])
+        self.assertEqual(server.requests[0][1], 'query=Hanko+Hanko')
+
+    def test_retries(self):
+        async def get_matches(url):
+            async with AsyncArpa(url, retries=1, wait_between_tries=0) as arpa:
+                return await arpa.get_uri_matches('Hanko Hanko')
+
+        with StandInServer({'/': 503}) as server:
+            self.assertRaises(HTTPError, asyncio.run, get_matches(server.url))
+
+        self.assertEqual(len(server.requests), 2)
+
+        # Not retried
+        with StandInServer({'/': 400}) as server:
+            self.assertRaises(HTTPError, asyncio.run, get_matches(server.url))
+
+        self.assertEqual(len(server.requests), 1)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+
+        async def get_matches(url):
+            async with AsyncArpa(url, retries=1, wait_between_tries=0,
+                    circuit_breaker=breaker) as arpa:
+                return await arpa.get_uri_matches('Hanko Hanko')
+
+        with StandInServer({'/': 503}) as server:
+            self.assertRaises(HTTPError, asyncio.run, get_matches(server.url))
+
+        self.assertTrue(breaker.is_open)
+        self.assertEqual(breaker.failures, 2)
+
+    def test_throttle(self):
+        throttle = Throttle(max_concurrency=2, rate=1000, latency_tolerance=None)
+
+        with StandInServer({'/': matches}) as server:
+            res = asyncio.run(arpafy_async(self.graph, self.tprop,
+                AsyncArpa(server.url, throttle=throttle), source_prop=self.prop,
+                output_graph=Graph()))
+
+        self.assertEqual(res['matches'], 30)
+        self.assertEqual(res['concurrency_limit'], 2)
+        self.assertEqual(throttle._in_flight, 0)
+
+    def test_empty_query(self):
+        async def get_matches():
+            async with AsyncArpa('http://url') as arpa:
+                return await arpa.get_uri_matches('')
+
+        self.assertRaises(ValueError, asyncio.run, get_matches())
+
+    def test_arpafy_async(self):
+        with StandInServer({'/': matches}) as server:
+            serial_graph = Graph()
+            serial_res = arpafy(self.graph, self.tprop, Arpa(server.url),
+                    source_prop=self.prop, output_graph=serial_graph)
+            async_graph = Graph()
+            async_res = asyncio.run(arpafy_async(self.graph, self.tprop, AsyncArpa(server.url),
+                    source_prop=self.prop, output_graph=async_graph, concurrency=3))
+
+        self.assertEqual(set(serial_graph), set(async_graph))
+        self.assertEqual(async_res['processed'], 10)
+        self.assertEqual(async_res['matches'], 30)
+        self.assertEqual(async_res['subjects_matched'], 10)
+        self.assertEqual(async_res['errors'], [])
+
+    def test_arpafy_async_errors(self):
+        with StandInServer({'/': 500}) as server:
+            res = asyncio.run(arpafy_async(self.graph, self.tprop, AsyncArpa(server.url),
+                    source_prop=self.prop))
+
+        self.assertEqual(len(res['errors']), 10)
+        self.assertEqual(res['matches'], 0)
+
+    def test_invalid_concurrency(self):
+        self.assertRaises(ValueError, asyncio.run, arpafy_async(self.graph, self.tprop,
+            AsyncArpa('http://url'), source_prop=self.prop, concurrency=0))
+
 
 class TestProcess(TestCase):
     def setUp(self):
@@ -842,6 +1683,36 @@ class TestProcess(TestCase):
 
         self.assertEqual(len(res['graph']), original_len + len(match_uris))
 
+    @responses.activate
+    @patch('arpa.Graph')
+    def test_run_report(self, mocked_graph):
+        responses.add(responses.POST, 'http://url', json=self.matches, status=200)
+
+        mocked_graph.side_effect = [self.graph, Graph()]
+        validator = Mock()
+        validator.validate.side_effect = lambda results, *args: results
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_file = os.path.join(tmp_dir, 'report.json')
+            res = process('input', 'turtle', 'output', 'turtle', source_prop=self.prop,
+                    target_prop=self.tprop, arpa=Arpa('http://url'), validator=validator,
+                    report_file=report_file)
+            with open(report_file) as f:
+                report = json.load(f)
+
+        for key in ('parse_time', 'selection_time', 'http_time', 'decode_time', 'filter_time',
+                'validation_time', 'write_time', 'arpafy_time', 'serialization_time'):
+            self.assertGreaterEqual(res[key], 0, key)
+            self.assertEqual(report[key], res[key])
+        self.assertGreaterEqual(res['runtime'], res['arpafy_time'])
+        self.assertEqual(res['requests'], 1)
+        self.assertEqual(res['bytes_sent'], len('text=Hanko'))
+        self.assertEqual(res['bytes_received'], len(json.dumps(self.matches)))
+        self.assertNotIn('retries', res)
+        self.assertEqual(report['processed'], 1)
+        self.assertEqual(report['errors'], [])
+        self.assertNotIn('graph', report)
+
     @responses.activate
     @patch('arpa.Graph')
     def test_process_in_new_graph(self, mocked_graph):
@@ -924,37 +1795,281 @@ class TestProcess(TestCase):
         self.assertEqual(0, len(res['graph']))
 
 
-class TestParseArgs(TestCase):
+class TestProcesses(TestCase):
     def setUp(self):
-        self.base_params = ['input.ttl', 'output.ttl', 'target', 'url']
+        ns = 'http://ldf.fi/warsa/places/'
+        self.vocabulary = Graph()
+        for name in ['Hanko', 'Summa', 'Kuhmo', 'Itä-Karjala']:
+            s = URIRef(ns + name.lower())
+            self.vocabulary.add((s, SKOS.prefLabel, Literal(name)))
+            self.vocabulary.add((s, RDF.type, URIRef(ns + 'Kunta')))
+
+        self.prop = URIRef('http://ldf.fi/schema/place')
+        self.tprop = URIRef('http://ldf.fi/schema/place_link')
+        self.type = URIRef('http://ldf.fi/schema/Event')
+        self.graph = Graph()
+        texts = ['Hanko', 'Summa ja Kuhmo', 'Helsinki', 'Itä-Karjala', 'Kuhmo, Hanko']
+        for i in range(40):
+            s = URIRef('http://ldf.fi/event_{}'.format(i))
+            self.graph.add((s, self.prop, Literal(texts[i % len(texts)])))
+            self.graph.add((s, RDF.type, self.type))
 
-    def test_parse_empty_args(self):
-        self.assertRaises(SystemExit, parse_args, [])
+        class Validator:
+            def validate(self, results, text, s):
+                # Drop the matches of every third subject
+                return [] if int(str(s).split('_')[-1]) % 3 == 0 else results
+
+        self.validator = Validator()
+
+    def run_process_graph(self, **kwargs):
+        return process_graph(self.graph, self.tprop, LocalArpa(self.vocabulary),
+                new_graph=True, source_prop=self.prop, rdf_class=self.type,
+                validator=self.validator, **kwargs)
+
+    def test_get_shard(self):
+        subjects = [URIRef('http://ldf.fi/event_{}'.format(i)) for i in range(100)]
+        shards = [get_shard(s, 4) for s in subjects]
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+        self.assertEqual(shards, [get_shard(s, 4) for s in subjects])
+        self.assertEqual({get_shard(s, 1) for s in subjects}, {0})
+
+    def test_split_graph(self):
+        place = URIRef('http://ldf.fi/warsa/places/hanko')
+        self.graph.add((place, SKOS.prefLabel, Literal('Hanko')))
+
+        parts = split_graph(self.graph, 3)
+        self.assertEqual(sum(len(g) for g in parts), len(self.graph))
+        for index, g in enumerate(parts):
+            self.assertTrue(all(get_shard(s, 3) == index for s in g.subjects()))
+            for s in g.subjects():
+                self.assertEqual(set(g.triples((s, None, None))),
+                        set(self.graph.triples((s, None, None))))
+
+        # Only the instances of the class are split, the rest are in every part
+        parts = split_graph(self.graph, 3, self.prop, self.type)
+        self.assertEqual(sum(len(g) for g in parts), len(self.graph) + 2)
+        self.assertTrue(all((place, SKOS.prefLabel, Literal('Hanko')) in g for g in parts))
+
+        merged = Graph()
+        for g in parts:
+            merged += g
+        self.assertEqual(set(merged), set(self.graph))
+
+        self.assertEqual(len(split_graph(self.graph, 1)[0]), len(self.graph))
+        self.assertRaises(ValueError, split_graph, self.graph, 0)
+
+    def test_arpafy_shard(self):
+        arpa = LocalArpa(self.vocabulary)
+        processed = 0
+        for index in range(3):
+            output_graph = Graph()
+            res = arpafy(self.graph, self.tprop, arpa, source_prop=self.prop,
+                    output_graph=output_graph, shard=(index, 3))
+            processed += res['processed']
+            self.assertTrue(all(get_shard(s, 3) == index for s in output_graph.subjects()))
+        self.assertEqual(processed, 40)
+
+    def test_processes(self):
+        expected = self.run_process_graph()
+        res = self.run_process_graph(processes=3, workers=2)
+
+        self.assertEqual(set(res['graph']), set(expected['graph']))
+        self.assertEqual(len(res['graph']), 30)
+        self.assertEqual(res['processes'], 3)
+        for key in ['processed', 'matches', 'subjects_matched', 'pre_validation_mention_count',
+                'post_validation_mention_count']:
+            self.assertEqual(res[key], expected[key], key)
+        self.assertEqual(res['errors'], [])
+        self.assertIn('match_time', res)
+        self.assertIn('merge_time', res)
+
+    def test_limits(self):
+        throttle = Throttle(max_concurrency=4, rate=8, burst=4)
+        arpa = LocalArpa(self.vocabulary, throttle=throttle)
+        res = process_graph(self.graph, self.tprop, arpa, new_graph=True,
+                source_prop=self.prop, processes=2)
+        self.assertEqual(res['processed'], 40)
+        # Only the copies in the worker processes are changed
+        self.assertEqual(throttle.rate, 8)
+
+        # The rate limit is divided between the processes
+        arpa._share_limits(4)
+        self.assertEqual(throttle.rate, 2)
+        self.assertEqual(throttle.burst, 1)
+        self.assertEqual(throttle.max_concurrency, 4)
+
+        arpa = LocalArpa(self.vocabulary, circuit_breaker=CircuitBreaker())
+        self.assertRaises(ValueError, process_graph, self.graph, self.tprop, arpa,
+                source_prop=self.prop, processes=2)
+
+    def test_cache(self):
+        # The processes can not share the size limit or the database of a cache
+        arpa = LocalArpa(self.vocabulary, cache=QueryCache(':memory:'))
+        self.assertRaises(ValueError, process_graph, self.graph, self.tprop, arpa,
+                new_graph=True, source_prop=self.prop, processes=2)
+
+        res = process_graph(self.graph, self.tprop, arpa, new_graph=True,
+                source_prop=self.prop, processes=1)
+        self.assertEqual(res['processed'], 40)
+
+    def test_processes_in_same_graph(self):
+        original_len = len(self.graph)
+        res = process_graph(self.graph, self.tprop, LocalArpa(self.vocabulary),
+                source_prop=self.prop, processes=2, candidates_only=True)
 
-    def test_parse_minimal_args(self):
-        args = parse_args(self.base_params)
+        self.assertIs(res['graph'], self.graph)
+        self.assertEqual(res['processed'], 40)
+        self.assertEqual(len(self.graph), original_len + res['matches'])
 
-        self.assertEqual(args.input, 'input.ttl')
-        self.assertEqual(args.output, 'output.ttl')
-        self.assertEqual(args.tprop, URIRef('target'))
-        self.assertEqual(args.arpa, 'url')
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with Checkpoint(os.path.join(tmp_dir, 'checkpoint.jsonl')) as checkpoint:
+                self.assertRaises(ValueError, self.run_process_graph, processes=2,
+                        checkpoint=checkpoint)
 
-        self.assertEqual(args.fi, 'turtle')
-        self.assertEqual(args.fo, 'turtle')
-        self.assertEqual(args.min_ngram, 1)
-        self.assertEqual(args.no_duplicates, False)
-        self.assertEqual(args.new_graph, False)
-        self.assertEqual(args.retries, 0)
-        self.assertEqual(args.wait, 1)
-        self.assertEqual(args.log_level, 'INFO')
 
-        self.assertEqual(args.prop, None)
-        self.assertEqual(args.rdf_class, None)
-        self.assertEqual(args.ignore, None)
+class TestProcessStream(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.tmp_dir.name, 'input.nt')
+        self.output = os.path.join(self.tmp_dir.name, 'output.nt')
 
-    def test_rdf_class(self):
-        params = self.base_params + ['--rdf_class', 'http://type']
-        params = ['input.ttl', 'output.ttl', 'target', 'url', '--rdf_class', 'http://type']
+        self.prop = URIRef('http://warsa/place')
+        self.tprop = URIRef('http://warsa/target')
+        self.event_class = URIRef('http://warsa/Event')
+        self.graph = Graph()
+        for i in range(5):
+            event = URIRef('http://warsa/event_{}'.format(i))
+            self.graph.add((event, self.prop, Literal('Hanko "{}"\n'.format(i), lang='fi')))
+            self.graph.add((event, RDF.type, self.event_class if i % 2 else URIRef('http://warsa/Other')))
+        self.graph.add((BNode('b1'), self.prop, Literal('Hanko')))
+        graph_serialize(self.graph, destination=self.input, format='nt')
+
+        responses.add(responses.POST, 'http://url', json=matches, status=200)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read_output(self, format='nt'):
+        g = Dataset() if format == 'nquads' else Graph()
+        graph_parse(g, self.output, format=format)
+        return g
+
+    @responses.activate
+    def test_stream(self):
+        res = process_stream(self.input, 'nt', self.output, 'nt', self.tprop, Arpa('http://url'),
+                source_prop=self.prop)
+
+        expected = arpafy(self.graph, self.tprop, Arpa('http://url'), source_prop=self.prop,
+                output_graph=Graph())
+        output = self.read_output()
+
+        self.assertIsNone(res['graph'])
+        self.assertEqual(res['processed'], 6)
+        self.assertEqual(res['matches'], expected['matches'])
+        self.assertEqual(res['subjects_matched'], 6)
+        self.assertEqual(len(output), len(self.graph) + 18)
+        for triple in self.graph:
+            if not isinstance(triple[0], BNode):
+                self.assertIn(triple, output)
+        self.assertEqual(set(output.triples((URIRef('http://warsa/event_1'), self.tprop, None))),
+                set(expected['graph'].triples((URIRef('http://warsa/event_1'), self.tprop, None))))
+        # The blank node subject of the source triple is also the subject of the links
+        bnodes = set(output.subjects(self.prop, Literal('Hanko')))
+        self.assertEqual(len(bnodes), 1)
+        self.assertEqual(len(set(output.objects(bnodes.pop(), self.tprop))), 3)
+
+    @responses.activate
+    def test_new_graph_and_rdf_class(self):
+        res = process_stream(self.input, 'nt', self.output, None, self.tprop, Arpa('http://url'),
+                source_prop=self.prop, rdf_class=self.event_class, new_graph=True, workers=2)
+
+        output = self.read_output()
+
+        self.assertEqual(res['processed'], 2)
+        self.assertEqual(len(output), 6)
+        self.assertEqual(set(output.subjects()), {URIRef('http://warsa/event_1'),
+            URIRef('http://warsa/event_3')})
+        self.assertEqual(set(output.predicates()), {self.tprop})
+
+    @responses.activate
+    def test_nquads(self):
+        ds = Dataset()
+        ds.graph(URIRef('http://warsa/graph')).add(
+                (URIRef('http://warsa/event'), self.prop, Literal('Hanko')))
+        ds.add((URIRef('http://warsa/event_2'), self.prop, Literal('Hanko')))
+        nq_input = os.path.join(self.tmp_dir.name, 'input.nq')
+        graph_serialize(ds, destination=nq_input, format='nquads')
+
+        res = process(nq_input, 'nquads', self.output, 'nquads', self.tprop, Arpa('http://url'),
+                source_prop=self.prop, stream=True)
+
+        output = self.read_output('nquads')
+
+        self.assertEqual(res['processed'], 2)
+        self.assertEqual(len(list(output.quads())), 8)
+        self.assertIn((URIRef('http://warsa/event'), self.prop, Literal('Hanko'),
+            URIRef('http://warsa/graph')), set(output.quads()))
+
+    @responses.activate
+    def test_stream_links(self):
+        with patch.object(Graph, 'parse', graph_parse):
+            res = process(self.input, 'nt', self.output, 'turtle', self.tprop,
+                    Arpa('http://url'), source_prop=self.prop, rdf_class=self.event_class,
+                    new_graph=True, stream_links=True)
+
+        output = self.read_output()
+
+        self.assertIsInstance(res['graph'], LinkWriter)
+        self.assertEqual(res['processed'], 2)
+        self.assertEqual(len(res['graph']), 6)
+        self.assertEqual(len(output), 6)
+        self.assertEqual(set(output.predicates()), {self.tprop})
+
+        self.assertRaises(ValueError, process, self.input, 'nt', self.output, 'nt',
+                self.tprop, Arpa('http://url'), stream_links=True)
+
+    def test_invalid_params(self):
+        arpa = Arpa('http://url')
+        self.assertRaises(ValueError, process_stream, self.input, 'turtle', self.output,
+                'turtle', self.tprop, arpa)
+        self.assertRaises(ValueError, process_stream, self.input, 'nt', self.output,
+                'nt', self.tprop, arpa, prune=True)
+        self.assertRaises(ValueError, process, self.input, 'nt', self.output, 'nt',
+                self.tprop, arpa, validator_class=Mock(), stream=True)
+
+
+class TestParseArgs(TestCase):
+    def setUp(self):
+        self.base_params = ['input.ttl', 'output.ttl', 'target', 'url']
+
+    def test_parse_empty_args(self):
+        self.assertRaises(SystemExit, parse_args, [])
+
+    def test_parse_minimal_args(self):
+        args = parse_args(self.base_params)
+
+        self.assertEqual(args.input, 'input.ttl')
+        self.assertEqual(args.output, 'output.ttl')
+        self.assertEqual(args.tprop, URIRef('target'))
+        self.assertEqual(args.arpa, 'url')
+
+        self.assertEqual(args.fi, 'turtle')
+        self.assertEqual(args.fo, 'turtle')
+        self.assertEqual(args.min_ngram, 1)
+        self.assertEqual(args.no_duplicates, False)
+        self.assertEqual(args.new_graph, False)
+        self.assertEqual(args.retries, 0)
+        self.assertEqual(args.wait, 1)
+        self.assertEqual(args.log_level, 'INFO')
+
+        self.assertEqual(args.prop, None)
+        self.assertEqual(args.rdf_class, None)
+        self.assertEqual(args.ignore, None)
+
+    def test_rdf_class(self):
+        params = self.base_params + ['--rdf_class', 'http://type']
+        params = ['input.ttl', 'output.ttl', 'target', 'url', '--rdf_class', 'http://type']
         args = parse_args(params)
 
         self.assertEqual(args.rdf_class, URIRef('http://type'))
@@ -1033,6 +2148,165 @@ class TestParseArgs(TestCase):
 
         self.assertEqual(args.wait, 4)
 
+    def test_workers(self):
+        args = parse_args(self.base_params)
+
+        self.assertEqual(args.workers, 1)
+
+        params = self.base_params + ['--workers', '8']
+        args = parse_args(params)
+
+        self.assertEqual(args.workers, 8)
+
+        params = self.base_params + ['--workers', '0']
+        self.assertRaises(SystemExit, parse_args, params)
+
+    def test_batch_size(self):
+        args = parse_args(self.base_params)
+
+        self.assertIsNone(args.batch_size)
+        self.assertIsNone(args.batch_bytes)
+
+        params = self.base_params + ['--batch_size', '50', '--batch_bytes', '10000']
+        args = parse_args(params)
+
+        self.assertEqual(args.batch_size, 50)
+        self.assertEqual(args.batch_bytes, 10000)
+
+        params = self.base_params + ['--batch_size', '0']
+        self.assertRaises(SystemExit, parse_args, params)
+
+    def test_stream(self):
+        args = parse_args(self.base_params)
+
+        self.assertFalse(args.stream)
+
+        args = parse_args(self.base_params + ['--stream'])
+
+        self.assertTrue(args.stream)
+
+    def test_cache(self):
+        args = parse_args(self.base_params)
+
+        self.assertIsNone(args.cache)
+
+        params = self.base_params + ['--cache', 'cache.db', '--cache_size', '100',
+                '--cache_ttl', '3600']
+        args = parse_args(params)
+
+        self.assertEqual(args.cache, 'cache.db')
+        self.assertEqual(args.cache_size, 100)
+        self.assertEqual(args.cache_ttl, 3600)
+
+    def test_throttle(self):
+        args = parse_args(self.base_params)
+
+        self.assertFalse(args.adaptive)
+        self.assertIsNone(args.max_rate)
+
+        args = parse_args(self.base_params + ['--adaptive', '--max_rate', '5.5'])
+
+        self.assertTrue(args.adaptive)
+        self.assertEqual(args.max_rate, 5.5)
+
+        self.assertRaises(SystemExit, parse_args, self.base_params + ['--max_rate', '0'])
+
+    def test_backoff(self):
+        args = parse_args(self.base_params)
+
+        self.assertEqual(args.backoff, 1)
+        self.assertIsNone(args.max_wait)
+        self.assertEqual(args.jitter, 0)
+        self.assertIsNone(args.breaker_threshold)
+
+        params = self.base_params + ['--backoff', '2', '--max_wait', '60', '--jitter', '0.5',
+                '--breaker_threshold', '5', '--breaker_timeout', '10']
+        args = parse_args(params)
+
+        self.assertEqual(args.backoff, 2)
+        self.assertEqual(args.max_wait, 60)
+        self.assertEqual(args.jitter, 0.5)
+        self.assertEqual(args.breaker_threshold, 5)
+        self.assertEqual(args.breaker_timeout, 10)
+
+        self.assertRaises(SystemExit, parse_args, self.base_params + ['--backoff', '0.5'])
+        self.assertRaises(SystemExit, parse_args, self.base_params + ['--jitter', '2'])
+        self.assertRaises(SystemExit, parse_args, self.base_params + ['--breaker_threshold', '0'])
+
+    def test_report(self):
+        self.assertIsNone(parse_args(self.base_params).report)
+        self.assertEqual(parse_args(self.base_params + ['--report', 'report.json']).report,
+                'report.json')
+
+    def test_checkpoint(self):
+        args = parse_args(self.base_params)
+
+        self.assertIsNone(args.checkpoint)
+        self.assertFalse(args.resume)
+
+        params = self.base_params + ['--checkpoint', 'checkpoint.jsonl', '--checkpoint_interval',
+                '10', '--resume']
+        args = parse_args(params)
+
+        self.assertEqual(args.checkpoint, 'checkpoint.jsonl')
+        self.assertEqual(args.checkpoint_interval, 10)
+        self.assertTrue(args.resume)
+
+        self.assertRaises(SystemExit, parse_args, self.base_params + ['--resume'])
+        params = self.base_params + ['--checkpoint', 'checkpoint.jsonl', '--checkpoint_interval',
+                '0']
+        self.assertRaises(SystemExit, parse_args, params)
+
+    def test_manifest(self):
+        self.assertIsNone(parse_args(self.base_params).manifest)
+        self.assertEqual(parse_args(self.base_params + ['--manifest', 'm.jsonl']).manifest,
+                'm.jsonl')
+        self.assertRaises(SystemExit, parse_args,
+                self.base_params + ['--manifest', 'm.jsonl', '--processes', '2'])
+
+    def test_validation_window(self):
+        self.assertEqual(parse_args(self.base_params).validation_window, 100)
+        self.assertEqual(parse_args(self.base_params + ['--validation_window', '5'])
+                .validation_window, 5)
+        self.assertRaises(SystemExit, parse_args, self.base_params + ['--validation_window', '0'])
+
+    def test_stream_links(self):
+        self.assertFalse(parse_args(self.base_params).stream_links)
+        self.assertTrue(parse_args(self.base_params + ['-n', '--stream_links']).stream_links)
+        self.assertRaises(SystemExit, parse_args, self.base_params + ['--stream_links'])
+
+    def test_processes(self):
+        self.assertEqual(parse_args(self.base_params).processes, 1)
+        self.assertEqual(parse_args(self.base_params + ['--processes', '4']).processes, 4)
+
+        self.assertRaises(SystemExit, parse_args, self.base_params + ['--processes', '0'])
+        self.assertRaises(SystemExit, parse_args, self.base_params + ['--processes', '2',
+            '--stream'])
+        self.assertRaises(SystemExit, parse_args, self.base_params + ['--processes', '2',
+            '--checkpoint', 'checkpoint.jsonl'])
+        self.assertRaises(SystemExit, parse_args, self.base_params + ['--processes', '2',
+            '--breaker_threshold', '5'])
+        self.assertRaises(SystemExit, parse_args, self.base_params + ['--processes', '2',
+            '--cache', 'cache.db'])
+
+    def test_local_candidates(self):
+        args = parse_args(self.base_params)
+
+        self.assertFalse(args.local_candidates)
+        self.assertIsNone(args.max_ngram)
+        self.assertIsNone(get_candidate_generator(args))
+
+        args = parse_args(self.base_params + ['--local_candidates', '--min_ngram', '2',
+            '--max_ngram', '3'])
+        generator = get_candidate_generator(args)
+
+        self.assertTrue(args.local_candidates)
+        self.assertEqual(generator.min_length, 2)
+        self.assertEqual(generator.max_length, 3)
+
+        params = self.base_params + ['--min_ngram', '2', '--max_ngram', '1']
+        self.assertRaises(SystemExit, parse_args, params)
+
     def test_log_level(self):
         params = self.base_params + ['--log_level', 'DEBUG']
         args = parse_args(params)
@@ -1088,6 +2362,23 @@ class TestPruneCandidates(TestCase):
         self.assertEqual(1, len(g))
         self.assertEqual(self.value, str(list(g.objects())[0]))
 
+    def test_rdf_class(self):
+        def pruner(cand):
+            return cand.upper()
+
+        event_class = URIRef('http://warsa/Event')
+        triple3 = (URIRef('http://warsa/event_2'), self.prop, Literal(self.value))
+        self.graph.add(triple3)
+        self.graph.add((URIRef('http://warsa/event_2'), RDF.type, event_class))
+
+        res = prune_candidates(self.graph, self.prop, pruner, rdf_class=event_class)
+
+        self.assertEqual(res['result_count'], 1)
+        self.assertEqual(4, len(self.graph))
+        self.assertIn(self.triple, self.graph)
+        self.assertIn(self.triple2, self.graph)
+        self.assertIn((URIRef('http://warsa/event_2'), self.prop, Literal('HANKO')), self.graph)
+
     def test_output_graph(self):
         def pruner(cand):
             return cand if cand == 'Hanko' else None
@@ -1104,6 +2395,38 @@ class TestPruneCandidates(TestCase):
         self.assertTrue(self.triple in self.graph)
         self.assertTrue(self.triple2 in self.graph)
 
+    def test_cache(self):
+        pruner = Mock(side_effect=lambda cand: cand.lower() if cand != 'Toinen' else None)
+        for i in range(5):
+            self.graph.add((URIRef('http://warsa/event_{}'.format(i)), self.prop, Literal('Hanko')))
+        self.graph.add((URIRef('http://warsa/event_0'), self.prop, Literal('Toinen')))
+
+        res = prune_candidates(self.graph, self.prop, pruner)
+
+        self.assertEqual(pruner.call_count, 2)
+        self.assertEqual(res['pruner_cache_hits'], 6)
+        self.assertEqual(res['pruner_cache_misses'], 2)
+        self.assertEqual(res['result_count'], 6)
+        self.assertEqual(set(self.graph.objects()), {Literal('hanko')})
+        self.assertEqual(len(self.graph), 6)
+
+        pruner.reset_mock()
+        res = prune_candidates(self.graph, self.prop, pruner, cache_size=0)
+
+        self.assertEqual(pruner.call_count, 6)
+        self.assertNotIn('pruner_cache_hits', res)
+
+    def test_pruned_value_is_an_original_value(self):
+        def pruner(cand):
+            return cand.split()[0] if cand != 'Hanko' else None
+
+        self.graph.add((URIRef('http://warsa/event'), self.prop, Literal('Hanko Suomi')))
+
+        res = prune_candidates(self.graph, self.prop, pruner)
+
+        self.assertEqual(set(self.graph.objects()), {Literal('Hanko'), Literal('Toinen')})
+        self.assertEqual(res['result_count'], 2)
+
 
 class TestPost(TestCase):
     def setUp(self):
@@ -1178,6 +2501,15 @@ class TestPost(TestCase):
         self.assertRaises(HTTPError, post, url=self.url, data=self.data, retries=0)
         self.assertEqual(len(responses.calls), 1)
 
+    def test_session(self):
+        session = Mock()
+        session.post.return_value.json.return_value = self.matches
+
+        res = post(self.url, self.data, session=session)
+
+        self.assertEqual(res, self.matches)
+        session.post.assert_called_once_with(self.url, self.data)
+
     @responses.activate
     def test_invalid_retries(self):
         responses.add(responses.POST, self.url,
@@ -1206,6 +2538,925 @@ class TestPost(TestCase):
         self.assertRaises(TypeError, post, url=self.url, data=self.data,
                 wait="string")
 
+    def test_invalid_backoff_params(self):
+        self.assertRaises(ValueError, post, self.url, self.data, backoff=0.5)
+        self.assertRaises(ValueError, post, self.url, self.data, max_wait=-1)
+        self.assertRaises(ValueError, post, self.url, self.data, jitter=1.5)
+        self.assertRaises(ValueError, Arpa, 'url', backoff=0.5)
+        self.assertRaises(ValueError, ArpaMimic, '', 'url', jitter=-1)
+
+    @responses.activate
+    @patch('arpa.time')
+    def test_backoff(self, mock_time):
+        responses.add(responses.POST, self.url, json=self.error, status=503)
+
+        self.assertRaises(HTTPError, post, self.url, self.data, retries=3, wait=1, backoff=2)
+        self.assertEqual([c[0][0] for c in mock_time.sleep.call_args_list], [1, 2, 4])
+
+        mock_time.sleep.reset_mock()
+
+        self.assertRaises(HTTPError, post, self.url, self.data, retries=3, wait=1, backoff=2,
+                max_wait=3)
+        self.assertEqual([c[0][0] for c in mock_time.sleep.call_args_list], [1, 2, 3])
+
+    @responses.activate
+    @patch('arpa.random')
+    @patch('arpa.time')
+    def test_jitter(self, mock_time, mock_random):
+        responses.add(responses.POST, self.url, json=self.error, status=503)
+        mock_random.uniform.return_value = 1
+
+        self.assertRaises(HTTPError, post, self.url, self.data, retries=1, wait=4, jitter=0.5)
+        mock_random.uniform.assert_called_once_with(0, 2)
+        mock_time.sleep.assert_called_once_with(3)
+
+    @responses.activate
+    @patch('arpa.time')
+    def test_retry_after(self, mock_time):
+        responses.add(responses.POST, self.url, json=self.error, status=429,
+                headers={'Retry-After': '5'})
+        responses.add(responses.POST, self.url, json=self.matches, status=200)
+
+        res = post(self.url, self.data, retries=1, wait=1)
+
+        self.assertEqual(res, self.matches)
+        mock_time.sleep.assert_called_once_with(5)
+
+        responses.reset()
+        responses.add(responses.POST, self.url, json=self.error, status=503,
+                headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        mock_time.sleep.reset_mock()
+
+        # A date in the past
+        self.assertRaises(HTTPError, post, self.url, self.data, retries=1, wait=1)
+        mock_time.sleep.assert_called_once_with(1)
+
+    @responses.activate
+    @patch('arpa.time')
+    def test_fatal_status(self, mock_time):
+        responses.add(responses.POST, self.url, json=self.error, status=400)
+
+        self.assertRaises(HTTPError, post, self.url, self.data, retries=3)
+        self.assertEqual(len(responses.calls), 1)
+        mock_time.sleep.assert_not_called()
+
+    @responses.activate
+    @patch('arpa.time')
+    def test_connection_error(self, mock_time):
+        responses.add(responses.POST, self.url, body=requests.ConnectionError('refused'))
+
+        self.assertRaises(HTTPError, post, self.url, self.data, retries=2)
+        self.assertEqual(len(responses.calls), 3)
+
+    @responses.activate
+    @patch('arpa.time')
+    def test_circuit_breaker(self, mock_time):
+        responses.add(responses.POST, self.url, json=self.error, status=503)
+        mock_time.monotonic.return_value = 100
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+        self.assertRaises(HTTPError, post, self.url, self.data, circuit_breaker=breaker)
+        self.assertFalse(breaker.is_open)
+
+        self.assertRaises(HTTPError, post, self.url, self.data, circuit_breaker=breaker)
+        self.assertTrue(breaker.is_open)
+
+        def advance(seconds):
+            mock_time.monotonic.return_value += seconds
+
+        # The next request waits until the circuit can be tried again
+        mock_time.sleep.side_effect = advance
+        responses.reset()
+        responses.add(responses.POST, self.url, json=self.matches, status=200)
+
+        self.assertEqual(post(self.url, self.data, circuit_breaker=breaker), self.matches)
+        mock_time.sleep.assert_called_once_with(30)
+        self.assertFalse(breaker.is_open)
+        self.assertEqual(breaker.failures, 0)
+
+
+class TestCircuitBreaker(TestCase):
+    @patch('arpa.time')
+    def test_open_and_close(self, mock_time):
+        mock_time.monotonic.return_value = 0
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertEqual(breaker.get_delay(), 0)
+
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.assertEqual(breaker.get_delay(), 10)
+        self.assertEqual(breaker.times_opened, 1)
+
+        mock_time.monotonic.return_value = 10
+        # A single trial request is let through
+        self.assertEqual(breaker.get_delay(), 0)
+        self.assertGreater(breaker.get_delay(), 0)
+
+        # The trial failed
+        breaker.record_failure()
+        self.assertEqual(breaker.get_delay(), 10)
+        self.assertEqual(breaker.times_opened, 2)
+
+        mock_time.monotonic.return_value = 20
+        self.assertEqual(breaker.get_delay(), 0)
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        self.assertEqual(breaker.get_delay(), 0)
+        self.assertEqual(breaker.get_delay(), 0)
+
+    def test_invalid_params(self):
+        self.assertRaises(ValueError, CircuitBreaker, failure_threshold=0)
+        self.assertRaises(ValueError, CircuitBreaker, reset_timeout=-1)
+
+    @responses.activate
+    @patch('arpa.time')
+    def test_fatal_errors_do_not_open(self, mock_time):
+        responses.add(responses.POST, 'http://url', json={}, status=404)
+        breaker = CircuitBreaker(failure_threshold=1)
+
+        arpa = Arpa('http://url', retries=2, circuit_breaker=breaker)
+        self.assertRaises(HTTPError, arpa.get_uri_matches, 'Hanko')
+        self.assertFalse(breaker.is_open)
+
+    @responses.activate
+    @patch('arpa.time')
+    def test_shared_by_arpa_instances(self, mock_time):
+        responses.add(responses.POST, 'http://url', json={}, status=503)
+        mock_time.monotonic.return_value = 0
+        breaker = CircuitBreaker(failure_threshold=2)
+
+        self.assertRaises(HTTPError, Arpa('http://url', circuit_breaker=breaker).query, 'Hanko')
+        self.assertRaises(HTTPError, ArpaMimic('<VALUES>', 'http://url',
+            circuit_breaker=breaker).query, 'Hanko')
+        self.assertTrue(breaker.is_open)
+
+
+    @responses.activate
+    def test_trial_with_unexpected_error(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+
+        responses.add(responses.POST, 'http://url',
+                body=requests.exceptions.ChunkedEncodingError('Connection broken'))
+        self.assertRaises(requests.exceptions.ChunkedEncodingError, post, 'http://url', {},
+                circuit_breaker=breaker)
+        # The failed trial is recorded, so another trial is let through
+        self.assertEqual(breaker.failures, 2)
+        self.assertEqual(breaker.get_delay(), 0)
+        breaker.record_failure()
+
+        session = Mock()
+        session.post.side_effect = KeyboardInterrupt
+        self.assertRaises(KeyboardInterrupt, post, 'http://url', {}, session=session,
+                circuit_breaker=breaker)
+        # An interrupted trial is not counted as a failure
+        self.assertEqual(breaker.failures, 3)
+        self.assertTrue(breaker.is_open)
+
+        responses.replace(responses.POST, 'http://url', json=matches)
+        self.assertEqual(post('http://url', {}, circuit_breaker=breaker), matches)
+        self.assertFalse(breaker.is_open)
+
+
+class TestThrottle(TestCase):
+    @patch('arpa.time')
+    def test_aimd(self, mock_time):
+        mock_time.monotonic.return_value = 0
+        throttle = Throttle(max_concurrency=4, latency_tolerance=None)
+
+        self.assertEqual(throttle.get_limits(), {'concurrency_limit': 1})
+
+        throttle.release(throttle.acquire())
+        self.assertEqual(throttle.get_limits(), {'concurrency_limit': 2})
+
+        # Additive increase: about one per round of requests
+        tokens = [throttle.acquire(), throttle.acquire()]
+        for token in tokens:
+            throttle.release(token)
+        self.assertEqual(throttle.get_limits(), {'concurrency_limit': 2})
+        throttle.release(throttle.acquire())
+        self.assertEqual(throttle.get_limits(), {'concurrency_limit': 3})
+
+        for i in range(20):
+            throttle.release(throttle.acquire())
+        self.assertEqual(throttle.get_limits(), {'concurrency_limit': 4})
+
+        # Multiplicative decrease, once per round
+        mock_time.monotonic.return_value = 1
+        tokens = [throttle.acquire() for i in range(4)]
+        mock_time.monotonic.return_value = 2
+        for token in tokens:
+            throttle.release(token, success=False)
+        self.assertEqual(throttle.get_limits(), {'concurrency_limit': 2})
+        self.assertEqual(throttle.decreases, 1)
+
+        throttle.release(throttle.acquire(), success=False)
+        throttle.release(throttle.acquire(), success=False)
+        self.assertEqual(throttle.get_limits(), {'concurrency_limit': 1})
+
+    @patch('arpa.time')
+    def test_latency(self, mock_time):
+        throttle = Throttle(max_concurrency=4, initial_concurrency=4)
+
+        def request(latency):
+            mock_time.monotonic.return_value = 0
+            token = throttle.acquire()
+            mock_time.monotonic.return_value = latency
+            throttle.release(token)
+
+        request(1)
+        request(5)
+        self.assertEqual(throttle.decreases, 0)
+        request(5)
+        self.assertEqual(throttle.decreases, 1)
+        self.assertEqual(throttle.get_limits(), {'concurrency_limit': 2})
+
+    def test_concurrency_limit(self):
+        throttle = Throttle(max_concurrency=1)
+        token = throttle.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            throttle.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        throttle.release(token)
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+    def test_rate(self):
+        throttle = Throttle(rate=50)
+        self.assertEqual(throttle.get_limits(), {'rate_limit': 50})
+
+        start = time.monotonic()
+        for i in range(6):
+            throttle.release(throttle.acquire())
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_invalid_params(self):
+        self.assertRaises(ValueError, Throttle, max_concurrency=2, min_concurrency=3)
+        self.assertRaises(ValueError, Throttle, max_concurrency=2, min_concurrency=0)
+        self.assertRaises(ValueError, Throttle, rate=0)
+        self.assertRaises(ValueError, Throttle, burst=0)
+        self.assertRaises(ValueError, Throttle, decrease_factor=1)
+
+    @responses.activate
+    def test_arpafy_limits(self):
+        responses.add(responses.POST, 'http://url', json={}, status=503)
+        prop = URIRef('http://warsa/place')
+        graph = Graph()
+        for i in range(4):
+            graph.add((URIRef('http://warsa/event_{}'.format(i)), prop, Literal('Hanko')))
+
+        throttle = Throttle(max_concurrency=4, initial_concurrency=4, rate=1000)
+        res = arpafy(graph, URIRef('http://warsa/target'), Arpa('http://url', throttle=throttle),
+                source_prop=prop, output_graph=Graph(), workers=4)
+
+        self.assertEqual(len(res['errors']), 4)
+        self.assertLess(res['concurrency_limit'], 4)
+        self.assertEqual(res['rate_limit'], 1000)
+
+        res = arpafy(graph, URIRef('http://warsa/target'), Arpa('http://url'),
+                source_prop=prop, output_graph=Graph())
+        self.assertNotIn('concurrency_limit', res)
+
+
+class TestQueryCache(TestCase):
+    def setUp(self):
+        self.url = 'http://url'
+        self.data = {'text': 'Hanko'}
+
+    def test_get_and_put(self):
+        cache = QueryCache(':memory:')
+
+        self.assertIsNone(cache.get(self.url, self.data))
+        cache.put(self.url, self.data, matches)
+
+        self.assertEqual(cache.get(self.url, self.data), matches)
+        self.assertIsNone(cache.get(self.url + '?cgen', self.data))
+        self.assertIsNone(cache.get(self.url, {'text': 'Hanko Hanko'}))
+        self.assertIsNone(cache.get(self.url, {'query': 'Hanko'}))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 4)
+        self.assertEqual(len(cache), 1)
+
+        cache.put(self.url, self.data, candidate_response)
+
+        self.assertEqual(cache.get(self.url, self.data), candidate_response)
+        self.assertEqual(len(cache), 1)
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'cache.db')
+            cache = QueryCache(path)
+            cache.put(self.url, self.data, matches)
+            cache.close()
+
+            cache = QueryCache(path)
+            self.assertEqual(len(cache), 1)
+            self.assertEqual(cache.get(self.url, self.data), matches)
+            cache.close()
+
+    @patch('arpa.time')
+    def test_lru_eviction(self, mock_time):
+        mock_time.time.return_value = 1
+        cache = QueryCache(':memory:', max_entries=2)
+
+        cache.put(self.url, {'text': 'a'}, matches)
+        mock_time.time.return_value = 2
+        cache.put(self.url, {'text': 'b'}, matches)
+        mock_time.time.return_value = 3
+        # Make 'a' the most recently used
+        cache.get(self.url, {'text': 'a'})
+        mock_time.time.return_value = 4
+        cache.put(self.url, {'text': 'c'}, matches)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNotNone(cache.get(self.url, {'text': 'a'}))
+        self.assertIsNone(cache.get(self.url, {'text': 'b'}))
+        self.assertIsNotNone(cache.get(self.url, {'text': 'c'}))
+
+    @patch('arpa.time')
+    def test_ttl(self, mock_time):
+        mock_time.time.return_value = 100
+        cache = QueryCache(':memory:', ttl=10)
+        cache.put(self.url, self.data, matches)
+
+        mock_time.time.return_value = 110
+        self.assertEqual(cache.get(self.url, self.data), matches)
+
+        mock_time.time.return_value = 111
+        self.assertIsNone(cache.get(self.url, self.data))
+        self.assertEqual(len(cache), 0)
+
+    def test_invalid_params(self):
+        self.assertRaises(ValueError, QueryCache, ':memory:', max_entries=0)
+        self.assertRaises(ValueError, QueryCache, ':memory:', ttl=0)
+
+    @responses.activate
+    def test_arpa_cache(self):
+        responses.add(responses.POST, self.url, json=matches, status=200)
+        cache = QueryCache(':memory:')
+
+        res = Arpa(self.url, cache=cache).get_uri_matches('Hanko Hanko')['results']
+        self.assertEqual(len(res), 3)
+        self.assertEqual(len(responses.calls), 1)
+
+        # Filtering options do not affect the cached response
+        res = Arpa(self.url, remove_duplicates=True, cache=cache).get_uri_matches(
+                'Hanko Hanko')['results']
+        self.assertEqual(len(res), 2)
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_arpa_mimic_cache(self):
+        responses.add(responses.POST, self.url, json=sparql_result, status=200)
+        cache = QueryCache(':memory:')
+
+        ArpaMimic('<VALUES>', self.url, cache=cache).get_uri_matches('Hanko')
+        ArpaMimic('<VALUES>', self.url, cache=cache).get_uri_matches('Hanko')
+        self.assertEqual(len(responses.calls), 1)
+
+        # Another query template
+        ArpaMimic('x <VALUES>', self.url, cache=cache).get_uri_matches('Hanko')
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_arpafy_cache_stats(self):
+        responses.add(responses.POST, self.url, json=matches, status=200)
+        prop = URIRef('http://warsa/place')
+        graph = Graph()
+        graph.add((URIRef('http://warsa/event'), prop, Literal('Hanko')))
+        graph.add((URIRef('http://warsa/event_2'), prop, Literal('Hanko')))
+
+        arpa = Arpa(self.url, cache=QueryCache(':memory:'))
+        res = arpafy(graph, URIRef('http://warsa/target'), arpa, source_prop=prop,
+                output_graph=Graph())
+
+        self.assertEqual(res['cache_hits'], 1)
+        self.assertEqual(res['cache_misses'], 1)
+
+        res = arpafy(graph, URIRef('http://warsa/target'), arpa, source_prop=prop,
+                output_graph=Graph())
+
+        self.assertEqual(res['cache_hits'], 2)
+        self.assertEqual(res['cache_misses'], 0)
+        self.assertEqual(len(responses.calls), 1)
+
+
+class TestCheckpoint(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'checkpoint.jsonl')
+
+        self.prop = URIRef('http://warsa/place')
+        self.tprop = URIRef('http://warsa/target')
+        self.graph = Graph()
+        for i in range(4):
+            self.graph.add((URIRef('http://warsa/event_{}'.format(i)), self.prop,
+                Literal('Hanko {}'.format(i))))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_add_and_get(self):
+        s = URIRef('http://warsa/event')
+        o = Literal('Hanko "1"\n', lang='fi')
+        result_dict = {
+            'results': [URIRef('http://ldf.fi/warsa/places/municipalities/m_place_75')],
+            'mentions': {'Hanko'},
+            'pre_validation_mentions': {'Hanko', 'Ha'}
+        }
+
+        with Checkpoint(self.path) as checkpoint:
+            self.assertNotIn((s, o), checkpoint)
+            checkpoint.add(s, o, result_dict)
+            checkpoint.add(s, Literal('Ha'), {'results': [Literal('Ha')]})
+            self.assertIn((s, o), checkpoint)
+
+        with Checkpoint(self.path, resume=True) as checkpoint:
+            self.assertEqual(len(checkpoint), 2)
+            self.assertEqual(checkpoint.get(s, o), result_dict)
+            self.assertEqual(checkpoint.get(s, Literal('Ha')), {'results': [Literal('Ha')]})
+            self.assertIsNone(checkpoint.get(s, Literal('Hanko')))
+
+        # Truncated if not resuming
+        with Checkpoint(self.path) as checkpoint:
+            self.assertEqual(len(checkpoint), 0)
+
+    def test_partial_line(self):
+        s = URIRef('http://warsa/event')
+        with Checkpoint(self.path) as checkpoint:
+            checkpoint.add(s, Literal('Hanko'), {'results': []})
+        with open(self.path, 'a') as f:
+            f.write('{"results": ["<http://ldf.fi/war')
+
+        with Checkpoint(self.path, resume=True) as checkpoint:
+            self.assertEqual(len(checkpoint), 1)
+            checkpoint.add(s, Literal('Ha'), {'results': []})
+
+        with Checkpoint(self.path, resume=True) as checkpoint:
+            self.assertEqual(len(checkpoint), 2)
+
+    def test_invalid_params(self):
+        self.assertRaises(ValueError, Checkpoint, self.path, flush_interval=0)
+
+    @responses.activate
+    def test_resume(self):
+        def fail_some(request):
+            if parse_qs(request.body)['text'][0] in ('Hanko 1', 'Hanko 3'):
+                return (503, {}, 'error')
+            return (200, {}, json.dumps(matches))
+
+        responses.add_callback(responses.POST, 'http://url', callback=fail_some)
+
+        with Checkpoint(self.path, flush_interval=1) as checkpoint:
+            res = arpafy(self.graph, self.tprop, Arpa('http://url'), source_prop=self.prop,
+                    output_graph=Graph(), checkpoint=checkpoint)
+
+        self.assertEqual(len(res['errors']), 2)
+        self.assertEqual(res['resumed'], 0)
+
+        responses.reset()
+        responses.add(responses.POST, 'http://url', json=matches, status=200)
+
+        with Checkpoint(self.path, resume=True) as checkpoint:
+            res = arpafy(self.graph, self.tprop, Arpa('http://url'), source_prop=self.prop,
+                    output_graph=Graph(), checkpoint=checkpoint, workers=2)
+
+        expected = arpafy(self.graph, self.tprop, Arpa('http://url'), source_prop=self.prop,
+                output_graph=Graph())
+
+        # Only the failed subjects were queried again
+        self.assertEqual(len(responses.calls), 2 + 4)
+        self.assertEqual(res['resumed'], 2)
+        self.assertEqual(res['processed'], 4)
+        self.assertEqual(res['errors'], [])
+        self.assertEqual(res['matches'], expected['matches'])
+        self.assertEqual(res['post_validation_mention_count'],
+                expected['post_validation_mention_count'])
+        self.assertEqual(set(res['graph']), set(expected['graph']))
+
+        # Everything is journaled now
+        with Checkpoint(self.path, resume=True) as checkpoint:
+            self.assertEqual(len(checkpoint), 4)
+
+    @responses.activate
+    def test_resume_stream(self):
+        responses.add(responses.POST, 'http://url', json=matches, status=200)
+        self.graph.add((BNode('b1'), self.prop, Literal('Hanko')))
+        input_file = os.path.join(self.tmp_dir.name, 'input.nt')
+        output_file = os.path.join(self.tmp_dir.name, 'output.nt')
+        graph_serialize(self.graph, destination=input_file, format='nt')
+
+        with Checkpoint(self.path) as checkpoint:
+            expected = process_stream(input_file, 'nt', output_file, 'nt', self.tprop,
+                    Arpa('http://url'), source_prop=self.prop, checkpoint=checkpoint)
+        with open(output_file) as f:
+            expected_output = set(f)
+
+        with Checkpoint(self.path, resume=True) as checkpoint:
+            res = process_stream(input_file, 'nt', output_file, 'nt', self.tprop,
+                    Arpa('http://url'), source_prop=self.prop, checkpoint=checkpoint)
+        with open(output_file) as f:
+            output = set(f)
+
+        self.assertEqual(len(responses.calls), 5)
+        self.assertEqual(res['resumed'], 5)
+        self.assertEqual(res['matches'], expected['matches'])
+        self.assertEqual(output, expected_output)
+
+
+class TestManifest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'manifest.jsonl')
+
+        self.prop = URIRef('http://warsa/place')
+        self.tprop = URIRef('http://warsa/target')
+        self.graph = Graph()
+        for i in range(4):
+            self.graph.add((URIRef('http://warsa/event_{}'.format(i)), self.prop,
+                Literal('Hanko {}'.format(i))))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_add_and_get(self):
+        s = URIRef('http://warsa/event')
+        result_dict = {
+            'results': [URIRef('http://ldf.fi/warsa/places/municipalities/m_place_75')],
+            'mentions': {'Hanko'},
+            'pre_validation_mentions': {'Hanko', 'Ha'}
+        }
+
+        with Manifest(self.path, {'arpa': 'http://url'}) as manifest:
+            fingerprint = manifest.get_fingerprint('Hanko')
+            self.assertNotEqual(fingerprint, manifest.get_fingerprint('Hankoo'))
+            self.assertIsNone(manifest.get(s, fingerprint))
+            manifest.add(s, fingerprint, result_dict)
+            manifest.add(URIRef('http://warsa/event_2'), fingerprint, {'results': []})
+
+        with Manifest(self.path, {'arpa': 'http://url'}) as manifest:
+            self.assertEqual(len(manifest), 2)
+            self.assertEqual(manifest.get_fingerprint('Hanko'), fingerprint)
+            self.assertEqual(manifest.get(s, fingerprint), result_dict)
+            manifest.add(s, fingerprint, result_dict)
+
+        # The subjects that were not added again are dropped
+        with Manifest(self.path, {'arpa': 'http://other'}) as manifest:
+            self.assertEqual(len(manifest), 1)
+            # The fingerprints change with the configuration
+            self.assertNotEqual(manifest.get_fingerprint('Hanko'), fingerprint)
+
+        # The previous manifest is kept if the run fails
+        with self.assertRaises(ValueError):
+            with Manifest(self.path) as manifest:
+                manifest.add(s, fingerprint, result_dict)
+                raise ValueError('Failed')
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['manifest.jsonl'])
+        self.assertEqual(len(Manifest(self.path)), 0)
+
+    @responses.activate
+    def test_incremental(self):
+        def fail_some(request):
+            if parse_qs(request.body)['text'][0] == 'Hanko 3':
+                return (503, {}, 'error')
+            return (200, {}, json.dumps(matches))
+
+        responses.add_callback(responses.POST, 'http://url', callback=fail_some)
+
+        with Manifest(self.path) as manifest:
+            res = arpafy(self.graph, self.tprop, Arpa('http://url'), source_prop=self.prop,
+                    output_graph=Graph(), manifest=manifest)
+
+        self.assertEqual(len(responses.calls), 4)
+        self.assertEqual(res['reused'], 0)
+        self.assertEqual(len(res['errors']), 1)
+
+        # Change, remove and add subjects
+        def event(i):
+            return URIRef('http://warsa/event_{}'.format(i))
+
+        self.graph.set((event(1), self.prop, Literal('Hanko changed')))
+        self.graph.remove((event(2), None, None))
+        self.graph.add((event(4), self.prop, Literal('Hanko 4')))
+
+        responses.reset()
+        responses.add(responses.POST, 'http://url', json=matches, status=200)
+
+        with Manifest(self.path) as manifest:
+            res = arpafy(self.graph, self.tprop, Arpa('http://url'), source_prop=self.prop,
+                    output_graph=Graph(), manifest=manifest, workers=2)
+
+        expected = arpafy(self.graph, self.tprop, Arpa('http://url'), source_prop=self.prop,
+                output_graph=Graph())
+
+        # Only the changed, new and failed subjects were queried
+        self.assertEqual(sorted(parse_qs(call.request.body)['text'][0]
+                for call in responses.calls[:3]), ['Hanko 3', 'Hanko 4', 'Hanko changed'])
+        self.assertEqual(res['reused'], 1)
+        self.assertEqual(res['processed'], 4)
+        self.assertEqual(res['errors'], [])
+        self.assertEqual(res['matches'], expected['matches'])
+        self.assertEqual(set(res['graph']), set(expected['graph']))
+
+        # The removed subject was dropped
+        with Manifest(self.path) as manifest:
+            self.assertEqual(len(manifest), 4)
+            fingerprint = manifest.get_fingerprint(Literal('Hanko 2'))
+            self.assertIsNone(manifest.get(event(2), fingerprint))
+
+    @responses.activate
+    def test_preprocessor_and_stream(self):
+        responses.add(responses.POST, 'http://url', json=matches, status=200)
+        self.graph.add((BNode('b1'), self.prop, Literal('Hanko')))
+        input_file = os.path.join(self.tmp_dir.name, 'input.nt')
+        output_file = os.path.join(self.tmp_dir.name, 'output.nt')
+        graph_serialize(self.graph, destination=input_file, format='nt')
+
+        def run(preprocessor):
+            with Manifest(self.path) as manifest:
+                res = process_stream(input_file, 'nt', output_file, 'nt', self.tprop,
+                        Arpa('http://url'), source_prop=self.prop, manifest=manifest,
+                        preprocessor=preprocessor)
+            with open(output_file) as f:
+                return res, set(f)
+
+        expected, expected_output = run(lambda o, s, g: str(o))
+        res, output = run(lambda o, s, g: str(o))
+
+        self.assertEqual(len(responses.calls), 5)
+        self.assertEqual(res['reused'], 5)
+        self.assertEqual(output, expected_output)
+
+        # The preprocessed text changes
+        res, output = run(lambda o, s, g: str(o).upper())
+        self.assertEqual(len(responses.calls), 10)
+        self.assertEqual(res['reused'], 0)
+
+
+class TestLinkWriter(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'links.nt')
+        self.prop = URIRef('http://ldf.fi/schema/place')
+        self.triples = [(URIRef('http://ldf.fi/event_{}'.format(i)), self.prop,
+            URIRef('http://ldf.fi/place_{}'.format(i % 3))) for i in range(5)]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read_lines(self):
+        with open(self.path, encoding='utf-8') as f:
+            return f.readlines()
+
+    def test_write(self):
+        with LinkWriter(self.path) as writer:
+            for triple in self.triples + self.triples[:2]:
+                writer.add(triple)
+            writer.add((BNode('b1'), self.prop, Literal('Hanko "1"\n', lang='fi')))
+            self.assertEqual(len(writer), 6)
+            self.assertEqual(writer.duplicates, 2)
+
+        g = Graph()
+        graph_parse(g, self.path, format='nt')
+        self.assertEqual(len(self.read_lines()), 6)
+        self.assertEqual(len(g), 6)
+        for triple in self.triples:
+            self.assertIn(triple, g)
+        self.assertIn(Literal('Hanko "1"\n', lang='fi'), set(g.objects()))
+
+    def test_buffer(self):
+        writer = LinkWriter(self.path, buffer_size=2)
+        writer.addN((s, p, o, None) for s, p, o in self.triples)
+        # The last triple is still buffered
+        self.assertEqual(len(self.read_lines()), 4)
+        writer.close()
+        self.assertEqual(len(self.read_lines()), 5)
+        writer.close()
+
+        self.assertRaises(ValueError, LinkWriter, self.path, 0)
+
+    def test_keep_duplicates(self):
+        with LinkWriter(self.path, remove_duplicates=False) as writer:
+            for triple in self.triples + self.triples:
+                writer.add(triple)
+        self.assertEqual(len(self.read_lines()), 10)
+
+    def test_arpafy(self):
+        graph = Graph()
+        graph.add((URIRef('http://ldf.fi/event'), SKOS.prefLabel, Literal('Hanko')))
+        arpa = LocalArpa(graph)
+
+        with LinkWriter(self.path) as writer:
+            res = process_graph(graph, self.prop, arpa, new_graph=True, output_graph=writer)
+            self.assertIs(res['graph'], writer)
+
+        self.assertEqual(self.read_lines(),
+                ['<http://ldf.fi/event> <http://ldf.fi/schema/place> <http://ldf.fi/event> .\n'])
+
+
+class TestLinkHelper(TestCase):
+    def setUp(self):
+        # TestProcess replaces these, and link_helper uses the real files
+        for name, f in (('parse', graph_parse), ('serialize', graph_serialize)):
+            patcher = patch.object(Graph, name, f)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir.name, name)
+
+    def write(self, name, text):
+        with open(self.path(name), 'w', encoding='utf-8') as f:
+            f.write(text)
+        return self.path(name)
+
+    def read_graph(self, name):
+        g = Graph()
+        g.parse(self.path(name), format='turtle')
+        return g
+
+    def test_shard_and_merge(self):
+        input_file = self.write('input.ttl', """
+            @prefix ex: <http://ex.org/> .
+            ex:d1 ex:place "Hanko" ; ex:author [ ex:name "doc1" ; ex:address [ ex:city "x" ] ] .
+            ex:d2 ex:place "Summa" ; ex:author _:shared .
+            ex:d3 ex:place "Kuhmo" ; ex:author _:shared .
+            _:shared ex:name "shared" .
+            ex:other ex:label "x" ; ex:ref [ ex:name "context" ] .
+            """)
+
+        link_helper.process_stage(['link_helper.py', 'shard', '3', input_file,
+                self.path('part_{}.ttl'), '--prop', 'http://ex.org/place'])
+
+        parts = [self.read_graph('part_{}.ttl'.format(i)) for i in range(3)]
+        place = URIRef('http://ex.org/place')
+        name = URIRef('http://ex.org/name')
+        for part in parts:
+            # The unselected triples and their blank nodes are in every part
+            self.assertIn((URIRef('http://ex.org/other'), URIRef('http://ex.org/label'),
+                Literal('x')), part)
+            self.assertIn(Literal('context'), set(part.objects(None, name)))
+            # The blank nodes of the subjects are in the same part
+            for s in part.subjects(place, None):
+                for o in part.objects(s, URIRef('http://ex.org/author')):
+                    self.assertIn((o, name, None), part)
+        self.assertEqual(sum(len(list(part.subjects(place, None))) for part in parts), 3)
+
+        part_files = [self.path('part_{}.ttl'.format(i)) for i in range(3)]
+        link_helper.process_stage(['link_helper.py', 'merge', self.path('output.ttl')]
+                + part_files)
+
+        merged = self.read_graph('output.ttl')
+        original = self.read_graph('input.ttl')
+        self.assertEqual(len(merged), len(original))
+        self.assertTrue(isomorphic(merged, original))
+
+    def test_split_graph_blank_nodes(self):
+        graph = Graph()
+        ex = 'http://ex.org/{}'.format
+        shared = BNode()
+        for i in range(20):
+            s = URIRef(ex('doc_{}'.format(i)))
+            author = BNode()
+            graph.add((s, URIRef(ex('author')), author))
+            graph.add((author, URIRef(ex('name')), Literal('Author {}'.format(i))))
+            graph.add((s, URIRef(ex('about')), shared))
+        graph.add((shared, URIRef(ex('name')), Literal('Shared')))
+
+        parts = split_graph(graph, 4)
+        for part in parts:
+            for s, o in part.subject_objects(URIRef(ex('author'))):
+                self.assertEqual(set(part.triples((o, None, None))),
+                        set(graph.triples((o, None, None))))
+            if len(part):
+                self.assertIn((shared, URIRef(ex('name')), Literal('Shared')), part)
+        self.assertEqual(sum(1 for part in parts for _ in part.subject_objects(
+            URIRef(ex('author')))), 20)
+
+    def test_shard_and_merge_args(self):
+        args = link_helper.parse_shard_args(['2', 'input.ttl', 'part_{}.nt', '--fo', 'nt',
+            '--prop', 'http://ex.org/place', '--rdf_class', 'http://ex.org/Doc'])
+        self.assertEqual(args.count, 2)
+        self.assertEqual(args.fi, 'turtle')
+        self.assertEqual(args.prop, URIRef('http://ex.org/place'))
+        self.assertEqual(args.rdf_class, URIRef('http://ex.org/Doc'))
+
+        self.assertRaises(SystemExit, link_helper.parse_shard_args, ['0', 'in.ttl', 'p_{}.ttl'])
+        self.assertRaises(SystemExit, link_helper.parse_shard_args, ['2', 'in.ttl', 'p.ttl'])
+
+        args = link_helper.parse_merge_args(['output.ttl', 'a.ttl', 'b.ttl'])
+        self.assertEqual(args.input, ['a.ttl', 'b.ttl'])
+        self.assertEqual(args.fo, 'turtle')
+        self.assertIsNone(args.fi)
+        self.assertRaises(SystemExit, link_helper.parse_merge_args, ['output.ttl'])
+
+
+class TestPipeline(TestLinkHelper):
+    def setUp(self):
+        super().setUp()
+        patcher = patch.object(link_helper, 'init_log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.cand = 'http://ex.org/candidate'
+        self.input_file = self.write('input.ttl', """
+            @prefix ex: <http://ex.org/> .
+            ex:e1 ex:candidate "Hanko", "ja", "Summa" ; ex:label "Event 1" .
+            ex:e2 ex:candidate "Kuhmo", "on" .
+            ex:e3 ex:candidate "x" .
+            """)
+
+    def pruner(self, candidate):
+        return candidate.upper() if len(candidate) > 2 else None
+
+    def get_candidates(self, name):
+        g = self.read_graph(name)
+        return {s: sorted(split_values(o)) for s, o in g.subject_objects(URIRef(self.cand))}
+
+    def test_read_pipeline(self):
+        config_file = self.write('pipeline.txt', """# Link the places
+            prune http://ex.org/target http://url --prop http://ex.org/candidate
+
+            # The query is quoted
+              disambiguate 'query file.sparql' http://ex.org/target http://url
+            raw http://ex.org/target http://url --ignore "Hanko Suomi"
+            """)
+
+        self.assertEqual(link_helper.read_pipeline(config_file), [
+            ['prune', 'http://ex.org/target', 'http://url', '--prop', 'http://ex.org/candidate'],
+            ['disambiguate', 'query file.sparql', 'http://ex.org/target', 'http://url'],
+            ['raw', 'http://ex.org/target', 'http://url', '--ignore', 'Hanko Suomi'],
+        ])
+
+    def test_file_arguments(self):
+        stages = [['prune', 'T', 'U'], ['join', 'T', 'U'], ['disambiguate', 'q.sparql', 'T', 'U'],
+                ['disambiguate_validate', 'q.sparql', 'T', 'U'], ['raw', 'T', 'U'], ['T', 'U']]
+        with patch.object(link_helper, 'get_stage',
+                side_effect=lambda *args, **kwargs: (None, None, {'report_file': None})) \
+                as get_stage:
+            link_helper.get_pipeline_stages(stages, 'in.ttl', 'out.ttl', pruner=self.pruner)
+
+        self.assertEqual([c[0][0] for c in get_stage.call_args_list], [
+            ['prune', 'in.ttl', 'out.ttl', 'T', 'U'],
+            ['join', 'in.ttl', 'out.ttl', 'T', 'U'],
+            ['disambiguate', 'q.sparql', 'in.ttl', 'out.ttl', 'T', 'U'],
+            ['disambiguate_validate', 'q.sparql', 'in.ttl', 'out.ttl', 'T', 'U'],
+            ['raw', 'in.ttl', 'out.ttl', 'T', 'U'],
+            ['in.ttl', 'out.ttl', 'T', 'U'],
+        ])
+        self.assertEqual(get_stage.call_args[1], {'pruner': self.pruner})
+
+    def test_prune_and_join(self):
+        args = ['http://ex.org/target', 'http://url', '--prop', self.cand]
+        link_helper.process_stage(['link_helper.py', 'prune', self.input_file,
+            self.path('pruned.ttl')] + args, pruner=self.pruner)
+        link_helper.process_stage(['link_helper.py', 'join', self.path('pruned.ttl'),
+            self.path('joined.ttl')] + args)
+
+        config_file = self.write('pipeline.txt', 'prune {0}\njoin {0}\n'.format(' '.join(args)))
+        link_helper.process_stage(['link_helper.py', 'pipeline', config_file, self.input_file,
+            self.path('output.ttl'), '--report', self.path('report.json')], pruner=self.pruner)
+
+        expected = self.get_candidates('joined.ttl')
+        self.assertEqual(self.get_candidates('output.ttl'), expected)
+        self.assertEqual(expected[URIRef('http://ex.org/e1')], ['HANKO', 'SUMMA'])
+        self.assertEqual(len(self.read_graph('output.ttl')), len(self.read_graph('joined.ttl')))
+
+        with open(self.path('report.json')) as f:
+            self.assertEqual([stage['stage'] for stage in json.load(f)], ['prune', 'join'])
+
+    def test_invalid_stage(self):
+        args = 'http://ex.org/target http://url --prop {}'.format(self.cand)
+        with patch.object(link_helper, 'process_graph') as mock_process_graph:
+            for invalid in ['raw {} --stream', 'raw {} --stream_links -n', 'raw {} --typo']:
+                stages = [['prune'] + args.split(), invalid.format(args).split()]
+                with self.assertRaises((ValueError, SystemExit)):
+                    link_helper.run_pipeline(Graph(), stages, 'in.ttl', 'out.ttl')
+            # Nothing is run if any of the stages is invalid
+            mock_process_graph.assert_not_called()
+
+    def test_checkpoint_closed(self):
+        checkpoint = self.path('checkpoint.jsonl')
+        stages = [['raw', 'http://ex.org/target', 'http://url', '--checkpoint', checkpoint],
+                ['raw', 'http://ex.org/target', 'http://url', '--stream']]
+        with patch.object(link_helper, 'Checkpoint') as mock_checkpoint:
+            self.assertRaises(ValueError, link_helper.run_pipeline, Graph(), stages,
+                    'in.ttl', 'out.ttl')
+        mock_checkpoint.return_value.close.assert_called_once_with()
+
 
 class TestMapResults(TestCase):
     def setUp(self):
@@ -1228,6 +3479,18 @@ class TestMapResults(TestCase):
         self.assertEqual(res[1]['properties']['promotion_rank'], self.ranks2)
         self.assertEqual(res[1]['matches'], self.ngrams2)
 
+    def test_map_bindings(self):
+        res = map_results(iter(self.sparql_result['results']['bindings']))
+        self.assertEqual(res, map_results(self.sparql_result))
+
+    def test_incremental_mapping(self):
+        mapper = ResultMapper()
+        for binding in self.sparql_result['results']['bindings']:
+            mapper.add(binding)
+        self.assertEqual(mapper.get_results(), map_results(self.sparql_result))
+
+        self.assertEqual(ResultMapper().get_results(), {'results': []})
+
     def test_map_with_missing_values(self):
         res = map_results(self.sparql_result_with_missing)['results']
         self.assertEqual(2, len(res))
@@ -1237,6 +3500,53 @@ class TestMapResults(TestCase):
         self.assertEqual(res[1]['matches'], self.ngrams2)
 
 
+class TestLogging(TestCase):
+    def setUp(self):
+        logging.disable(logging.NOTSET)
+        self.logger = logging.getLogger('arpa')
+        self.level = self.logger.level
+
+    def tearDown(self):
+        self.logger.setLevel(self.level)
+        logging.disable(logging.CRITICAL)
+
+    def test_truncated(self):
+        self.assertEqual(str(_Truncated('short')), 'short')
+
+        text = str(_Truncated('x' * 1000))
+        self.assertTrue(text.startswith('x' * 500 + '...'))
+        self.assertTrue(text.endswith('(1000 characters)'))
+
+        with patch('arpa.MAX_LOG_LENGTH', None):
+            self.assertEqual(str(_Truncated('x' * 1000)), 'x' * 1000)
+
+    def test_truncated_containers(self):
+        results = {'results': [{'id': 'http://ldf.fi/place_{}'.format(i)} for i in range(1000)]}
+        text = str(_Truncated(results))
+        self.assertLessEqual(len(text), 500)
+        self.assertIn("'http://ldf.fi/place_0'", text)
+
+        with patch('arpa.MAX_LOG_LENGTH', None):
+            self.assertEqual(str(_Truncated(results)), str(results))
+
+    def test_lazy_formatting(self):
+        formatted = []
+
+        class Results:
+            def __repr__(self):
+                formatted.append(self)
+                return 'results'
+
+        self.logger.setLevel(logging.WARNING)
+        self.logger.debug('%s', _Truncated(Results()))
+        self.assertEqual(formatted, [])
+
+        with self.assertLogs('arpa', logging.DEBUG) as cm:
+            self.logger.debug('%s', _Truncated(Results()))
+        self.assertEqual(len(formatted), 1)
+        self.assertEqual(cm.output, ['DEBUG:arpa:results'])
+
+
 class TestCombineCandidates(TestCase):
     def setUp(self):
         self.value = 'Hanko'
@@ -1259,6 +3569,12 @@ class TestCombineCandidates(TestCase):
         self.assertTrue('Toinen' in val)
         self.assertTrue(re.match('"\w+" "\w+"', val))
 
+    def test_split_values(self):
+        values = ['Hanko', '"Hanko"', 'Helsinki "Hanko']
+        self.assertEqual(values, split_values(combine_values(values)))
+        self.assertEqual([], split_values('Hanko'))
+        self.assertEqual([], split_values(''))
+
     def test_combine_values(self):
         values = [Literal('Hanko'), Literal('Helsinki')]
         self.assertEqual('"Hanko" "Helsinki"', combine_values(values))